@@ -0,0 +1,165 @@
+"""
+Benchmark the conversion of tubes to VTK polylines.
+
+Builds a synthetic group of tubes and reports the number of centerline
+points converted per second by the original per-point implementation
+(kept here as a reference) and by
+tube_visualization_utils.convert_tubes_to_polylines.
+
+Usage:
+    python benchmark_convert_tubes.py [num_tubes] [points_per_tube]
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from phantoms import make_synthetic_group, time_call  # noqa: E402
+from tube_utils import (  # noqa: E402
+    get_children_as_list,
+    get_tube_point_arrays,
+)
+from tube_visualization_utils import convert_tubes_to_polylines  # noqa: E402
+
+from vtkmodules.util.numpy_support import vtk_to_numpy  # noqa: E402
+from vtkmodules.vtkCommonCore import vtkDoubleArray, vtkPoints  # noqa: E402
+from vtkmodules.vtkCommonDataModel import (  # noqa: E402
+    vtkCellArray,
+    vtkPolyData,
+    vtkPolyLine,
+)
+
+
+def convert_tubes_to_polylines_reference(tubes):
+    """The original per-point conversion, used as the baseline."""
+    tube_polylines = []
+
+    tubes.Update()
+    tube_list = get_children_as_list(tubes)
+
+    names = [
+        "Id",
+        "Radius",
+        "Ridgeness",
+        "Medialness",
+        "Branchness",
+        "Curvature",
+        "Intensity",
+        "Roundness",
+        "Levelness",
+        "Alpha1",
+        "Alpha2",
+        "Alpha3",
+    ]
+    for tube in tube_list:
+        tube.Update()
+        tube.RemoveDuplicatePointsInObjectSpace()
+        tube.ComputeTangentsAndNormals()
+
+        tube_num_points = tube.GetNumberOfPoints()
+
+        data_point = vtkPoints()
+        data_point.SetNumberOfPoints(tube_num_points)
+
+        data = {}
+        for name in names:
+            data[name] = vtkDoubleArray()
+            data[name].SetName(name)
+            data[name].SetNumberOfTuples(tube_num_points)
+        data_color = vtkDoubleArray()
+        data_color.SetName("Color")
+        data_color.SetNumberOfComponents(4)
+        data_color.SetNumberOfTuples(tube_num_points)
+
+        tube_line = vtkPolyLine()
+        tube_line.GetPointIds().SetNumberOfIds(tube_num_points)
+        for point_num, point in enumerate(tube.GetPoints()):
+            tube_line.GetPointIds().SetId(point_num, point_num)
+            data_point.SetPoint(point_num, *point.GetPositionInWorldSpace())
+            data["Id"].SetTuple1(point_num, tube.GetId())
+            data["Radius"].SetTuple1(point_num, point.GetRadiusInWorldSpace())
+            data_color.SetTuple4(point_num, *point.GetColor())
+            data["Ridgeness"].SetTuple1(point_num, point.GetRidgeness())
+            data["Medialness"].SetTuple1(point_num, point.GetMedialness())
+            data["Branchness"].SetTuple1(point_num, point.GetBranchness())
+            data["Curvature"].SetTuple1(point_num, point.GetCurvature())
+            data["Intensity"].SetTuple1(point_num, point.GetIntensity())
+            data["Roundness"].SetTuple1(point_num, point.GetRoundness())
+            data["Levelness"].SetTuple1(point_num, point.GetLevelness())
+            data["Alpha1"].SetTuple1(point_num, point.GetAlpha1())
+            data["Alpha2"].SetTuple1(point_num, point.GetAlpha2())
+            data["Alpha3"].SetTuple1(point_num, point.GetAlpha3())
+
+        tube_line_array = vtkCellArray()
+        tube_line_array.InsertNextCell(tube_line)
+
+        tube_polylines.append(vtkPolyData())
+        tube_polylines[-1].SetPoints(data_point)
+        tube_polylines[-1].SetLines(tube_line_array)
+        for name in names:
+            tube_polylines[-1].GetPointData().AddArray(data[name])
+        tube_polylines[-1].GetPointData().AddArray(data_color)
+        tube_polylines[-1].GetPointData().SetActiveScalars("Radius")
+
+    return tube_polylines
+
+
+def main():
+    args = sys.argv[1:]
+    num_tubes = int(args[0]) if len(args) > 0 else 100
+    points_per_tube = int(args[1]) if len(args) > 1 else 1000
+    num_points = num_tubes * points_per_tube
+
+    print(f"Tubes: {num_tubes}  Points: {num_points}", flush=True)
+
+    group_ref = make_synthetic_group(num_tubes, points_per_tube)
+    time_ref, polylines_ref = time_call(
+        convert_tubes_to_polylines_reference, group_ref
+    )
+    print(f"  reference: {num_points / time_ref:14.0f} points/sec")
+
+    group = make_synthetic_group(num_tubes, points_per_tube)
+    time_new, polylines_new = time_call(
+        convert_tubes_to_polylines, group
+    )
+    print(f"  arrays:    {num_points / time_new:14.0f} points/sec")
+    print(f"  speedup:   {time_ref / time_new:14.1f}x")
+
+    check_conversion(group_ref, polylines_ref, group, polylines_new)
+
+
+def check_conversion(group_ref, polylines_ref, group_new, polylines_new):
+    """Asserts that both conversions give the same points and values."""
+    assert len(polylines_ref) == len(polylines_new)
+    for pd_ref, pd_new in zip(polylines_ref, polylines_new):
+        assert pd_ref.GetNumberOfPoints() == pd_new.GetNumberOfPoints()
+        assert np.allclose(
+            vtk_to_numpy(pd_ref.GetPoints().GetData()),
+            vtk_to_numpy(pd_new.GetPoints().GetData()),
+        )
+        for i in range(pd_ref.GetPointData().GetNumberOfArrays()):
+            name = pd_ref.GetPointData().GetArrayName(i)
+            array_new = pd_new.GetPointData().GetArray(name)
+            assert array_new is not None, name
+            assert np.allclose(
+                vtk_to_numpy(pd_ref.GetPointData().GetArray(name)),
+                vtk_to_numpy(array_new),
+            ), name
+
+    # Polylines carry no tangents, so compare those computed on the tubes
+    tangents_ref = [
+        list(point.GetTangentInWorldSpace())
+        for tube in get_children_as_list(group_ref)
+        for point in tube.GetPoints()
+    ]
+    tangents_new = get_tube_point_arrays(
+        get_children_as_list(group_new), include_object_space=True
+    )["TangentInObjectSpace"]
+    assert np.allclose(tangents_ref, tangents_new)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark the tiled vessel extraction of segment_vessels_brain_mra.
+
+Builds a synthetic angiogram of a tree of bright, branching vessels
+inside a brain mask, runs the stages of segment_vessels_brain_mra up to
+the vessel enhancement once, and then times extract_vessels in the
+"full" mode and in the "tiled" mode at the default min_vessel_length.
+Reports the speedup of the tiled mode, the agreement of the total
+centerline length of the extracted vessels, and the fraction of the
+centerline points of each mode's vessels that the other mode also found.
+
+Usage:
+    python benchmark_extract_vessels.py [size] [num_vessels] [num_workers]
+        [tile_size] [tile_overlap]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from phantoms import (  # noqa: E402
+    get_centerline_coverage,
+    get_total_centerline_length,
+    make_vessel_image,
+    make_vessel_tree,
+    time_call,
+)
+from segment_vessels_brain_mra import segment_vessels_brain_mra  # noqa: E402
+
+
+def time_extraction(segmenter, extraction_mode, num_workers):
+    """Returns the seconds taken by extract_vessels in a mode."""
+    segmenter.extraction_mode = extraction_mode
+    segmenter.num_workers = num_workers
+    return time_call(segmenter.extract_vessels)[0]
+
+
+def main():
+    args = sys.argv[1:]
+    size = int(args[0]) if len(args) > 0 else 128
+    num_vessels = int(args[1]) if len(args) > 1 else 12
+    num_workers = int(args[2]) if len(args) > 2 else os.cpu_count()
+    tile_size = int(args[3]) if len(args) > 3 else size // 2
+    tile_overlap = int(args[4]) if len(args) > 4 else tile_size // 4
+
+    segmenter = segment_vessels_brain_mra(
+        debug_output_base_name="./BenchmarkDebug/out"
+    )
+    segmenter.num_training_seeds = 20
+    segmenter.num_seeds = 200
+    segmenter.extraction_tile_size = tile_size
+    segmenter.extraction_tile_overlap = tile_overlap
+    group = make_vessel_tree(size, num_vessels)
+    segmenter.set_input_image(make_vessel_image(group, size))
+    segmenter.normalize_image(1.5)
+    segmenter.identify_training_seeds()
+    segmenter.generate_training_mask_image()
+    segmenter.enhance_vessels()
+
+    time_full = time_extraction(segmenter, "full", 1)
+    group_full = segmenter.data_vessels_group
+    time_tiled = time_extraction(segmenter, "tiled", num_workers)
+    group_tiled = segmenter.data_vessels_group
+    length_full = get_total_centerline_length(group_full)
+    length_tiled = get_total_centerline_length(group_tiled)
+
+    print(f"Size: {size}^3  Vessels: {num_vessels}  Workers: {num_workers}")
+    print(f"  tiles: {tile_size}^3 with {tile_overlap} overlap")
+    print(f"  full:    {time_full:8.2f} sec  {length_full:10.1f} length")
+    print(f"  tiled:   {time_tiled:8.2f} sec  {length_tiled:10.1f} length")
+    print(f"  speedup: {time_full / time_tiled:8.2f}x")
+    print(f"  length agreement: {length_tiled / length_full:8.3f}")
+    print(
+        "  full points found by tiled:"
+        f" {get_centerline_coverage(group_tiled, group_full):8.3f}"
+    )
+    print(
+        "  tiled points found by full:"
+        f" {get_centerline_coverage(group_full, group_tiled):8.3f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
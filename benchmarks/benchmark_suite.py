@@ -0,0 +1,285 @@
+"""
+A reproducible benchmark suite over synthetic vessel phantoms.
+
+Builds, from fixed random seeds, trees of tubes whose geometry is known
+and MR angiogram-like images of them, and times:
+
+    pipeline: the stages of segment_vessels_brain_mra.run, as recorded
+        by its stage profiler, at each image size.
+    tubes: convert_tubes_to_polylines, convert_tubes_to_surfaces,
+        write_group and read_group (as ".tre" and ".tubes"), and the
+        building of a tube_viewer scene, from the conversions to the
+        mappers, actors, and first render, at each number of tubes.
+        Scenes are rendered off screen.
+
+The results, and the commit and platform they were measured on, are
+written to a JSON file, by default in the temporary directory.  Given
+an earlier results file, the ratio of each time to its earlier value is
+also reported, so regressions can be found between commits.
+
+Usage:
+    python benchmark_suite.py [--sizes 64 96] [--tube-counts 100 1000]
+        [--output results.json] [--compare earlier.json]
+
+Tube benchmarks keep the fastest of --repeats runs.  The pipeline runs
+once per size, as it takes minutes.
+
+Run with --help for all options.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import itk
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from phantoms import (  # noqa: E402
+    get_total_centerline_length,
+    make_vessel_image,
+    make_vessel_tree,
+    time_call,
+)
+from segment_vessels_brain_mra import segment_vessels_brain_mra  # noqa: E402
+from tube_utils import (  # noqa: E402
+    get_children_as_list,
+    read_group,
+    write_group,
+)
+from tube_viewer import tube_viewer  # noqa: E402
+from tube_visualization_utils import (  # noqa: E402
+    convert_tubes_to_polylines,
+    convert_tubes_to_surfaces,
+    geometry_cache,
+)
+
+# Small enough that the pipeline finishes in minutes on synthetic images
+PIPELINE_SETTINGS = {
+    "num_training_seeds": 10,
+    "num_seeds": 100,
+    "min_vessel_length": 10,
+}
+
+
+def benchmark_pipeline(size, num_vessels, noise, work_dir):
+    """
+    Times the stages of segment_vessels_brain_mra.run on a phantom.
+
+    Returns:
+        A list of result dicts, one per stage.
+    """
+    group = make_vessel_tree(size, num_vessels)
+    img = make_vessel_image(group, size, noise)
+
+    records = []
+    segmenter = segment_vessels_brain_mra(
+        debug_output_base_name=os.path.join(work_dir, "Debug", "out"),
+        profile_callback=records.append,
+    )
+    for name, value in PIPELINE_SETTINGS.items():
+        setattr(segmenter, name, value)
+    segmenter.set_input_image(img)
+    segmenter.run()
+
+    truth_length = get_total_centerline_length(group)
+    extracted_length = get_total_centerline_length(
+        segmenter.data_vessels_group
+    )
+    results = []
+    for record in records:
+        result = {
+            "benchmark": f"pipeline/{record['stage']}",
+            "size": size,
+            "num_vessels": num_vessels,
+            "seconds": record["wall_time"],
+        }
+        for name in ("cpu_time", "peak_rss_mb", "voxels_per_second"):
+            result[name] = record[name]
+        if record["stage"] == "run":
+            result["truth_length"] = truth_length
+            result["extracted_length"] = extracted_length
+        results.append(result)
+    return results
+
+
+def benchmark_tubes(num_tubes, work_dir, repeats=3):
+    """
+    Times the conversion, I/O, and viewing of a tree of num_tubes tubes.
+
+    Each time is the shortest of repeats runs.  The geometry cache is
+    cleared before each run, so every time includes the conversion.
+
+    Returns:
+        A list of result dicts, one per operation.
+    """
+    group = make_vessel_tree(256, num_tubes)
+    num_points = sum(
+        tube_so.GetNumberOfPoints() for tube_so in get_children_as_list(group)
+    )
+    results = []
+
+    def _time(benchmark, func, *args, **kwargs):
+        seconds = []
+        for _ in range(repeats):
+            geometry_cache.invalidate()
+            seconds.append(time_call(func, *args, **kwargs)[0])
+        results.append(
+            {
+                "benchmark": benchmark,
+                "num_tubes": num_tubes,
+                "num_points": num_points,
+                "seconds": min(seconds),
+            }
+        )
+
+    for merged in (False, True):
+        _time(
+            f"convert_tubes_to_polylines/merged={merged}",
+            convert_tubes_to_polylines,
+            group,
+            merged,
+        )
+        _time(
+            f"convert_tubes_to_surfaces/merged={merged}",
+            convert_tubes_to_surfaces,
+            group,
+            merged=merged,
+        )
+
+    for extension in (".tre", ".tubes"):
+        filename = os.path.join(work_dir, f"group-{num_tubes}{extension}")
+        _time(f"write_group/{extension}", write_group, group, filename)
+        _time(f"read_group/{extension}", read_group, filename)
+
+    def _view(merged, lod):
+        viewer = tube_viewer(group, merged, offscreen=True)
+        if lod:
+            viewer.render_tubes_as_lod_surfaces()
+        else:
+            viewer.render_tubes_as_surfaces()
+
+    for merged, lod in ((False, False), (True, False), (True, True)):
+        _time(f"tube_viewer/merged={merged},lod={lod}", _view, merged, lod)
+    return results
+
+
+def get_environment():
+    """Returns the commit and platform that the results are measured on."""
+    commit = None
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "itk": itk.Version.GetITKVersion(),
+        "cpu_count": os.cpu_count(),
+        "itk_threads": itk.MultiThreaderBase.GetGlobalDefaultNumberOfThreads(),
+    }
+
+
+def get_result_key(result):
+    """Returns what identifies a result across results files."""
+    return (
+        result["benchmark"],
+        result.get("size"),
+        result.get("num_vessels"),
+        result.get("num_tubes"),
+    )
+
+
+def compare_results(earlier, results):
+    """Prints the ratio of each time to its time in an earlier file."""
+    earlier_seconds = {
+        get_result_key(result): result["seconds"]
+        for result in earlier["results"]
+    }
+    print(f"Compared with commit {earlier['environment']['commit']}:")
+    for result in results:
+        key = get_result_key(result)
+        if key not in earlier_seconds or earlier_seconds[key] <= 0:
+            continue
+        ratio = result["seconds"] / earlier_seconds[key]
+        label = " ".join(str(x) for x in key if x is not None)
+        print(f"  {label:60s} {ratio:8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="*", default=[64, 96])
+    parser.add_argument("--num-vessels", type=int, default=8)
+    parser.add_argument("--noise", type=float, default=5.0)
+    parser.add_argument(
+        "--tube-counts", type=int, nargs="*", default=[100, 1000]
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="runs of each tube benchmark, of which the fastest is kept",
+    )
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=None,
+        help="ITK's default number of threads, for comparable timings",
+    )
+    parser.add_argument(
+        "--output",
+        default=os.path.join(
+            tempfile.gettempdir(), "benchmark_suite_results.json"
+        ),
+    )
+    parser.add_argument("--compare", default=None, help="earlier results")
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(args.num_threads)
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for num_tubes in args.tube_counts:
+            print(f"Tubes: {num_tubes}", flush=True)
+            results += benchmark_tubes(num_tubes, work_dir, args.repeats)
+        for size in args.sizes:
+            print(f"Pipeline: {size}^3", flush=True)
+            results += benchmark_pipeline(
+                size, args.num_vessels, args.noise, work_dir
+            )
+
+    for result in results:
+        label = " ".join(
+            str(x) for x in get_result_key(result) if x is not None
+        )
+        print(f"  {label:60s} {result['seconds']:10.3f} sec")
+
+    with open(args.output, "w") as file:
+        json.dump(
+            {"environment": get_environment(), "results": results},
+            file,
+            indent=2,
+        )
+    print(f"Results written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            compare_results(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
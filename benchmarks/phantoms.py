@@ -0,0 +1,180 @@
+"""
+Synthetic vessel phantoms and helpers shared by the benchmarks.
+
+Functions:
+    make_vessel_tree: Creates a tree of tubes branching in a sphere.
+    make_vessel_image: Creates an MR angiogram-like image of tubes.
+    get_total_centerline_length: Returns the summed centerline length of
+        a group's tubes.
+    get_centerline_coverage: Returns the fraction of a group's
+        centerline points that lie near another group's centerlines.
+    make_synthetic_group: Creates a group of long random-walk tubes.
+    time_call: Returns the seconds taken by a call and its return value.
+
+Every phantom is built from a fixed random seed, so benchmarks of
+different commits run on identical data.
+"""
+
+import os
+import sys
+import time
+
+import itk
+import numpy as np
+from itk import TubeTK as tube
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from tube_utils import (  # noqa: E402
+    get_children_as_list,
+    get_tube_point_arrays,
+    tube_point_index,
+)
+
+
+def make_vessel_tree(size=64, num_vessels=8, seed=0):
+    """
+    Creates a group of tubes that branch from one another in a sphere.
+
+    The first vessel starts near the center of a size^3 volume of unit
+    spacing.  Each later vessel branches from a random point of an
+    earlier one, with a smaller radius, and is a smooth random walk that
+    ends at the sphere of radius 0.45 * size.
+
+    Returns:
+        The group.  Tube ids are the vessel numbers.
+    """
+    rng = np.random.default_rng(seed)
+    center = np.full(3, size / 2)
+    group = itk.GroupSpatialObject[3].New()
+    vessels = []
+    for vessel_num in range(num_vessels):
+        if vessel_num == 0:
+            position = center + rng.uniform(-0.1, 0.1, 3) * size
+            radius = 2.5
+        else:
+            parent_positions, parent_radius = vessels[
+                rng.integers(len(vessels))
+            ]
+            position = parent_positions[rng.integers(len(parent_positions))]
+            radius = max(0.75, 0.75 * parent_radius)
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        positions = [position]
+        for _ in range(size):
+            direction += rng.normal(0, 0.1, 3)
+            direction /= np.linalg.norm(direction)
+            position = position + direction
+            if np.linalg.norm(position - center) > 0.45 * size:
+                break
+            positions.append(position)
+        if len(positions) < 2:
+            continue
+        vessels.append((np.array(positions), radius))
+
+        tube_so = itk.TubeSpatialObject[3].New()
+        tube_so.SetId(len(vessels) - 1)
+        points = []
+        for point_num, point_position in enumerate(positions):
+            point = itk.TubeSpatialObjectPoint[3]()
+            point.SetId(point_num)
+            point.SetPositionInObjectSpace(point_position.tolist())
+            point.SetRadiusInObjectSpace(radius)
+            point.SetColor(1, 0, 0, 1)
+            points.append(point)
+        tube_so.SetPoints(points)
+        tube_so.Update()
+        group.AddChild(tube_so)
+    group.Update()
+    return group
+
+
+def make_vessel_image(group, size=64, noise=5.0, seed=0):
+    """
+    Creates an MR angiogram-like image of the tubes of a group.
+
+    The tubes are drawn bright, with blurred edges, over a dim, noisy,
+    brain-shaped sphere.
+    """
+    rng = np.random.default_rng(seed)
+    template = itk.GetImageFromArray(np.zeros([size] * 3, dtype=np.float32))
+    template.SetSpacing([1.0, 1.0, 1.0])
+
+    tubesToImage = tube.ConvertTubesToImage[itk.Image[itk.F, 3]].New()
+    tubesToImage.SetTemplateImage(template)
+    tubesToImage.SetInput(group)
+    tubesToImage.SetUseRadius(True)
+    tubesToImage.Update()
+    imMath = tube.ImageMath.New(tubesToImage.GetOutput())
+    imMath.Blur(1.0)
+    vessels = itk.array_from_image(imMath.GetOutput())
+
+    shape = (size, size, size)
+    grid = np.indices(shape, dtype=np.float32)
+    center = np.array(shape) / 2
+    brain = (
+        np.square(grid - center[:, None, None, None]).sum(axis=0)
+        < (0.45 * size) ** 2
+    )
+    data = brain * (100 + 200 * np.clip(vessels, 0, 1))
+    data += brain * rng.normal(0, noise, shape)
+    img = itk.GetImageFromArray(np.clip(data, 0, None).astype(np.float32))
+    img.CopyInformation(template)
+    return img
+
+
+def get_total_centerline_length(group):
+    """Returns the summed length of the centerlines of a group's tubes."""
+    tube_list = get_children_as_list(group)
+    if len(tube_list) == 0:
+        return 0.0
+    point_arrays = get_tube_point_arrays(tube_list)
+    steps = np.linalg.norm(np.diff(point_arrays["Position"], axis=0), axis=1)
+    # Drop the steps from the last point of a tube to the next tube
+    steps[point_arrays["TubeOffsets"][1:-1] - 1] = 0
+    return float(steps.sum())
+
+
+def get_centerline_coverage(group, reference, distance=2.0):
+    """Returns the fraction of reference's centerline points within a
+    distance of a centerline point of group."""
+    tube_list = get_children_as_list(reference)
+    if len(tube_list) == 0:
+        return 1.0
+    positions = get_tube_point_arrays(tube_list)["Position"]
+    counts = tube_point_index(group).count_points_within_radius(
+        positions, distance
+    )
+    return float(np.mean(counts > 0))
+
+
+def make_synthetic_group(num_tubes=100, points_per_tube=1000, seed=0):
+    """Creates a group of random-walk tubes with varying radii."""
+    rng = np.random.default_rng(seed)
+    group = itk.GroupSpatialObject[3].New()
+    for tube_num in range(num_tubes):
+        tube = itk.TubeSpatialObject[3].New()
+        tube.SetId(tube_num)
+        steps = rng.normal(0, 0.2, (points_per_tube, 3)) + [0.5, 0, 0]
+        positions = np.cumsum(steps, axis=0) + rng.uniform(0, 100, 3)
+        radii = rng.uniform(0.5, 3.0) * np.ones(points_per_tube)
+        points = []
+        for point_num in range(points_per_tube):
+            point = itk.TubeSpatialObjectPoint[3]()
+            point.SetId(point_num)
+            point.SetPositionInObjectSpace(positions[point_num].tolist())
+            point.SetRadiusInObjectSpace(float(radii[point_num]))
+            point.SetColor(1, 0, 0, 1)
+            points.append(point)
+        tube.SetPoints(points)
+        tube.Update()
+        group.AddChild(tube)
+    group.Update()
+    return group
+
+
+def time_call(func, *args, **kwargs):
+    """Returns the seconds taken by func and its return value."""
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    return time.perf_counter() - start, value
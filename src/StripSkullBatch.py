@@ -0,0 +1,36 @@
+import sys
+
+from strip_skull_batch import strip_skull_batch
+
+
+def read_manifest(filename):
+    """Read one subject per line, as whitespace-separated image files."""
+    with open(filename) as file:
+        return [
+            tuple(line.split())
+            for line in file
+            if line.strip() and not line.startswith("#")
+        ]
+
+
+def main():
+    args = sys.argv[1:]
+    if 2 <= len(args) <= 4:
+        manifest = read_manifest(args[0])
+        num_workers = int(args[2]) if len(args) > 2 else 1
+        strip_skull_args = {}
+        if len(args) > 3:
+            strip_skull_args["data_dir"] = args[3]
+        results = strip_skull_batch(
+            manifest, args[1], num_workers=num_workers, **strip_skull_args
+        )
+        failed = [r["subject"] for r in results if r["status"] != "done"]
+        print(f"{len(results) - len(failed)} of {len(results)} subjects done")
+        if failed:
+            print("ERROR: Failed subjects: " + " ".join(failed))
+            sys.exit(1)
+    else:
+        print(
+            "USAGE: StripSkullBatch <manifest.txt> <output_dir>"
+            " [num_workers] [data_dir]"
+        )
@@ -1,12 +1,23 @@
 # __init__.py
 from .segment_vessels_brain_mra import segment_vessels_brain_mra
 from .strip_skull import strip_skull
+from .strip_skull_batch import strip_skull_batch
 from .tube_utils import (
     get_children_as_list,
+    merge_tube_groups,
     read_group,
+    read_group_arrays,
+    tube_id_map,
+    tube_point_index,
+    write_group,
+    write_group_arrays,
 )
 from .tube_viewer import tube_viewer
 from .tube_visualization_utils import (
+    convert_point_arrays_to_polylines,
+    convert_tubes_to_lod_surfaces,
     convert_tubes_to_polylines,
     convert_tubes_to_surfaces,
+    geometry_cache,
+    tube_geometry_cache,
 )
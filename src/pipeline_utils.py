@@ -0,0 +1,543 @@
+"""
+Utilities shared by the image processing pipelines.
+
+Classes:
+    pipeline_checkpoint: A content-addressed store of the outputs of
+        pipeline stages, used to skip stages that are up to date.
+    stage_profiler: Records the time, memory, and throughput of the
+        stages of a pipeline.
+    background_image_writer: Compresses and writes images on a worker
+        thread, with a bound on the memory of the queued images.
+
+Functions:
+    get_image_hash: Returns a digest of an image's pixels and geometry.
+    profile_stage: Decorates the stage methods of a pipeline so that
+        they are recorded by its stage_profiler, if it has one.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import itk
+import numpy as np
+
+from tube_utils import read_group, write_group
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Change to invalidate all checkpoints, e.g., when a stage's algorithm
+#   changes in a way that its parameters do not capture.
+PIPELINE_CHECKPOINT_VERSION = 2
+
+
+def get_image_hash(img) -> str:
+    """Returns a digest of an image's pixels, pixel type, and geometry.
+
+    Args:
+        img (itk.Image): The image to hash.
+
+    Returns:
+        str: A hex digest that changes if any pixel or the geometry does.
+    """
+    digest = hashlib.sha1()
+    array = np.ascontiguousarray(itk.array_view_from_image(img))
+    digest.update(str(array.dtype).encode())
+    digest.update(str(array.shape).encode())
+    digest.update(array.data)
+    geometry = [
+        list(img.GetSpacing()),
+        list(img.GetOrigin()),
+        itk.array_from_matrix(img.GetDirection()).tolist(),
+    ]
+    digest.update(json.dumps(geometry).encode())
+    return digest.hexdigest()
+
+
+def _to_json(value):
+    """Converts NumPy values for json.dumps."""
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+class pipeline_checkpoint:
+    """A content-addressed store of the outputs of pipeline stages.
+
+    Each stage is keyed by a digest of its name, its parameters, and the
+    keys of its inputs, which are either image hashes or the keys of
+    earlier stages.  A change to an input or a parameter therefore
+    changes the key of that stage and of every stage after it, as in a
+    build system, while the stages before it are reloaded from disk.
+
+    Stage outputs are attributes of the pipeline object.  Images, lists
+    of images, groups of tubes, NumPy arrays, and JSON values are
+    supported.
+    """
+
+    def __init__(self, checkpoint_dir: str, debug: bool = False):
+        """
+        Args:
+            checkpoint_dir (str): The directory holding the checkpoints.
+                It is created if needed.
+            debug (bool, optional): Report stages that are reloaded or
+                saved. Defaults to False.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.debug = debug
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+    def get_stage_key(self, stage: str, inputs: list, params: dict) -> str:
+        """Returns the key of a stage given its inputs and parameters.
+
+        Args:
+            stage (str): The name of the stage.
+            inputs (list): Image hashes or keys of earlier stages.
+            params (dict): Every parameter that changes the outputs.
+
+        Returns:
+            str: A hex digest.
+        """
+        description = json.dumps(
+            [PIPELINE_CHECKPOINT_VERSION, stage, inputs, params],
+            sort_keys=True,
+            default=_to_json,
+        )
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def _getStageDir(self, stage: str, key: str) -> str:
+        return os.path.join(self.checkpoint_dir, f"{stage}-{key}")
+
+    def load(self, stage: str, key: str) -> dict:
+        """Returns the saved outputs of a stage, or None if there are none.
+
+        Args:
+            stage (str): The name of the stage.
+            key (str): The key from get_stage_key.
+
+        Returns:
+            dict: The outputs, by attribute name.
+        """
+        stage_dir = self._getStageDir(stage, key)
+        manifest_file = os.path.join(stage_dir, "manifest.json")
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file) as file:
+            manifest = json.load(file)
+
+        outputs = {}
+        for name, (kind, value) in manifest.items():
+            path = os.path.join(stage_dir, name)
+            if kind == "image":
+                outputs[name] = itk.imread(path + ".mha")
+            elif kind == "image_list":
+                outputs[name] = [
+                    itk.imread(f"{path}-{i}.mha") for i in range(value)
+                ]
+            elif kind == "group":
+                outputs[name] = read_group(path + ".tre")
+            elif kind == "array":
+                outputs[name] = np.load(path + ".npy")
+            else:
+                outputs[name] = value
+        return outputs
+
+    def save(self, stage: str, key: str, outputs: dict):
+        """Saves the outputs of a stage.
+
+        The files are written to a temporary directory that is renamed
+        once complete, so an interrupted run never leaves a partial
+        checkpoint.
+
+        Args:
+            stage (str): The name of the stage.
+            key (str): The key from get_stage_key.
+            outputs (dict): The outputs, by attribute name.
+        """
+        stage_dir = self._getStageDir(stage, key)
+        tmp_dir = tempfile.mkdtemp(dir=self.checkpoint_dir)
+        manifest = {}
+        for name, value in outputs.items():
+            path = os.path.join(tmp_dir, name)
+            if isinstance(value, itk.GroupSpatialObject[3]):
+                write_group(value, path + ".tre")
+                manifest[name] = ("group", None)
+            elif isinstance(value, itk.ImageBase[3]):
+                itk.imwrite(value, path + ".mha", compression=True)
+                manifest[name] = ("image", None)
+            elif (
+                isinstance(value, list)
+                and len(value) > 0
+                and isinstance(value[0], itk.ImageBase[3])
+            ):
+                for i, img in enumerate(value):
+                    itk.imwrite(img, f"{path}-{i}.mha", compression=True)
+                manifest[name] = ("image_list", len(value))
+            elif isinstance(value, np.ndarray):
+                np.save(path + ".npy", value)
+                manifest[name] = ("array", None)
+            else:
+                manifest[name] = ("value", value)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as file:
+            json.dump(manifest, file, default=_to_json)
+
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        os.rename(tmp_dir, stage_dir)
+
+    def run_stage(
+        self,
+        pipeline,
+        stage: str,
+        inputs: list,
+        params: dict,
+        method,
+        outputs: list,
+    ) -> str:
+        """Runs a stage of a pipeline, or reloads its outputs if saved.
+
+        Args:
+            pipeline: The pipeline object holding the stage outputs.
+            stage (str): The name of the stage.
+            inputs (list): Image hashes or keys of earlier stages.
+            params (dict): Every parameter that changes the outputs.
+            method: Called with no arguments to run the stage.
+            outputs (list): The names of the pipeline attributes that
+                the stage sets.
+
+        Returns:
+            str: The key of the stage, to pass as an input of later
+                stages.
+        """
+        key = self.get_stage_key(stage, inputs, params)
+        saved = self.load(stage, key)
+        if saved is not None:
+            if self.debug:
+                print(f"*** Reloading {stage} from checkpoint ***")
+            for name, value in saved.items():
+                setattr(pipeline, name, value)
+            return key
+
+        method()
+        if self.debug:
+            print(f"*** Saving {stage} checkpoint ***")
+        self.save(
+            stage, key, {name: getattr(pipeline, name) for name in outputs}
+        )
+        return key
+
+
+def _get_peak_rss_mb():
+    """Returns the peak resident set size of this process, in MB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _get_children_cpu_time():
+    """Returns the CPU time of the ended child processes, e.g., workers."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class stage_profiler:
+    """Records the time, memory, and throughput of the stages of a pipeline.
+
+    Each stage gives one record, a dict with:
+        pipeline, stage, parent: The class of the pipeline, the name of
+            the stage, and the name of the stage that called it, if any.
+        start: The time.time() at which the stage began.
+        wall_time, cpu_time: Seconds elapsed and seconds of CPU used by
+            this process.
+        children_cpu_time: Seconds of CPU used by the worker processes
+            that ended during the stage.
+        peak_rss_mb, peak_rss_increase_mb: The peak resident memory of
+            this process after the stage, and how much the stage raised
+            it.  None where the resource module is unavailable.
+        num_voxels, voxels_per_second: The voxels of the pipeline's
+            input and their number over wall_time.
+        num_threads: ITK's default number of threads during the stage.
+
+    Records are kept in the records list, passed to the callback as they
+    complete, and, if a profile_file is given, rewritten to it as JSON.
+    Stages that call other stages are recorded after them.
+    """
+
+    def __init__(self, profile_file: str = None, callback=None):
+        """
+        Args:
+            profile_file (str, optional): JSON file listing the records.
+                Defaults to None, for no file.
+            callback (optional): Called with each record as it
+                completes. Defaults to None.
+        """
+        self.profile_file = profile_file
+        self.callback = callback
+        self.records = []
+        self._stages = []
+
+    def profile(self, pipeline, stage: str, method, *args, **kwargs):
+        """Runs a stage method and records it.
+
+        Args:
+            pipeline: The pipeline object.  Its _getNumVoxels method, if
+                any, gives num_voxels once the stage has run.
+            stage (str): The name of the stage.
+            method: The stage method, called with args and kwargs.
+
+        Returns:
+            The return value of the method.
+        """
+        record = {
+            "pipeline": type(pipeline).__name__,
+            "stage": stage,
+            "parent": self._stages[-1] if self._stages else None,
+            "start": time.time(),
+            "num_threads": (
+                itk.MultiThreaderBase.GetGlobalDefaultNumberOfThreads()
+            ),
+        }
+        peak_rss = _get_peak_rss_mb()
+        children_cpu_time = _get_children_cpu_time()
+        cpu_time = time.process_time()
+        wall_time = time.perf_counter()
+        self._stages.append(stage)
+        try:
+            result = method(*args, **kwargs)
+        finally:
+            self._stages.pop()
+            record["wall_time"] = time.perf_counter() - wall_time
+            record["cpu_time"] = time.process_time() - cpu_time
+            record["children_cpu_time"] = (
+                _get_children_cpu_time() - children_cpu_time
+            )
+            record["peak_rss_mb"] = _get_peak_rss_mb()
+            record["peak_rss_increase_mb"] = None
+            if peak_rss is not None:
+                record["peak_rss_increase_mb"] = (
+                    record["peak_rss_mb"] - peak_rss
+                )
+            num_voxels = 0
+            if hasattr(pipeline, "_getNumVoxels"):
+                num_voxels = pipeline._getNumVoxels()
+            record["num_voxels"] = num_voxels
+            record["voxels_per_second"] = num_voxels / max(
+                record["wall_time"], 1e-9
+            )
+            self.add_record(record)
+        return result
+
+    def add_record(self, record: dict):
+        """Adds a record, e.g., one made in a worker process.
+
+        Args:
+            record (dict): The record, as made by profile.
+        """
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+        if self.profile_file is not None:
+            with open(self.profile_file, "w") as file:
+                json.dump(self.records, file, indent=2)
+
+
+def profile_stage(method):
+    """Decorates a stage method so that the pipeline's profiler records it.
+
+    The pipeline holds its stage_profiler in a profiler attribute.  When
+    that is None, the method is called directly.
+
+    Args:
+        method: The stage method.
+
+    Returns:
+        The decorated method.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.profiler is None:
+            return method(self, *args, **kwargs)
+        return self.profiler.profile(
+            self, method.__name__, method, self, *args, **kwargs
+        )
+
+    return wrapper
+
+
+# MetaImage element types of the pixel types written without ITK
+_METAIMAGE_ELEMENT_TYPES = {
+    "int8": "MET_CHAR",
+    "uint8": "MET_UCHAR",
+    "int16": "MET_SHORT",
+    "uint16": "MET_USHORT",
+    "int32": "MET_INT",
+    "uint32": "MET_UINT",
+    "float32": "MET_FLOAT",
+    "float64": "MET_DOUBLE",
+}
+
+
+def _write_metaimage(filename, array, spacing, origin, direction, level):
+    """Writes an array as a zlib-compressed MetaImage (.mha) file.
+
+    Python's zlib and file writes release the GIL, unlike itk.imwrite,
+    so this runs alongside the pipeline on a worker thread.
+    """
+    data = zlib.compress(np.ascontiguousarray(array).data, level)
+    num_dims = len(spacing)
+    header = [
+        "ObjectType = Image",
+        f"NDims = {num_dims}",
+        "BinaryData = True",
+        "BinaryDataByteOrderMSB = False",
+        "CompressedData = True",
+        f"CompressedDataSize = {len(data)}",
+        # MetaImage lists the direction of each axis in turn
+        "TransformMatrix = "
+        + " ".join(f"{x:.17g}" for x in np.transpose(direction).flat),
+        "Offset = " + " ".join(f"{x:.17g}" for x in origin),
+        "CenterOfRotation = " + " ".join(["0"] * num_dims),
+        "ElementSpacing = " + " ".join(f"{x:.17g}" for x in spacing),
+        "DimSize = " + " ".join(str(x) for x in array.shape[:num_dims][::-1]),
+    ]
+    if array.ndim > num_dims:
+        header.append(f"ElementNumberOfChannels = {array.shape[-1]}")
+    header += [
+        f"ElementType = {_METAIMAGE_ELEMENT_TYPES[str(array.dtype)]}",
+        "ElementDataFile = LOCAL",
+    ]
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "wb") as file:
+        file.write(("\n".join(header) + "\n").encode())
+        file.write(data)
+    os.replace(tmp_file, filename)
+
+
+class background_image_writer:
+    """Compresses and writes images on a worker thread.
+
+    write() copies the image buffer, so the pipeline may change or free
+    the image at once, and queues the copy.  While the queued copies
+    would exceed max_queued_bytes, write() waits for earlier writes to
+    finish.  flush() waits for every queued write and reports any that
+    failed.
+
+    ".mha" files are written by a zlib-based MetaImage writer that lets
+    the pipeline run during the write.  Other files, and pixel types the
+    MetaImage writer does not handle, are written by itk.imwrite on the
+    worker thread.
+    """
+
+    def __init__(
+        self, max_queued_bytes: int = 1024**3, compression_level: int = 1
+    ):
+        """
+        Args:
+            max_queued_bytes (int, optional): The most memory held by
+                queued images. A single larger image is still queued,
+                alone. Defaults to 1 GB.
+            compression_level (int, optional): The zlib compression
+                level of ".mha" files, from 1 (fastest) to 9 (smallest).
+                Defaults to 1.
+        """
+        self.max_queued_bytes = max_queued_bytes
+        self.compression_level = compression_level
+        self._queued_bytes = 0
+        self._condition = threading.Condition()
+        self._executor = None
+        self._futures = []
+
+    def __getstate__(self):
+        # A copy sent to a worker process starts with an empty queue
+        return {
+            "max_queued_bytes": self.max_queued_bytes,
+            "compression_level": self.compression_level,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def write(self, img, filename: str):
+        """Queues an image to be written.
+
+        Args:
+            img (itk.Image): The image.  Its buffer is copied.
+            filename (str): The file to write.
+        """
+        array = itk.array_from_image(img)
+        spacing = list(img.GetSpacing())
+        origin = list(img.GetOrigin())
+        direction = itk.array_from_matrix(img.GetDirection())
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._queued_bytes == 0
+                or self._queued_bytes + array.nbytes <= self.max_queued_bytes
+            )
+            self._queued_bytes += array.nbytes
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        self._futures.append(
+            (
+                filename,
+                self._executor.submit(
+                    self._write, filename, array, spacing, origin, direction
+                ),
+            )
+        )
+
+    def _write(self, filename, array, spacing, origin, direction):
+        try:
+            if (
+                filename.endswith(".mha")
+                and str(array.dtype) in _METAIMAGE_ELEMENT_TYPES
+            ):
+                _write_metaimage(
+                    filename,
+                    array,
+                    spacing,
+                    origin,
+                    direction,
+                    self.compression_level,
+                )
+            else:
+                img = itk.image_view_from_array(
+                    array, is_vector=array.ndim > len(spacing)
+                )
+                img.SetSpacing(spacing)
+                img.SetOrigin(origin)
+                img.SetDirection(itk.matrix_from_array(direction))
+                itk.imwrite(img, filename, compression=True)
+        finally:
+            with self._condition:
+                self._queued_bytes -= array.nbytes
+                self._condition.notify_all()
+
+    def flush(self):
+        """Waits for every queued image to be written.
+
+        Returns:
+            bool: True if every write succeeded.
+        """
+        futures, self._futures = self._futures, []
+        success = True
+        for filename, future in futures:
+            error = future.exception()
+            if error is not None:
+                print(f"ERROR: Could not write {filename}: {error}")
+                success = False
+        return success
@@ -1,9 +1,376 @@
+import itertools
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import itk
 import numpy as np
 from itk import TubeTK as tube
 
+from pipeline_utils import (
+    background_image_writer,
+    get_image_hash,
+    pipeline_checkpoint,
+    profile_stage,
+    stage_profiler,
+)
+from tube_utils import (
+    convert_group_arrays_to_group,
+    get_group_arrays,
+    merge_tube_groups,
+)
+
+# The image from which this worker extracts training vessels, set by
+#   _init_training_worker
+_training_image = None
+
+
+def _init_training_worker(image, num_threads):
+    """Set this worker's image and the number of threads ITK uses."""
+    global _training_image
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(num_threads)
+    _training_image = image
+
+
+def _extract_training_vessels(seeds, image=None):
+    """
+    Extract a training vessel from each seed using one SegmentTubes.
+
+    Args:
+        seeds: list of (seed number, physical point) pairs.  The seed
+            number is used as the id of its vessel.
+        image: the normalized image.  Defaults to this worker's image.
+
+    Returns:
+        A uint8 array that is 1 inside the extracted vessels.
+    """
+    if image is None:
+        image = _training_image
+    vSeg = tube.SegmentTubes.New(Input=image)
+    vSeg.SetVerbose(True)
+    vSeg.SetMinRoundness(0.1)
+    vSeg.SetMinRidgeness(0.8)
+    vSeg.SetMinCurvature(0.000001)
+    # MinCurvature is the most influential variable
+    vSeg.SetRadiusInObjectSpace(1.5)
+    vSeg.SetMinLength(300)
+    for seed_num, point in seeds:
+        print("     Seed", seed_num, flush=True)
+        vSeg.ExtractTubeInObjectSpace(point, seed_num)
+    mask = itk.array_view_from_image(vSeg.GetTubeMaskImage())
+    return (mask != 0).astype(np.uint8)
+
+
+def _group_seeds(points, separation):
+    """
+    Group the seeds so that seeds in different groups are more than
+    separation apart.
+
+    Args:
+        points: (n, 3) array of the seeds' physical points.
+        separation: the distance below which seeds share a group.
+
+    Returns:
+        A list of lists of seed numbers, ordered by their first seed.
+    """
+    points = np.asarray(points)
+    near = (
+        np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+        <= separation
+    )
+    # Spread the smallest seed number through each cluster of near seeds
+    labels = np.arange(len(points))
+    while True:
+        new_labels = np.where(near, labels[None, :], len(points)).min(axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    return [
+        np.flatnonzero(labels == label).tolist() for label in np.unique(labels)
+    ]
+
+
+def _get_voxels_at_or_above(array, threshold, slab_size=16):
+    """Return the flat indices of the voxels >= threshold, in order."""
+    slab_voxels = array[0].size
+    indices = [
+        np.flatnonzero(array[z : z + slab_size] >= threshold)
+        + z * slab_voxels
+        for z in range(0, array.shape[0], slab_size)
+    ]
+    return np.concatenate(indices)
+
+
+def _get_masked_mean_and_stddev(values, mask, slab_size=16):
+    """
+    Return the mean and standard deviation of the values where the mask
+    is nonzero.
+
+    The statistics of each slab of the volume are computed in float64
+    and merged as in Welford's algorithm, so only one slab's masked
+    values are held at a time.
+    """
+    count = 0
+    mean = 0.0
+    sum_sq_diff = 0.0
+    for z in range(0, values.shape[0], slab_size):
+        slab = values[z : z + slab_size][mask[z : z + slab_size] != 0]
+        if slab.size == 0:
+            continue
+        slab = slab.astype(np.float64)
+        slab_mean = slab.mean()
+        slab_sum_sq_diff = np.square(slab - slab_mean).sum()
+        delta = slab_mean - mean
+        total = count + slab.size
+        mean += delta * slab.size / total
+        sum_sq_diff += slab_sum_sq_diff + delta**2 * count * slab.size / total
+        count = total
+    if count == 0:
+        return 0.0, 0.0
+    return mean, np.sqrt(sum_sq_diff / count)
+
+
+def _select_seeds(array, num_seeds, seed_coverage, num_bins=4096):
+    """
+    Select the brightest voxels that are not near a brighter selection.
+
+    Equivalent to repeatedly taking the argmax of the array and masking
+    the seed_coverage neighborhood around it, without modifying the
+    array.  The voxels are ranked once, by value and then by index, and
+    only those above a threshold chosen from a histogram are ranked, so
+    the cost barely depends on num_seeds.  The threshold is lowered if
+    too few seeds are found above it.
+
+    Args:
+        array: the image array.
+        num_seeds: the maximum number of seeds to select.
+        seed_coverage: voxels within this many indices of a seed along
+            every axis cannot also be seeds.
+
+    Returns:
+        An (n, 3) array of the seeds' indices into the array, brightest
+        first.  n is less than num_seeds only if the array is exhausted.
+    """
+    counts, edges = np.histogram(array, bins=num_bins)
+    # counts_above[i] is the number of voxels >= edges[i]
+    counts_above = np.cumsum(counts[::-1])[::-1]
+
+    num_candidates = 64 * num_seeds
+    while True:
+        bin_num = np.searchsorted(-counts_above, -num_candidates, "right")
+        bin_num = max(bin_num - 1, 0)
+        candidates = _get_voxels_at_or_above(array, edges[bin_num])
+        values = array.reshape(-1)[candidates]
+        candidates = candidates[np.argsort(-values, kind="stable")]
+        # To find the candidates in a seed's neighborhood by flat index
+        flat_order = np.argsort(candidates)
+        flat_candidates = candidates[flat_order]
+
+        # Greedy non-maximum suppression in order of decreasing value
+        seeds = []
+        available = np.ones(len(candidates), dtype=bool)
+        next_num = 0
+        while len(seeds) < num_seeds and next_num < len(candidates):
+            next_num += np.argmax(available[next_num:])
+            if not available[next_num]:
+                break
+            seeds.append(candidates[next_num])
+            seed = np.unravel_index(candidates[next_num], array.shape)
+            neighborhood = np.ravel_multi_index(
+                np.ix_(
+                    *(
+                        np.arange(
+                            max(x - seed_coverage, 0),
+                            min(x + seed_coverage, size),
+                        )
+                        for x, size in zip(seed, array.shape)
+                    )
+                ),
+                array.shape,
+            ).reshape(-1)
+            found = np.minimum(
+                np.searchsorted(flat_candidates, neighborhood),
+                len(flat_candidates) - 1,
+            )
+            found = found[flat_candidates[found] == neighborhood]
+            available[flat_order[found]] = False
+            next_num += 1
+
+        if len(seeds) == num_seeds or bin_num == 0:
+            seeds = np.unravel_index(np.array(seeds, dtype=int), array.shape)
+            return np.stack(seeds, axis=1)
+        num_candidates = 2 * counts_above[bin_num] + 1
+
+
+def _segment_vessels(
+    input_image, seeds_image, seeds_radius_image, min_vessel_length, num_seeds
+):
+    """
+    Extract the vessels from the seeds of a seed mask.
+
+    Returns:
+        The SegmentTubes filter, after ProcessSeeds.
+    """
+    vSeg = tube.SegmentTubes.New(Input=input_image)
+    vSeg.SetVerbose(True)
+    vSeg.SetMinCurvature(0.001)
+    vSeg.SetMinRoundness(0.1)
+    vSeg.SetMinRidgeness(0.1)
+    vSeg.SetMinLevelness(0.001)
+    vSeg.SetMinLength(min_vessel_length)
+    # vSeg.SetRadiusInObjectSpace( 1.5 )
+    vSeg.SetBorderInIndexSpace(3)
+    vSeg.SetSeedMask(seeds_image)
+    vSeg.SetSeedRadiusMask(seeds_radius_image)
+    vSeg.SetOptimizeRadius(True)
+    vSeg.SetSeedMaskMaximumNumberOfPoints(num_seeds)
+    vSeg.SetUseSeedMaskAsProbabilities(True)
+    vSeg.SetSeedExtractionMinimumProbability(0.1)
+    vSeg.ProcessSeeds()
+    return vSeg
+
+
+def _get_tiles(size, tile_size, overlap):
+    """
+    Split an image into tiles whose cores partition it.
+
+    Args:
+        size: the image size, in ITK index order.
+        tile_size: the edge length of the tile cores, in voxels.
+        overlap: the voxels each tile extends past its core.
+
+    Returns:
+        A list of (lower, upper, core_lower, core_upper) index arrays.
+            Upper bounds are exclusive.
+    """
+    size = np.asarray(size)
+    tiles = []
+    for core_lower in itertools.product(
+        *(range(0, dim, tile_size) for dim in size)
+    ):
+        core_lower = np.array(core_lower)
+        core_upper = np.minimum(core_lower + tile_size, size)
+        lower = np.maximum(core_lower - overlap, 0)
+        upper = np.minimum(core_upper + overlap, size)
+        tiles.append((lower, upper, core_lower, core_upper))
+    return tiles
+
+
+def _crop_image(img, lower, upper):
+    """Return the part of an image from index lower up to upper."""
+    region = itk.ImageRegion[3]()
+    region.SetIndex([int(x) for x in lower])
+    region.SetSize([int(x) for x in np.subtract(upper, lower)])
+    crop = itk.RegionOfInterestImageFilter.New(Input=img)
+    crop.SetRegionOfInterest(region)
+    crop.Update()
+    return crop.GetOutput()
+
+
+# The input, seeds, and seeds radius images from which this worker
+#   extracts vessels, set by _init_extraction_worker
+_extraction_images = None
+
+
+def _init_extraction_worker(images, num_threads):
+    """Set this worker's images and the number of threads ITK uses."""
+    global _extraction_images
+    if num_threads is not None:
+        itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(num_threads)
+    _extraction_images = images
+
+
+def _extract_vessels_in_tile(tile, min_vessel_length, num_seeds):
+    """
+    Extract the vessels from the seeds in the core of a tile.
+
+    The vessels are traced into the tile's overlap, but not beyond it.
+
+    Returns:
+        The header and arrays of get_group_arrays for the vessels.
+    """
+    lower, upper, core_lower, core_upper = tile
+    input_image, seeds_image, seeds_radius_image = (
+        _crop_image(img, lower, upper) for img in _extraction_images
+    )
+    seeds = itk.array_view_from_image(seeds_image)
+    core = tuple(
+        slice(x0 - x, x1 - x)
+        for x, x0, x1 in zip(lower[::-1], core_lower[::-1], core_upper[::-1])
+    )
+    core_seeds = seeds[core].copy()
+    seeds[...] = 0
+    seeds[core] = core_seeds
+
+    vSeg = _segment_vessels(
+        input_image,
+        seeds_image,
+        seeds_radius_image,
+        min_vessel_length,
+        num_seeds,
+    )
+    return get_group_arrays(vSeg.GetTubeGroup())
+
+
+# The segmenter with which this worker runs the scales of run_scales, set
+#   by _init_scale_worker
+_scale_segmenter = None
+
+# The parameters and images of a segmenter that the stages run by
+#   _runScale read, and that are sent to the workers of run_scales
+_SCALE_WORKER_ATTRIBUTES = (
+    "intensity_z_score_range",
+    "num_seeds",
+    "min_vessel_length",
+    "extraction_tile_size",
+    "extraction_tile_overlap",
+    "vessels_enhancement_scales",
+    "spacing",
+    "data_im",
+    "data_mask",
+    "data_mask_erode",
+    "training_mask_image",
+)
+
+
+def _init_scale_worker(settings, num_threads):
+    """
+    Build this worker's segmenter and set the number of threads ITK uses.
+
+    Args:
+        settings: the constructor arguments, attributes, and profiling
+            flag of the segmenter, from _getScaleWorkerSettings.  They
+            are picklable, so workers may be spawned as well as forked.
+        num_threads: number of threads ITK uses in this worker.
+    """
+    global _scale_segmenter
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(num_threads)
+    segmenter = segment_vessels_brain_mra(**settings["kwargs"])
+    for name, value in settings["attributes"].items():
+        setattr(segmenter, name, value)
+    segmenter.data_array = itk.array_view_from_image(segmenter.data_im)
+    # Records are returned by _run_scale, not written by the worker
+    if settings["profile"]:
+        segmenter.profiler = stage_profiler()
+    _scale_segmenter = segmenter
+
+
+def _run_scale(vessels_scale, training_key, input_keys, alter_image):
+    """
+    Run one scale of run_scales with this worker's segmenter.
+
+    Returns:
+        The header and arrays of get_group_arrays for the vessels, and
+        the records of the stages run, if the segmenter has a profiler.
+    """
+    profiler = _scale_segmenter.profiler
+    num_records = len(profiler.records) if profiler is not None else 0
+    arrays = _scale_segmenter._runScale(
+        vessels_scale, training_key, input_keys, alter_image
+    )
+    _scale_segmenter.image_writer.flush()
+    records = profiler.records[num_records:] if profiler is not None else []
+    return arrays, records
+
 
 class segment_vessels_brain_mra:
     """
@@ -12,9 +379,55 @@ class segment_vessels_brain_mra:
     brain.
     """
 
-    def __init__(self, debug=False, debug_output_base_name="./Debug/out"):
+    def __init__(
+        self,
+        debug=False,
+        debug_output_base_name="./Debug/out",
+        debug_max_queued_bytes=1024**3,
+        checkpoint_dir=None,
+        num_workers=1,
+        extraction_mode="full",
+        profile_file=None,
+        profile_callback=None,
+    ):
+        """
+        Args:
+            debug: save intermediate results using debug_output_base_name.
+            debug_output_base_name: prefix of the intermediate results.
+            debug_max_queued_bytes: the intermediate results are
+                compressed and written by a background thread, while
+                processing continues.  At most this many bytes of them
+                are held in memory, waiting to be written.  run() waits
+                for them all to be written before returning.
+            checkpoint_dir: directory in which the outputs of each stage
+                of run() are saved.  Stages whose input images and
+                parameters are unchanged are then reloaded rather than
+                rerun.  None disables checkpointing.
+            num_workers: number of processes that extract the training
+                vessels, each from its own group of seeds, or the vessels
+                of the tiles of the "tiled" extraction_mode.
+            extraction_mode: "full" extracts the vessels from the whole
+                image at once.  "tiled" extracts them from overlapping
+                tiles of extraction_tile_size voxels, extended by
+                extraction_tile_overlap, and merges the tubes found in
+                more than one tile.
+            profile_file: JSON file to which the wall time, CPU time,
+                peak memory, voxel throughput, and ITK thread count of
+                each stage method are written as it completes.
+            profile_callback: called with the record of each stage
+                method as it completes.  Stages are only profiled if
+                profile_file or profile_callback is given.
+        """
         self.debug = debug
+        self.profiler = None
+        if profile_file is not None or profile_callback is not None:
+            self.profiler = stage_profiler(profile_file, profile_callback)
+        self.num_workers = num_workers
+        self.extraction_mode = extraction_mode
+        self.extraction_tile_size = 128
+        self.extraction_tile_overlap = 32
         self.debug_output_base_name = debug_output_base_name
+        self.image_writer = background_image_writer(debug_max_queued_bytes)
         dname = os.path.dirname(self.debug_output_base_name)
         if not os.path.exists(dname):
             os.makedirs(dname)
@@ -24,6 +437,9 @@ class segment_vessels_brain_mra:
         self.intensity_z_score_range = 10
 
         self.num_training_seeds = 50
+        # With num_workers > 1, seeds within this distance of each other
+        #   have their training vessels extracted by the same worker.
+        self.training_seed_separation = 30
         self.num_seeds = 1000
         self.min_vessel_length = 500
 
@@ -45,6 +461,15 @@ class segment_vessels_brain_mra:
         self.data_vessels_im = itk.Image[itk.F, 3].New()
         self.data_vessels_group = itk.GroupSpatialObject[3].New()
 
+        # Hashes of the images used as checkpoint inputs, by id, so that
+        #   each image is hashed once however many stages it keys.
+        self._image_keys = {}
+
+        self.checkpoint = None
+        if checkpoint_dir is not None:
+            self.checkpoint = pipeline_checkpoint(checkpoint_dir, debug)
+
+    @profile_stage
     def set_input_image(self, data_im):
         """
         Provide the volumetic image to be processed.
@@ -55,7 +480,8 @@ class segment_vessels_brain_mra:
         print("initializing image", flush=True)
 
         self.data_im = data_im
-        self.data_array = itk.GetArrayFromImage(self.data_im)
+        self._image_keys = {}
+        self.data_array = itk.array_view_from_image(self.data_im)
 
         imMath = tube.ImageMath.New(self.data_im)
         imMath.Threshold(1, 99999, 1, 0)
@@ -67,15 +493,19 @@ class segment_vessels_brain_mra:
 
         if self.debug:
             print("Saving mask image", flush=True)
-            itk.imwrite(
+            self.image_writer.write(
                 self.data_mask_erode,
                 self.debug_output_base_name + "-DataMaskErode.mha",
             )
 
+    @profile_stage
     def normalize_image(self, vessels_scale: float = -1):
         """
         Use image statistics to rescale the image to 0 to 100.
 
+        The blurred image is normalized in place, as float32, and becomes
+        data_norm_im.  data_norm_array is a view of its buffer.
+
         Args:
             vessels_scale: scale factor for default range of vessels
                 to be extracted.  Default = 1.0. Scale of 0.25 will
@@ -89,43 +519,24 @@ class segment_vessels_brain_mra:
         imMath = tube.ImageMath.New(self.data_im)
         imMath.Blur(self.spacing * self.vessels_scale)
         imMath.ReplaceValuesOutsideMaskRange(self.data_mask, 1, 1, 0)
-        imBlur = imMath.GetOutput()
-
-        data_norm = itk.GetArrayFromImage(imBlur)
-        data_norm_nz_indx = np.nonzero(self.data_array)
-        data_norm_nz = data_norm[data_norm_nz_indx]
-        self.data_mean = np.mean(data_norm_nz)
-        self.data_stddev = np.std(data_norm_nz)
+        self.data_norm_im = imMath.GetOutput()
+        self.data_norm_im.CopyInformation(self.data_im)
+        self.data_norm_array = itk.array_view_from_image(self.data_norm_im)
 
-        print("data stats =", self.data_mean, self.data_stddev, flush=True)
-        data_norm = np.where(
-            data_norm > 0,
-            (
-                (
-                    (data_norm - self.data_mean)
-                    / (self.data_stddev * (1.5 * self.intensity_z_score_range))
-                )
-                + 0.5
-            )
-            / 2.0,
-            0,
+        self.data_mean, self.data_stddev = _get_masked_mean_and_stddev(
+            self.data_norm_array, self.data_array
         )
-        data_norm = np.where(data_norm > 1, 1.0, data_norm)
-        data_norm = np.where(data_norm < 0, 0.0, data_norm)
-        self.data_norm_min = data_norm.min()
-        self.data_norm_max = data_norm.max()
+        print("data stats =", self.data_mean, self.data_stddev, flush=True)
+
+        self._normalizeArray(self.data_norm_array, zero_nonpositive=True)
+        self.data_norm_min = float(self.data_norm_array.min())
+        self.data_norm_max = float(self.data_norm_array.max())
         print("data =", self.data_norm_min, self.data_norm_max, flush=True)
-        self.data_norm_array = (
-            (data_norm - self.data_norm_min)
-            / (self.data_norm_max - self.data_norm_min)
-            * 100
-        )
-        self.data_norm_im = itk.GetImageFromArray(self.data_norm_array)
-        self.data_norm_im.CopyInformation(self.data_im)
+        self._rescaleArray(self.data_norm_array)
 
         if self.debug:
             print("Saving normalized image", flush=True)
-            itk.imwrite(
+            self.image_writer.write(
                 self.data_norm_im,
                 self.debug_output_base_name
                 + "_VS"
@@ -133,6 +544,35 @@ class segment_vessels_brain_mra:
                 + "-Normalized.mha",
             )
 
+    def _normalizeArray(self, data_norm, zero_nonpositive, slab_size=16):
+        """
+        Internal member function that maps blurred intensities, in place,
+            to 0 to 1 using the statistics of the input image.
+
+        Args:
+            data_norm: float32 array of blurred intensities
+            zero_nonpositive: map intensities <= 0 to 0
+        """
+        scale = 1 / (2 * self.data_stddev * 1.5 * self.intensity_z_score_range)
+        for z in range(0, data_norm.shape[0], slab_size):
+            slab = data_norm[z : z + slab_size]
+            if zero_nonpositive:
+                positive = slab > 0
+            slab -= self.data_mean
+            slab *= scale
+            slab += 0.25
+            if zero_nonpositive:
+                slab *= positive
+            np.clip(slab, 0, 1, out=slab)
+
+    def _rescaleArray(self, data_norm):
+        """
+        Internal member function that maps, in place, data_norm_min to
+            data_norm_max to 0 to 100.
+        """
+        data_norm -= self.data_norm_min
+        data_norm *= 100 / (self.data_norm_max - self.data_norm_min)
+
     def _normalize_second_image(self, data_im2):
         """
         Internal member function to applying consistent statistics (from
@@ -144,96 +584,101 @@ class segment_vessels_brain_mra:
         """
         imMath = tube.ImageMath.New(data_im2)
         imMath.Blur(self.spacing * self.vessels_scale)
-        imBlur = imMath.GetOutput()
-
-        data_norm2 = itk.GetArrayFromImage(imBlur)
-        data_norm2 = (
-            (
-                (data_norm2 - self.data_mean)
-                / (self.data_stddev * (1.5 * self.intensity_z_score_range))
-            )
-            + 0.5
-        ) / 2.0
-
-        data_norm2 = np.where(data_norm2 > 1, 1.0, data_norm2)
-        data_norm2 = np.where(data_norm2 < 0, 0.0, data_norm2)
-
-        data_norm2_array = (
-            (data_norm2 - self.data_norm_min)
-            / (self.data_norm_max - self.data_norm_min)
-            * 100
-        )
-
-        data_norm2_im = itk.GetImageFromArray(data_norm2_array)
+        data_norm2_im = imMath.GetOutput()
         data_norm2_im.CopyInformation(self.data_im)
 
-        itk.imwrite(
-            data_norm2_im,
-            self.debug_output_base_name
-            + "-alter_VS"
-            + str(self.vessels_scale)
-            + "-Normalized.mha",
-        )
+        data_norm2_array = itk.array_view_from_image(data_norm2_im)
+        self._normalizeArray(data_norm2_array, zero_nonpositive=False)
+        self._rescaleArray(data_norm2_array)
+
+        if self.debug:
+            self.image_writer.write(
+                data_norm2_im,
+                self.debug_output_base_name
+                + "-alter_VS"
+                + str(self.vessels_scale)
+                + "-Normalized.mha",
+            )
 
         return data_norm2_im
 
+    @profile_stage
     def identify_training_seeds(self, num_training_seeds=0):
+        """
+        Select the brightest voxels, at least seed_coverage voxels apart,
+        as the seeds of the training vessels.
+
+        Args:
+            num_training_seeds: number of seeds.  Defaults to the
+                num_training_seeds attribute.
+        """
         print("Identifying training seeds", flush=True)
 
         if num_training_seeds != 0:
             self.num_training_seeds = num_training_seeds
         seed_coverage = 10
-        data_min = self.data_norm_array.min()
-        self.training_seed_coord = np.zeros([self.num_training_seeds, 3])
-        for i in range(self.num_training_seeds):
-            self.training_seed_coord[i] = np.unravel_index(
-                np.argmax(self.data_norm_array, axis=None),
-                self.data_norm_array.shape,
-            )
-            indx = [
-                int(self.training_seed_coord[i][0]),
-                int(self.training_seed_coord[i][1]),
-                int(self.training_seed_coord[i][2]),
-            ]
-            minX = max(indx[0] - seed_coverage, 0)
-            maxX = min(indx[0] + seed_coverage, self.data_norm_array.shape[0])
-            minY = max(indx[1] - seed_coverage, 0)
-            maxY = min(indx[1] + seed_coverage, self.data_norm_array.shape[1])
-            minZ = max(indx[2] - seed_coverage, 0)
-            maxZ = min(indx[2] + seed_coverage, self.data_norm_array.shape[2])
-            self.data_norm_array[minX:maxX, minY:maxY, minZ:maxZ] = data_min
-            indx.reverse()
-            self.training_seed_coord[:][
+        seed_indices = _select_seeds(
+            self.data_norm_array, self.num_training_seeds, seed_coverage
+        )
+        self.training_seed_coord = np.zeros([len(seed_indices), 3])
+        for i, indx in enumerate(seed_indices):
+            self.training_seed_coord[
                 i
-            ] = self.data_norm_im.TransformIndexToPhysicalPoint(indx)
+            ] = self.data_norm_im.TransformIndexToPhysicalPoint(
+                [int(x) for x in indx[::-1]]
+            )
             print(
-                self.training_seed_coord[:][i],
+                self.training_seed_coord[i],
                 ":",
-                np.max(self.data_norm_array, axis=None),
+                self.data_norm_array[tuple(indx)],
             )
 
+    @profile_stage
     def generate_training_mask_image(self):
         print("Generating training mask", flush=True)
 
         # Manually extract a few vessels to form an
         #     image-specific training set
         print("   - Extracting training vessels", flush=True)
-        vSeg = tube.SegmentTubes.New(Input=self.data_norm_im)
-        vSeg.SetVerbose(True)
-        vSeg.SetMinRoundness(0.1)
-        vSeg.SetMinRidgeness(0.8)
-        vSeg.SetMinCurvature(0.000001)
-        # MinCurvature is the most influential variable
-        vSeg.SetRadiusInObjectSpace(1.5)
-        vSeg.SetMinLength(300)
-        for i in range(self.num_training_seeds):
-            print("     Seed", i, "of", self.num_training_seeds, flush=True)
-            vSeg.ExtractTubeInObjectSpace(self.training_seed_coord[i], i)
-        imMath = tube.ImageMath.New(vSeg.GetTubeMaskImage())
-        imMath.Threshold(0, 0, 0, 1)
-        vessels_mask_image = imMath.GetOutput()
+        seeds = list(enumerate(self.training_seed_coord))
+        groups = [list(range(len(seeds)))]
+        if self.num_workers > 1:
+            groups = _group_seeds(
+                self.training_seed_coord, self.training_seed_separation
+            )
+        num_workers = min(self.num_workers, len(groups))
+        if num_workers <= 1:
+            vessels_mask = _extract_training_vessels(seeds, self.data_norm_im)
+        else:
+            # Groups are far apart, so each gets its own extractor.  The
+            #   union of their masks does not depend on the order in
+            #   which they finish, or on num_workers.
+            print(f"   - Using {len(groups)} seed groups", flush=True)
+            # Workers may be forked, so no write may be in progress
+            self.image_writer.flush()
+            num_threads = max(
+                1,
+                itk.MultiThreaderBase.GetGlobalDefaultNumberOfThreads()
+                // num_workers,
+            )
+            with ProcessPoolExecutor(
+                num_workers,
+                initializer=_init_training_worker,
+                initargs=(self.data_norm_im, num_threads),
+            ) as pool:
+                group_masks = pool.map(
+                    _extract_training_vessels,
+                    [[seeds[i] for i in group] for group in groups],
+                )
+                vessels_mask = next(group_masks)
+                for group_mask in group_masks:
+                    vessels_mask |= group_mask
+        vessels_mask_image = itk.GetImageFromArray(
+            vessels_mask.astype(np.float32)
+        )
+        vessels_mask_image.CopyInformation(self.data_norm_im)
         if self.debug:
-            itk.imwrite(
+            self.image_writer.write(
                 vessels_mask_image,
                 self.debug_output_base_name
                 + "_VS"
@@ -252,11 +697,11 @@ class segment_vessels_brain_mra:
         trMask.Update()
         tmpIm = trMask.GetOutput()
         tmpIm.CopyInformation(self.data_im)
-        imMath.SetInput(tmpIm)
+        imMath = tube.ImageMath.New(tmpIm)
         imMath.ReplaceValuesOutsideMaskRange(self.data_mask_erode, 1, 1, 0)
         self.training_mask_image = imMath.GetOutput()
         if self.debug:
-            itk.imwrite(
+            self.image_writer.write(
                 self.training_mask_image,
                 self.debug_output_base_name
                 + "_VS"
@@ -264,6 +709,7 @@ class segment_vessels_brain_mra:
                 + "-VesselsTrainingMask.mha",
             )
 
+    @profile_stage
     def enhance_vessels(self):
         print("Enhancing vessels (This takes several minutes)", flush=True)
         ImageType = itk.Image[itk.F, 3]
@@ -306,7 +752,7 @@ class segment_vessels_brain_mra:
         imMath.ReplaceValuesOutsideMaskRange(self.data_mask, 1, 1, 0)
         self.data_vessels_enhanced_im = imMath.GetOutput()
         if self.debug:
-            itk.imwrite(
+            self.image_writer.write(
                 self.data_vessels_enhanced_im,
                 self.debug_output_base_name
                 + "_VS"
@@ -314,6 +760,7 @@ class segment_vessels_brain_mra:
                 + "-VesselsEnhanced.mha",
             )
 
+    @profile_stage
     def extract_vessels(self, alter_image=None):
         print("Extract vessels (This takes several minutes)", flush=True)
 
@@ -327,7 +774,14 @@ class segment_vessels_brain_mra:
         imMath.Threshold(0.0000000001, 10000, 1, 0)
         imMath.ReplaceValuesOutsideMaskRange(self.data_mask_erode, 1, 1, 0)
         imVessMask = imMath.GetOutputShort()
-        itk.imwrite(imVessMask, "imVessMask.mha")
+        if self.debug:
+            self.image_writer.write(
+                imVessMask,
+                self.debug_output_base_name
+                + "_VS"
+                + str(self.vessels_scale)
+                + "-VesselMask.mha",
+            )
 
         ccSeg = tube.SegmentConnectedComponents.New(imVessMask)
         ccSeg.SetMinimumVolume(50)
@@ -337,7 +791,7 @@ class segment_vessels_brain_mra:
         imMathSS.Threshold(1, 9999999, 1, 0)
         imVessMask = imMathSS.GetOutput()
         if self.debug:
-            itk.imwrite(
+            self.image_writer.write(
                 imVessMask,
                 self.debug_output_base_name
                 + "_VS"
@@ -363,7 +817,7 @@ class segment_vessels_brain_mra:
         imSeedsRadius = distFilter.GetOutput(0)
 
         if self.debug:
-            itk.imwrite(
+            self.image_writer.write(
                 imSeedsRadius,
                 self.debug_output_base_name
                 + "_VS"
@@ -381,7 +835,7 @@ class segment_vessels_brain_mra:
         )
         imSeeds = imMath.GetOutput()
         if self.debug:
-            itk.imwrite(
+            self.image_writer.write(
                 imSeeds,
                 self.debug_output_base_name
                 + "_VS"
@@ -390,7 +844,7 @@ class segment_vessels_brain_mra:
             )
 
         if self.debug:
-            itk.imwrite(
+            self.image_writer.write(
                 input_image,
                 self.debug_output_base_name
                 + "_VS"
@@ -399,27 +853,35 @@ class segment_vessels_brain_mra:
             )
 
         print("   - Extracting vessels", flush=True)
-        vSeg = tube.SegmentTubes.New(Input=input_image)
-        vSeg.SetVerbose(True)
-        vSeg.SetMinCurvature(0.001)
-        vSeg.SetMinRoundness(0.1)
-        vSeg.SetMinRidgeness(0.1)
-        vSeg.SetMinLevelness(0.001)
-        vSeg.SetMinLength(self.min_vessel_length)
-        # vSeg.SetRadiusInObjectSpace( 1.5 )
-        vSeg.SetBorderInIndexSpace(3)
-        vSeg.SetSeedMask(imSeeds)
-        vSeg.SetSeedRadiusMask(imSeedsRadius)
-        vSeg.SetOptimizeRadius(True)
-        vSeg.SetSeedMaskMaximumNumberOfPoints(self.num_seeds)
-        vSeg.SetUseSeedMaskAsProbabilities(True)
-        vSeg.SetSeedExtractionMinimumProbability(0.1)
-        vSeg.ProcessSeeds()
-        self.data_vessels_im = vSeg.GetTubeMaskImage()
+        if self.extraction_mode == "tiled":
+            vessels_group = self._extractVesselsInTiles(
+                input_image, imSeeds, imSeedsRadius
+            )
+            tubesToImage = tube.ConvertTubesToImage[
+                itk.Image[itk.F, 3]
+            ].New()
+            tubesToImage.SetTemplateImage(input_image)
+            tubesToImage.SetInput(vessels_group)
+            tubesToImage.SetUseRadius(True)
+            tubesToImage.Update()
+            self.data_vessels_im = tubesToImage.GetOutput()
+        elif self.extraction_mode == "full":
+            vSeg = _segment_vessels(
+                input_image,
+                imSeeds,
+                imSeedsRadius,
+                self.min_vessel_length,
+                self.num_seeds,
+            )
+            vessels_group = vSeg.GetTubeGroup()
+            self.data_vessels_im = vSeg.GetTubeMaskImage()
+        else:
+            print(f"ERROR: Unknown extraction mode {self.extraction_mode}")
+            return
 
         if self.debug:
             print("   - Saving results", flush=True)
-            itk.imwrite(
+            self.image_writer.write(
                 self.data_vessels_im,
                 self.debug_output_base_name
                 + "_VS"
@@ -428,7 +890,7 @@ class segment_vessels_brain_mra:
             )
 
         TubeMath = tube.TubeMath[3, itk.F].New()
-        TubeMath.SetInputTubeGroup(vSeg.GetTubeGroup())
+        TubeMath.SetInputTubeGroup(vessels_group)
         TubeMath.SetUseAllTubes()
         TubeMath.SmoothTube(4, "SMOOTH_TUBE_USING_INDEX_GAUSSIAN")
         TubeMath.SmoothTubeProperty(
@@ -448,9 +910,306 @@ class segment_vessels_brain_mra:
             )
             SOWriter.Update()
 
+    def _extractVesselsInTiles(self, input_image, seeds_image, radius_image):
+        """
+        Extract the vessels from overlapping tiles and merge them.
+
+        The num_seeds seeds are shared among the tiles in proportion to
+        the seed voxels in their cores.  Tiles are merged in order, by
+        merge_tube_groups, so the result does not depend on num_workers.
+        A vessel that crosses tiles is cut at their borders, so the
+        tiles keep short vessels, and min_vessel_length is applied to
+        the points traced for each vessel once its pieces are stitched
+        together.
+
+        Returns:
+            The group of merged vessels.
+        """
+        seeds = itk.array_view_from_image(seeds_image)
+        num_seed_voxels = max(np.count_nonzero(seeds), 1)
+        # A vessel cut by a tile border spans at least the overlap past
+        #   the core, at more than two points per voxel, so the tiles
+        #   only drop vessels shorter than any cut piece.
+        tile_min_vessel_length = min(
+            self.min_vessel_length, 2 * self.extraction_tile_overlap
+        )
+        jobs = []
+        for tile in _get_tiles(
+            input_image.GetLargestPossibleRegion().GetSize(),
+            self.extraction_tile_size,
+            self.extraction_tile_overlap,
+        ):
+            _, _, core_lower, core_upper = tile
+            core = tuple(
+                slice(x0, x1) for x0, x1 in zip(core_lower, core_upper)
+            )[::-1]
+            num_tile_voxels = np.count_nonzero(seeds[core])
+            if num_tile_voxels > 0:
+                num_tile_seeds = np.ceil(
+                    self.num_seeds * num_tile_voxels / num_seed_voxels
+                )
+                jobs.append(
+                    (tile, tile_min_vessel_length, int(num_tile_seeds))
+                )
+        print(f"   - Using {len(jobs)} tiles", flush=True)
+        if len(jobs) == 0:
+            return itk.GroupSpatialObject[3].New()
+
+        images = (input_image, seeds_image, radius_image)
+        num_workers = min(self.num_workers, len(jobs))
+        if num_workers <= 1:
+            _init_extraction_worker(images, None)
+            try:
+                tile_arrays = [_extract_vessels_in_tile(*job) for job in jobs]
+            finally:
+                _init_extraction_worker(None, None)
+        else:
+            # Workers may be forked, so no write may be in progress
+            self.image_writer.flush()
+            num_threads = max(
+                1,
+                itk.MultiThreaderBase.GetGlobalDefaultNumberOfThreads()
+                // num_workers,
+            )
+            with ProcessPoolExecutor(
+                num_workers,
+                initializer=_init_extraction_worker,
+                initargs=(images, num_threads),
+            ) as pool:
+                tile_arrays = list(
+                    pool.map(_extract_vessels_in_tile, *zip(*jobs))
+                )
+        return merge_tube_groups(
+            [
+                convert_group_arrays_to_group(header, arrays)
+                for header, arrays in tile_arrays
+            ],
+            min_tube_points=self.min_vessel_length,
+        )
+
+    def _getNumVoxels(self):
+        """Return the number of voxels of the input image, for profiling."""
+        return int(np.prod(self.data_im.GetLargestPossibleRegion().GetSize()))
+
+    def _runStage(self, stage, inputs, params, method, outputs):
+        """Run a stage of run(), or reload it from its checkpoint."""
+        if self.checkpoint is None:
+            method()
+            return None
+        return self.checkpoint.run_stage(
+            self, stage, inputs, params, method, outputs
+        )
+
+    def _runNormalizeStage(self, vessels_scale, input_keys):
+        """Run the normalize_image stage of run() and run_scales()."""
+        key = self._runStage(
+            "normalize_image",
+            input_keys,
+            {
+                "vessels_scale": vessels_scale,
+                "intensity_z_score_range": self.intensity_z_score_range,
+            },
+            lambda: self.normalize_image(vessels_scale=vessels_scale),
+            [
+                "vessels_scale",
+                "data_mean",
+                "data_stddev",
+                "data_norm_min",
+                "data_norm_max",
+                "data_norm_im",
+            ],
+        )
+        self.data_norm_array = itk.array_view_from_image(self.data_norm_im)
+        return key
+
+    def _runTrainingStages(self, vessels_scale, input_keys):
+        """
+        Run the stages of run() that produce the training mask image.
+
+        Returns:
+            The keys of the normalize_image stage and of the last stage,
+            or None without checkpointing.
+        """
+        normalize_key = self._runNormalizeStage(vessels_scale, input_keys)
+        key = self._runStage(
+            "identify_training_seeds",
+            [normalize_key],
+            {"num_training_seeds": self.num_training_seeds},
+            self.identify_training_seeds,
+            ["training_seed_coord"],
+        )
+        key = self._runStage(
+            "generate_training_mask_image",
+            [key],
+            {
+                "parallel": self.num_workers > 1,
+                "training_seed_separation": self.training_seed_separation,
+            },
+            self.generate_training_mask_image,
+            ["training_mask_image"],
+        )
+        return normalize_key, key
+
+    def _runScaleStages(self, training_key, normalize_key, alter_image):
+        """
+        Run the stages of run() that follow the training mask image,
+            at the scale of the current normalized image.
+        """
+        key = self._runStage(
+            "enhance_vessels",
+            [training_key, normalize_key],
+            {"vessels_enhancement_scales": self.vessels_enhancement_scales},
+            self.enhance_vessels,
+            ["data_vessels_enhanced_im"],
+        )
+        alter_keys = []
+        if self.checkpoint is not None and alter_image is not None:
+            alter_keys = [self._getImageKey(alter_image)]
+        self._runStage(
+            "extract_vessels",
+            [key] + alter_keys,
+            {
+                "num_seeds": self.num_seeds,
+                "min_vessel_length": self.min_vessel_length,
+                "extraction_mode": self.extraction_mode,
+                "extraction_tile_size": self.extraction_tile_size,
+                "extraction_tile_overlap": self.extraction_tile_overlap,
+                "vessels_enhancement_scales": self.vessels_enhancement_scales,
+            },
+            lambda: self.extract_vessels(alter_image=alter_image),
+            ["data_vessels_im", "data_vessels_group"],
+        )
+
+    def _getInputKeys(self):
+        """Return the stage inputs of the input image, for checkpoints."""
+        if self.checkpoint is None:
+            return []
+        return [self._getImageKey(self.data_im)]
+
+    def _getImageKey(self, img):
+        """Return the hash of an image, computing it once per image."""
+        entry = self._image_keys.get(id(img))
+        if entry is None or entry[0] is not img:
+            entry = (img, get_image_hash(img))
+            self._image_keys[id(img)] = entry
+        return entry[1]
+
+    @profile_stage
     def run(self, vessels_scale=1.5, alter_image=None):
-        self.normalize_image(vessels_scale=vessels_scale)
-        self.identify_training_seeds()
-        self.generate_training_mask_image()
-        self.enhance_vessels()
-        self.extract_vessels(alter_image=alter_image)
+        if vessels_scale <= 0:
+            vessels_scale = self.vessels_scale
+
+        normalize_key, training_key = self._runTrainingStages(
+            vessels_scale, self._getInputKeys()
+        )
+        self._runScaleStages(training_key, normalize_key, alter_image)
+        self.image_writer.flush()
+
+    @profile_stage
+    def run_scales(
+        self, vessels_scales, training_vessels_scale=None, alter_image=None
+    ):
+        """
+        Extract the vessels at several vessels_scale values and merge them.
+
+        The training seeds and training mask image are computed once, at
+        training_vessels_scale, and shared by every scale: the training
+        vessels are traced with a fixed radius, so the mask only marks
+        where vessels and background are.  The vessels are then enhanced
+        and extracted at each scale, in num_workers processes, and the
+        tubes of all scales are merged by merge_tube_groups, so a vessel
+        found at several scales appears once in data_vessels_group.
+
+        Args:
+            vessels_scales: list of the vessels_scale values, as in run().
+            training_vessels_scale: vessels_scale of the image from which
+                the training vessels are extracted.  Defaults to the
+                first of vessels_scales.
+            alter_image: image from which the vessels are extracted
+                instead of the input image, as in run().
+        """
+        if training_vessels_scale is None:
+            training_vessels_scale = vessels_scales[0]
+        input_keys = self._getInputKeys()
+        _, training_key = self._runTrainingStages(
+            training_vessels_scale, input_keys
+        )
+
+        num_workers = min(self.num_workers, len(vessels_scales))
+        jobs = [
+            (vessels_scale, training_key, input_keys, alter_image)
+            for vessels_scale in vessels_scales
+        ]
+        if num_workers <= 1:
+            scale_arrays = [self._runScale(*job) for job in jobs]
+        else:
+            # Workers may be forked, so no write may be in progress
+            self.image_writer.flush()
+            num_threads = max(
+                1,
+                itk.MultiThreaderBase.GetGlobalDefaultNumberOfThreads()
+                // num_workers,
+            )
+            with ProcessPoolExecutor(
+                num_workers,
+                initializer=_init_scale_worker,
+                initargs=(self._getScaleWorkerSettings(), num_threads),
+            ) as pool:
+                scale_results = list(pool.map(_run_scale, *zip(*jobs)))
+            scale_arrays = [arrays for arrays, _ in scale_results]
+            if self.profiler is not None:
+                for _, records in scale_results:
+                    for record in records:
+                        if record["parent"] is None:
+                            record["parent"] = "run_scales"
+                        self.profiler.add_record(record)
+
+        print("Merging the vessels of all scales", flush=True)
+        self.data_vessels_group = merge_tube_groups(
+            [
+                convert_group_arrays_to_group(header, arrays)
+                for header, arrays in scale_arrays
+            ]
+        )
+        tubesToImage = tube.ConvertTubesToImage[itk.Image[itk.F, 3]].New()
+        tubesToImage.SetTemplateImage(self.data_im)
+        tubesToImage.SetInput(self.data_vessels_group)
+        tubesToImage.SetUseRadius(True)
+        tubesToImage.Update()
+        self.data_vessels_im = tubesToImage.GetOutput()
+        self.image_writer.flush()
+
+    def _getScaleWorkerSettings(self):
+        """
+        Internal member function that returns what the workers of
+            run_scales need to rebuild this segmenter.
+        """
+        checkpoint_dir = None
+        if self.checkpoint is not None:
+            checkpoint_dir = self.checkpoint.checkpoint_dir
+        return {
+            "kwargs": {
+                "debug": self.debug,
+                "debug_output_base_name": self.debug_output_base_name,
+                "debug_max_queued_bytes": self.image_writer.max_queued_bytes,
+                "checkpoint_dir": checkpoint_dir,
+                "extraction_mode": self.extraction_mode,
+            },
+            "attributes": {
+                name: getattr(self, name) for name in _SCALE_WORKER_ATTRIBUTES
+            },
+            "profile": self.profiler is not None,
+        }
+
+    def _runScale(self, vessels_scale, training_key, input_keys, alter_image):
+        """
+        Internal member function that enhances and extracts the vessels
+            at one scale of run_scales.
+
+        Returns:
+            The header and arrays of get_group_arrays for the vessels.
+        """
+        print(f"Extracting vessels at scale {vessels_scale}", flush=True)
+        normalize_key = self._runNormalizeStage(vessels_scale, input_keys)
+        self._runScaleStages(training_key, normalize_key, alter_image)
+        return get_group_arrays(self.data_vessels_group)
@@ -13,23 +13,367 @@ The atlas cases should be in the pytubetk/data directory.  See that
 directory for download info.
 """
 
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
 
 import itk
+import numpy as np
 from itk import TubeTK as tube
 
+from pipeline_utils import (
+    background_image_writer,
+    get_image_hash,
+    pipeline_checkpoint,
+    profile_stage,
+    stage_profiler,
+)
+
+# Preloaded cohort images shared by all strip_skull instances in this
+#   process, keyed as in _get_cohort_key.  Only the most recently used
+#   _COHORT_CACHE_SIZE cohorts are kept, as each holds three images per
+#   cohort member.
+_COHORT_CACHE_SIZE = 2
+_cohort_cache = OrderedDict()
+_cohort_cache_lock = threading.Lock()
+
+
+def _get_cohort_key(data_dir, cohort_list, cohort_blur):
+    """
+    Return a key that changes if any cohort file or the blur changes.
+
+    Returns:
+        A hex digest of the cohort file paths, their modification times
+        and sizes, and cohort_blur.
+    """
+    files = []
+    for names in cohort_list:
+        for name in names:
+            filename = os.path.abspath(os.path.join(data_dir, name))
+            stat = os.stat(filename)
+            files.append([filename, stat.st_mtime_ns, stat.st_size])
+    description = json.dumps([files, cohort_blur])
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def _write_cohort_images(cache_dir, images):
+    """
+    Write cohort images as .npy files and their geometry as JSON.
+
+    The files are written to a temporary directory that is then renamed,
+    so that concurrent readers never see a partly written cache.
+    """
+    os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_dir))
+    geometry = []
+    for i, img in enumerate(images):
+        np.save(
+            os.path.join(tmp_dir, f"{i}.npy"), itk.array_view_from_image(img)
+        )
+        geometry.append(
+            {
+                "Spacing": list(img.GetSpacing()),
+                "Origin": list(img.GetOrigin()),
+                "Direction": itk.array_from_matrix(
+                    img.GetDirection()
+                ).tolist(),
+            }
+        )
+    with open(os.path.join(tmp_dir, "images.json"), "w") as geometry_file:
+        json.dump(geometry, geometry_file)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # Another process wrote the same cache first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _read_cohort_images(cache_dir):
+    """
+    Memory-map the images written by _write_cohort_images.
+
+    The maps are copy-on-write, so filters that modify their input can
+    not change the files.
+    """
+    with open(os.path.join(cache_dir, "images.json")) as geometry_file:
+        geometry = json.load(geometry_file)
+    images = []
+    for i, img_geometry in enumerate(geometry):
+        array = np.load(os.path.join(cache_dir, f"{i}.npy"), mmap_mode="c")
+        img = itk.GetImageViewFromArray(array)
+        img.SetSpacing(img_geometry["Spacing"])
+        img.SetOrigin(img_geometry["Origin"])
+        img.SetDirection(
+            itk.matrix_from_array(np.array(img_geometry["Direction"]))
+        )
+        images.append(img)
+    return images
+
+
+def _set_number_of_threads(num_threads):
+    """Set the number of threads ITK filters use in this process."""
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(num_threads)
+
+
+def get_image_pyramid(img, shrink_factors):
+    """
+    Return Gaussian-smoothed, downsampled copies of an image.
+
+    Each level is smoothed with a Gaussian of half its voxel spacing
+    before shrinking, to avoid aliasing.
+
+    Args:
+        img: the image to downsample.
+        shrink_factors: one shrink factor per level, e.g., [4, 2].
+
+    Returns:
+        A list of (shrink_factor, image) pairs, in the order of
+        shrink_factors.
+    """
+    pyramid = []
+    for factor in shrink_factors:
+        sigma = [0.5 * factor * spacing for spacing in img.GetSpacing()]
+        smooth = itk.SmoothingRecursiveGaussianImageFilter.New(
+            Input=img, SigmaArray=sigma
+        )
+        shrink = itk.ShrinkImageFilter.New(
+            Input=smooth.GetOutput(), ShrinkFactors=[factor] * 3
+        )
+        shrink.Update()
+        pyramid.append((factor, shrink.GetOutput()))
+    return pyramid
+
+
+def _register_images(
+    fixed_image,
+    moving_image,
+    resample_images,
+    settings,
+    fixed_pyramid=(),
+    refine_iterations=50,
+):
+    """
+    Register moving_image to fixed_image and resample images with it.
+
+    A module-level function so that it can run in a process pool.
+
+    If fixed_pyramid is given, the registration is first run on each of
+    its levels, coarse to fine, with the moving image downsampled to
+    match.  Each level starts from the transform of the one before, and
+    the full resolution registration then only refines the result for
+    refine_iterations iterations.
+
+    Args:
+        fixed_image: the image registered to.
+        moving_image: the image registered.
+        resample_images: images to resample using the registration, or
+            None to return the final moving image.
+        settings: (name, value) pairs, each applied by calling
+            Set<name>(value) on the tube.RegisterImages filter.
+        fixed_pyramid: (shrink_factor, image) pairs from
+            get_image_pyramid(fixed_image, ...).
+        refine_iterations: the rigid and affine iterations run at full
+            resolution after a pyramid.
+
+    Returns:
+        The list of resampled images, in the order of resample_images,
+        and the final value of the registration metric.
+    """
+    transform = None
+    for factor, fixed_level in fixed_pyramid:
+        ((_, moving_level),) = get_image_pyramid(moving_image, [factor])
+        # Levels have fewer voxels, so a larger portion is sampled
+        level_settings = [
+            (name, min(1.0, value * factor))
+            if name.endswith("SamplingRatio")
+            else (name, value)
+            for name, value in settings
+        ]
+        if transform is not None:
+            level_settings.append(("InitialMethodEnum", "INIT_WITH_NONE"))
+        imReg = _run_registration(
+            fixed_level, moving_level, level_settings, transform
+        )
+        transform = imReg.GetCurrentMatrixTransform()
+
+    if transform is not None:
+        settings = list(settings) + [
+            ("InitialMethodEnum", "INIT_WITH_NONE"),
+            ("RigidMaxIterations", refine_iterations),
+            ("AffineMaxIterations", refine_iterations),
+        ]
+    imReg = _run_registration(fixed_image, moving_image, settings, transform)
+    if resample_images is None:
+        images = [imReg.GetFinalMovingImage()]
+    else:
+        images = [
+            imReg.ResampleImage("LINEAR", img) for img in resample_images
+        ]
+    return images, imReg.GetFinalMetricValue()
+
+
+def fuse_cohort_masks(masks, weights=None, slab_size=16):
+    """
+    Return the (weighted) fraction of masks that mark each voxel as brain.
+
+    A voxel is brain in a mask if its value is outside [0, 1].  The
+    masks are read through array views, and the mean is accumulated slab
+    by slab into a single output image, so memory use does not grow with
+    the number of masks.
+
+    Args:
+        masks: registered brain mask images, all on the same grid.
+        weights: optional weight per mask, e.g., from the registration
+            metric.  Defaults to equal weights.
+        slab_size: number of slices processed at a time.
+
+    Returns:
+        A float image with the geometry of masks[0].
+    """
+    N = len(masks)
+    if weights is None or np.sum(weights) <= 0:
+        weights = np.ones(N)
+    weights = np.asarray(weights, dtype=np.float32) / np.sum(weights)
+
+    fused = itk.Image[itk.F, 3].New()
+    fused.CopyInformation(masks[0])
+    fused.SetRegions(masks[0].GetLargestPossibleRegion())
+    fused.Allocate()
+    fused_array = itk.array_view_from_image(fused)
+    fused_array.fill(0)
+
+    mask_arrays = [itk.array_view_from_image(mask) for mask in masks]
+    brain = np.empty((slab_size,) + fused_array.shape[1:], dtype=bool)
+    for start in range(0, fused_array.shape[0], slab_size):
+        stop = min(start + slab_size, fused_array.shape[0])
+        slab = fused_array[start:stop]
+        slab_brain = brain[: stop - start]
+        for weight, mask_array in zip(weights, mask_arrays):
+            mask_slab = mask_array[start:stop]
+            np.greater(mask_slab, 1, out=slab_brain)
+            slab_brain |= mask_slab < 0
+            slab += weight * slab_brain
+    return fused
+
+
+def _get_center_of_mass(img):
+    """Return the physical center of mass of an image's intensities."""
+    moments = itk.ImageMomentsCalculator[type(img)].New()
+    moments.SetImage(img)
+    moments.Compute()
+    return np.array(moments.GetCenterOfGravity())
+
+
+def _get_mutual_information(fixed_values, moving_values, num_bins=32):
+    """Return the mutual information of two equal-length value arrays."""
+    joint, _, _ = np.histogram2d(fixed_values, moving_values, bins=num_bins)
+    joint /= max(joint.sum(), 1)
+    marginals = np.outer(joint.sum(axis=1), joint.sum(axis=0))
+    nonzero = joint > 0
+    return float(
+        np.sum(joint[nonzero] * np.log(joint[nonzero] / marginals[nonzero]))
+    )
+
+
+def _run_registration(fixed_image, moving_image, settings, transform=None):
+    """
+    Create, configure, and update a tube.RegisterImages filter.
+
+    Args:
+        settings: (name, value) pairs, each applied by calling
+            Set<name>(value) on the filter.  Later pairs override
+            earlier ones.
+        transform: optional matrix transform to start from.
+    """
+    imReg = tube.RegisterImages[itk.Image[itk.F, 3]].New(
+        FixedImage=fixed_image, MovingImage=moving_image
+    )
+    imReg.SetReportProgress(True)
+    for name, value in settings:
+        getattr(imReg, "Set" + name)(value)
+    if transform is not None:
+        imReg.SetLoadedMatrixTransform(transform)
+    imReg.Update()
+    return imReg
+
 
 class strip_skull:
     """Generate an image containing only the interior of the skull."""
 
-    def __init__(self, data_dir="../data/MRI-Normals", debug=False):
+    def __init__(
+        self,
+        data_dir="../data/MRI-Normals",
+        debug=False,
+        debug_max_queued_bytes=1024**3,
+        num_workers=1,
+        executor="thread",
+        atlas_cache_dir=None,
+        registration_mode="full",
+        checkpoint_dir=None,
+        profile_file=None,
+        profile_callback=None,
+    ):
         """
         Create an instance of the skull stripping method.
 
         args:
             debug - save intermediate results to a "Debug" directory.
+            debug_max_queued_bytes - memory limit of the intermediate
+                results queued for the background image writer.  run()
+                returns once they are all on disk.
+            num_workers - number of cohort registrations run at once.
+                ITK's threads are split evenly across the workers.
+            executor - "thread" or "process" to run the registrations in
+                a pool of that kind, or a concurrent.futures.Executor to
+                use as is.
+            atlas_cache_dir - directory in which the read and blurred
+                cohort images are kept between runs.  Relative paths are
+                relative to data_dir.  None, the default, keeps them only
+                in memory.
+            registration_mode - "full" registers at full resolution.
+                "pyramid" registers coarse to fine on the levels given by
+                pyramid_shrink_factors, then runs only
+                pyramid_refine_iterations at full resolution.
+            checkpoint_dir - directory in which the outputs of each stage
+                of run() are saved.  Stages whose input images and
+                parameters are unchanged are then reloaded rather than
+                rerun.  None disables checkpointing.
+            profile_file - JSON file to which the wall time, CPU time,
+                peak memory, voxel throughput, and ITK thread count of
+                each stage method are written as it completes.
+            profile_callback - called with the record of each stage
+                method as it completes.  Stages are only profiled if
+                profile_file or profile_callback is given.
         """
         self.debug = debug
+        self.image_writer = background_image_writer(debug_max_queued_bytes)
+
+        self.profiler = None
+        if profile_file is not None or profile_callback is not None:
+            self.profiler = stage_profiler(profile_file, profile_callback)
+
+        self.checkpoint = None
+        if checkpoint_dir is not None:
+            self.checkpoint = pipeline_checkpoint(checkpoint_dir, debug)
+
+        self.num_workers = num_workers
+        self.executor = executor
+        self.atlas_cache_dir = atlas_cache_dir
+        self.registration_mode = registration_mode
+        self.pyramid_shrink_factors = [4, 2]
+        self.pyramid_refine_iterations = 50
+        # A fixed seed makes the sampled metrics, and so the results,
+        #   the same from run to run and for any num_workers.
+        self.random_seed = 1
 
         self.ImageType = itk.Image[itk.F, 3]
         self.LabelMapType = itk.Image[itk.UC, 3]
@@ -50,12 +394,23 @@ class strip_skull:
             ["Normal071-FLASH.mha", "Normal071-FLASH-Brain.mha"],
         ]
         self.cohort_blur = 2
+        # Register only the cohort_top_k members most similar to the
+        #   input, as ranked by prescreen_cohort.  None registers all.
+        self.cohort_top_k = None
+        self.prescreen_shrink_factor = 8
+        self.cohort_selected = []
+        self.cohort_prescreen_scores = []
+        # "equal" averages the registered brain masks, "metric" weights
+        #   them by their registration's mutual information.
+        self.cohort_weighting = "equal"
         self.cohort_reg = []
+        self.cohort_reg_metric = []
         self.cohort_regB = []
 
         self.data_dir = data_dir
 
 
+    @profile_stage
     def set_input_images(self, images):
         """
         List of itk images (MRI) that combine to make skull stripping.
@@ -66,6 +421,7 @@ class strip_skull:
         self.brain_image = []
         self.anatomic_brain_image = []
 
+    @profile_stage
     def register_input_images(self, target_image_num=0):
         """
         Align the input images with the "target" input image.
@@ -82,28 +438,92 @@ class strip_skull:
         res.Update()
         self.input_images_reg = [res.GetOutput()]
 
-        for img_num in range(1, len(self.input_images)):
-            imReg = tube.RegisterImages[self.ImageType].New()
-            imReg.SetFixedImage(self.input_images_reg[0])
-            imReg.SetMovingImage(self.input_images[img_num])
-            imReg.SetReportProgress(True)
-            imReg.SetExpectedOffsetMagnitude(40)
-            imReg.SetExpectedRotationMagnitude(0.01)
-            imReg.SetExpectedScaleMagnitude(0.01)
-            imReg.SetRigidMaxIterations(500)
-            imReg.SetRigidSamplingRatio(0.1)
-            imReg.SetRegistration("RIGID")
-            imReg.SetMetric("MATTES_MI_METRIC")
-            imReg.Update()
-            self.input_images_reg.append(imReg.GetFinalMovingImage())
+        settings = [
+            ("ExpectedOffsetMagnitude", 40),
+            ("ExpectedRotationMagnitude", 0.01),
+            ("ExpectedScaleMagnitude", 0.01),
+            ("RigidMaxIterations", 500),
+            ("RigidSamplingRatio", 0.1),
+            ("Registration", "RIGID"),
+            ("Metric", "MATTES_MI_METRIC"),
+            ("RandomNumberSeed", self.random_seed),
+        ]
+        fixed_image = self.input_images_reg[0]
+        jobs = [
+            (fixed_image, self.input_images[img_num], None, settings)
+            for img_num in range(1, len(self.input_images))
+        ]
+        if len(jobs) > 0:
+            results = self._registerImages(jobs)
+            self.input_images_reg.extend(images[0] for images, _ in results)
+
+    @profile_stage
+    def load_cohort(self):
+        """
+        Return the cohort images, their brain masks, and blurred images.
+
+        Reading and blurring the cohort is done once per process and,
+        if atlas_cache_dir is set, once per machine: the results are
+        kept in memory, shared by all instances, for the most recently
+        used cohorts, and on disk as memory-mapped arrays.  Both are
+        keyed by the cohort files, their modification times, and
+        cohort_blur.
+
+        Returns:
+            Three lists of images, each in the order of cohort_list.
+        """
+        key = _get_cohort_key(
+            self.data_dir, self.cohort_list, self.cohort_blur
+        )
+        cache_dir = None
+        if self.atlas_cache_dir is not None:
+            cache_dir = os.path.join(self.data_dir, self.atlas_cache_dir, key)
+
+        with _cohort_cache_lock:
+            if key in _cohort_cache:
+                _cohort_cache.move_to_end(key)
+                return _cohort_cache[key]
+
+            if cache_dir is not None and os.path.exists(cache_dir):
+                if self.debug:
+                    print(f"*** Reading cohort from {cache_dir} ***")
+                images = _read_cohort_images(cache_dir)
+            else:
+                images = [
+                    itk.imread(os.path.join(self.data_dir, name), itk.F)
+                    for names in self.cohort_list
+                    for name in names
+                ]
+                for i in range(0, len(images), 2):
+                    imMath = tube.ImageMath.New(Input=images[i])
+                    imMath.Blur(self.cohort_blur)
+                    images.append(imMath.GetOutput())
+                if cache_dir is not None:
+                    try:
+                        _write_cohort_images(cache_dir, images)
+                    except OSError as error:
+                        print(f"ERROR: Cannot write atlas cache: {error}")
+
+            N = len(self.cohort_list)
+            cohort = (
+                images[0 : 2 * N : 2],
+                images[1 : 2 * N : 2],
+                images[2 * N :],
+            )
+            _cohort_cache[key] = cohort
+            while len(_cohort_cache) > _COHORT_CACHE_SIZE:
+                _cohort_cache.popitem(last=False)
+            return cohort
 
+    @profile_stage
     def register_cohort(self, anatomic_image_num=1):
         """
         Register the atlas (8 pre-segmented normals) to the input.
 
         The input "anatomic" image is used to register with the normals.
         The anatomic image should have the most anatomic detail,
-        to simplify registration.
+        to simplify registration.  If cohort_top_k is set, only that many
+        normals, chosen by prescreen_cohort, are registered.
 
         Args:
             anatomic_image_num: Defaults to image 1 (or 0 if only 1 input)
@@ -114,15 +534,7 @@ class strip_skull:
             return
 
         N = len(self.cohort_list)
-        cohort_base = []
-        cohort_baseB = []
-        for i in range(N):
-            name = os.path.join(self.data_dir, self.cohort_list[i][0])
-            nameB = os.path.join(self.data_dir, self.cohort_list[i][1])
-            cohort_baseTmp = itk.imread(name, itk.F)
-            cohort_baseBTmp = itk.imread(nameB, itk.F)
-            cohort_base.append(cohort_baseTmp)
-            cohort_baseB.append(cohort_baseBTmp)
+        cohort_base, cohort_baseB, cohort_baseBlur = self.load_cohort()
 
         if anatomic_image_num >= len(self.input_images_reg):
             anatomic_image_num = len(self.input_images_reg) - 1
@@ -132,32 +544,156 @@ class strip_skull:
         imMath.Blur(self.cohort_blur)
         input_blur = imMath.GetOutput()
 
-        self.cohort_reg = []
-        self.cohort_regB = []
-        for i in range(N):
-            imMath.SetInput(cohort_base[i])
-            imMath.Blur(self.cohort_blur)
-            cohort_baseBlur = imMath.GetOutput()
-            regBTo1 = tube.RegisterImages[self.ImageType].New(
-                FixedImage=input_blur, MovingImage=cohort_baseBlur
+        settings = [
+            ("ExpectedOffsetMagnitude", 40),
+            ("ExpectedRotationMagnitude", 0.01),
+            ("ExpectedScaleMagnitude", 0.1),
+            ("RigidMaxIterations", 500),
+            ("AffineMaxIterations", 500),
+            ("RigidSamplingRatio", 0.05),
+            ("AffineSamplingRatio", 0.05),
+            ("InitialMethodEnum", "INIT_WITH_IMAGE_CENTERS"),
+            ("Registration", "PIPELINE_AFFINE"),
+            ("Metric", "MATTES_MI_METRIC"),
+            ("RandomNumberSeed", self.random_seed),
+        ]
+        self.cohort_selected = list(range(N))
+        if self.cohort_top_k is not None and self.cohort_top_k < N:
+            self.cohort_selected = self.prescreen_cohort(
+                input_blur, cohort_baseBlur
+            )
+        jobs = []
+        for i in self.cohort_selected:
+            jobs.append(
+                (
+                    input_blur,
+                    cohort_baseBlur[i],
+                    [cohort_base[i], cohort_baseB[i]],
+                    settings,
+                )
+            )
+
+        results = self._registerImages(jobs)
+        self.cohort_reg = [images[0] for images, _ in results]
+        self.cohort_regB = [images[1] for images, _ in results]
+        self.cohort_reg_metric = [metric for _, metric in results]
+
+    @profile_stage
+    def prescreen_cohort(self, input_image, cohort_images):
+        """
+        Return the indices of the cohort images most similar to the input.
+
+        Each image is shrunk by prescreen_shrink_factor, its center of
+        mass is aligned with the input's, and the mutual information of
+        the overlapping voxels is computed.  This costs a fraction of a
+        registration, so large cohorts can be screened and only the
+        cohort_top_k most similar members registered.
+
+        Args:
+            input_image: the image the cohort will be registered to.
+            cohort_images: the cohort images, prepared as for
+                registration.
+
+        Returns:
+            The indices of the cohort_top_k highest scoring images, in
+            cohort order.  The scores of all images are kept in
+            cohort_prescreen_scores.
+        """
+        factor = self.prescreen_shrink_factor
+        ((_, fixed_level),) = get_image_pyramid(input_image, [factor])
+        fixed_center = _get_center_of_mass(fixed_level)
+        fixed_array = itk.array_view_from_image(fixed_level)
+
+        scores = []
+        for img in cohort_images:
+            ((_, moving_level),) = get_image_pyramid(img, [factor])
+            transform = itk.TranslationTransform[itk.D, 3].New()
+            transform.SetOffset(
+                (_get_center_of_mass(moving_level) - fixed_center).tolist()
             )
-            regBTo1.SetReportProgress(True)
-            regBTo1.SetExpectedOffsetMagnitude(40)
-            regBTo1.SetExpectedRotationMagnitude(0.01)
-            regBTo1.SetExpectedScaleMagnitude(0.1)
-            regBTo1.SetRigidMaxIterations(500)
-            regBTo1.SetAffineMaxIterations(500)
-            regBTo1.SetRigidSamplingRatio(0.05)
-            regBTo1.SetAffineSamplingRatio(0.05)
-            regBTo1.SetInitialMethodEnum("INIT_WITH_IMAGE_CENTERS")
-            regBTo1.SetRegistration("PIPELINE_AFFINE")
-            regBTo1.SetMetric("MATTES_MI_METRIC")
-            regBTo1.Update()
-            img = regBTo1.ResampleImage("LINEAR", cohort_base[i])
-            self.cohort_reg.append(img)
-            img = regBTo1.ResampleImage("LINEAR", cohort_baseB[i])
-            self.cohort_regB.append(img)
+            resample = itk.ResampleImageFilter.New(
+                Input=moving_level,
+                Transform=transform,
+                ReferenceImage=fixed_level,
+                UseReferenceImage=True,
+                DefaultPixelValue=np.nan,
+            )
+            resample.Update()
+            moving_array = itk.array_view_from_image(resample.GetOutput())
+            overlap = ~np.isnan(moving_array)
+            scores.append(
+                _get_mutual_information(
+                    fixed_array[overlap], moving_array[overlap]
+                )
+            )
+        self.cohort_prescreen_scores = scores
 
+        ranked = np.argsort(scores, kind="stable")[::-1]
+        selected = sorted(ranked[: self.cohort_top_k].tolist())
+        if self.debug:
+            print(f"*** Prescreen scores {np.round(scores, 3).tolist()} ***")
+            print(f"*** Registering cohort members {selected} ***")
+        return selected
+
+    def _registerImages(self, jobs):
+        """
+        Run _register_images on each job, using the configured executor.
+
+        Results are returned in the order of jobs, whatever the order in
+        which the registrations finish, so the output does not depend on
+        num_workers.
+
+        Args:
+            jobs: list of (fixed_image, moving_image, resample_images,
+                settings) tuples, as taken by _register_images.
+        """
+        if self.debug:
+            print(f"*** Registering {len(jobs)} images ***")
+        if self.registration_mode == "pyramid":
+            # Jobs that share a fixed image share its pyramid
+            pyramids = {}
+            for fixed_image, _, _, _ in jobs:
+                if id(fixed_image) not in pyramids:
+                    pyramids[id(fixed_image)] = get_image_pyramid(
+                        fixed_image, self.pyramid_shrink_factors
+                    )
+            jobs = [
+                job
+                + (pyramids[id(job[0])], self.pyramid_refine_iterations)
+                for job in jobs
+            ]
+        elif self.registration_mode != "full":
+            print(f"ERROR: Unknown registration mode {self.registration_mode}")
+            return []
+        if isinstance(self.executor, Executor):
+            return list(self.executor.map(_register_images, *zip(*jobs)))
+
+        num_workers = min(self.num_workers, len(jobs))
+        if num_workers <= 1:
+            return [_register_images(*job) for job in jobs]
+
+        num_threads = itk.MultiThreaderBase.GetGlobalDefaultNumberOfThreads()
+        worker_threads = max(1, num_threads // num_workers)
+        if self.executor == "process":
+            # Workers may be forked, so no write may be in progress
+            self.image_writer.flush()
+            with ProcessPoolExecutor(
+                num_workers,
+                initializer=_set_number_of_threads,
+                initargs=(worker_threads,),
+            ) as pool:
+                return list(pool.map(_register_images, *zip(*jobs)))
+
+        # Threads share ITK's global thread count, so it is lowered for
+        #   the duration of the pool.
+        _set_number_of_threads(worker_threads)
+        try:
+            with ThreadPoolExecutor(num_workers) as pool:
+                return list(pool.map(_register_images, *zip(*jobs)))
+        finally:
+            _set_number_of_threads(num_threads)
+
+    @profile_stage
     def refine_brain_registrations(self):
         """
         Refine the registrations using the brain-stripped atlas images.
@@ -166,36 +702,40 @@ class strip_skull:
         version of them to the input anatomic image - ideally improving
         registration.
         """
-        N = len(self.cohort_list)
+        settings = [
+            ("ExpectedOffsetMagnitude", 10),
+            ("ExpectedRotationMagnitude", 0.005),
+            ("ExpectedScaleMagnitude", 0.05),
+            ("RigidMaxIterations", 200),
+            ("AffineMaxIterations", 200),
+            ("RigidSamplingRatio", 0.05),
+            ("AffineSamplingRatio", 0.05),
+            ("InitialMethodEnum", "INIT_WITH_NONE"),
+            ("Registration", "PIPELINE_AFFINE"),
+            ("Metric", "MATTES_MI_METRIC"),
+            ("RandomNumberSeed", self.random_seed),
+        ]
+        N = len(self.cohort_reg)
+        jobs = []
         for i in range(N):
-            if self.debug:
-                print(f"*** Registration {i} ***")
             imMath = tube.ImageMath.New(Input=self.cohort_reg[i])
             imMath.ReplaceValuesOutsideMaskRange(self.cohort_regB[i], 1, 9999999, 0)
             cohort_brain_image = imMath.GetOutput()
-            regBTo1 = tube.RegisterImages[self.ImageType].New(
-                FixedImage=self.anatomic_brain_image,
-                MovingImage=cohort_brain_image,
-            )
-            regBTo1.SetReportProgress(True)
-            regBTo1.SetExpectedOffsetMagnitude(10)
-            regBTo1.SetExpectedRotationMagnitude(0.005)
-            regBTo1.SetExpectedScaleMagnitude(0.05)
-            regBTo1.SetRigidMaxIterations(200)
-            regBTo1.SetAffineMaxIterations(200)
-            regBTo1.SetRigidSamplingRatio(0.05)
-            regBTo1.SetAffineSamplingRatio(0.05)
-            regBTo1.SetInitialMethodEnum("INIT_WITH_NONE")
-            regBTo1.SetRegistration("PIPELINE_AFFINE")
-            regBTo1.SetMetric("MATTES_MI_METRIC")
-            regBTo1.Update()
-            self.cohort_reg[i] = regBTo1.ResampleImage(
-                "LINEAR", self.cohort_reg[i]
-            )
-            self.cohort_regB[i] = regBTo1.ResampleImage(
-                "LINEAR", self.cohort_regB[i]
+            jobs.append(
+                (
+                    self.anatomic_brain_image,
+                    cohort_brain_image,
+                    [self.cohort_reg[i], self.cohort_regB[i]],
+                    settings,
+                )
             )
 
+        results = self._registerImages(jobs)
+        self.cohort_reg = [images[0] for images, _ in results]
+        self.cohort_regB = [images[1] for images, _ in results]
+        self.cohort_reg_metric = [metric for _, metric in results]
+
+    @profile_stage
     def segment_brain_using_registered_cohort(
         self, target_image_num=0, anatomic_image_num=1
     ):
@@ -211,20 +751,11 @@ class strip_skull:
             target_image_num = len(self.input_images_reg)-1
         if anatomic_image_num >= len(self.input_images_reg):
             anatomic_image_num = len(self.input_images_reg)-1
-        self.cohort_regbrain = []
-        N = len(self.cohort_list)
-        for i in range(N):
-            imMath = tube.ImageMath.New(Input=self.cohort_regB[i])
-            imMath.Threshold(0, 1, 0, 1)
-            img = imMath.GetOutput()
-            if i == 0:
-                imMathSum = tube.ImageMath.New(img)
-                imMathSum.AddImages(img, 0, 1.0 / N)
-                self.cohort_regbrain = imMathSum.GetOutput()
-            else:
-                imMathSum = tube.ImageMath.New(self.cohort_regbrain)
-                imMathSum.AddImages(img, 1, 1.0 / N)
-                self.cohort_regbrain = imMathSum.GetOutput()
+        weights = None
+        if self.cohort_weighting == "metric":
+            # The MI metrics are negated, so that smaller is better
+            weights = np.maximum(-np.array(self.cohort_reg_metric), 0)
+        self.cohort_regbrain = fuse_cohort_masks(self.cohort_regB, weights)
 
         insideMath = tube.ImageMath.New(Input=self.cohort_regbrain)
         insideMath.Threshold(0.75, 1.0, 1, 0)
@@ -272,39 +803,135 @@ class strip_skull:
         brainMath.ReplaceValuesOutsideMaskRange(self.brain_mask, 1, 1, 0)
         self.anatomic_brain_image = brainMath.GetOutput()
 
+    def _getNumVoxels(self):
+        """Return the number of voxels of the input images, for profiling."""
+        return sum(
+            int(np.prod(img.GetLargestPossibleRegion().GetSize()))
+            for img in self.input_images
+        )
+
+    def _runStage(self, stage, inputs, params, method, outputs):
+        """Run a stage of run(), or reload it from its checkpoint."""
+        if self.checkpoint is None:
+            method()
+            return None
+        return self.checkpoint.run_stage(
+            self, stage, inputs, params, method, outputs
+        )
+
+    @profile_stage
     def run(self, target_image_num=0, anatomic_image_num=1, use_iterative_refinement=False):
         """
         Execute the workflow of this class.
 
+        If a checkpoint_dir was given, the stages that are up to date are
+        reloaded from it rather than rerun.
+
         Args:
             target_image_num: Image to be returned after skull stripping
             anatomic_image_num: Image to be used for atlas registrations
         """
+        registration_params = {
+            "registration_mode": self.registration_mode,
+            "pyramid_shrink_factors": self.pyramid_shrink_factors,
+            "pyramid_refine_iterations": self.pyramid_refine_iterations,
+            "random_seed": self.random_seed,
+        }
+        segment_outputs = [
+            "cohort_regbrain",
+            "brain_training_mask",
+            "brain_mask_raw",
+            "brain_mask",
+            "brain_image",
+            "anatomic_brain_image",
+        ]
+        cohort_outputs = [
+            "cohort_reg",
+            "cohort_regB",
+            "cohort_reg_metric",
+            "cohort_selected",
+            "cohort_prescreen_scores",
+        ]
+
+        input_keys = []
+        cohort_key = None
+        if self.checkpoint is not None:
+            input_keys = [get_image_hash(img) for img in self.input_images]
+            sample_file = os.path.join(self.data_dir, self.cohort_list[0][0])
+            if os.path.exists(sample_file):
+                cohort_key = _get_cohort_key(
+                    self.data_dir, self.cohort_list, self.cohort_blur
+                )
 
         if self.debug:
             print("*** Set input images ***")
-        self.register_input_images(target_image_num)
+        key = self._runStage(
+            "register_input_images",
+            input_keys,
+            dict(registration_params, target_image_num=target_image_num),
+            lambda: self.register_input_images(target_image_num),
+            ["input_images_reg"],
+        )
 
         if self.debug:
             print("*** Register cohort ***")
-        self.register_cohort(anatomic_image_num)
+        key = self._runStage(
+            "register_cohort",
+            [key, cohort_key],
+            dict(
+                registration_params,
+                anatomic_image_num=anatomic_image_num,
+                cohort_top_k=self.cohort_top_k,
+                prescreen_shrink_factor=self.prescreen_shrink_factor,
+            ),
+            lambda: self.register_cohort(anatomic_image_num),
+            cohort_outputs,
+        )
+
+        def _segmentBrain():
+            self.segment_brain_using_registered_cohort(
+                target_image_num, anatomic_image_num
+            )
+
+        segment_params = {
+            "target_image_num": target_image_num,
+            "anatomic_image_num": anatomic_image_num,
+            "cohort_weighting": self.cohort_weighting,
+        }
 
         if self.debug:
             print("*** Initial brain segmentation ***")
-        self.segment_brain_using_registered_cohort(
-            target_image_num, anatomic_image_num
+        key = self._runStage(
+            "segment_brain",
+            [key],
+            segment_params,
+            _segmentBrain,
+            segment_outputs,
         )
 
         if use_iterative_refinement:
             if self.debug:
-                itk.imwrite(self.anatomic_brain_image, "brain_initial_seg.mha")
+                self.image_writer.write(
+                    self.anatomic_brain_image, "brain_initial_seg.mha"
+                )
                 print("*** Refining registration ***") 
-            self.refine_brain_registrations()
+            key = self._runStage(
+                "refine_brain_registrations",
+                [key],
+                registration_params,
+                self.refine_brain_registrations,
+                cohort_outputs,
+            )
 
         if self.debug:
             print("*** Segment brain using registered cohort ***")
-        self.segment_brain_using_registered_cohort(
-            target_image_num, anatomic_image_num
+        self._runStage(
+            "segment_brain",
+            [key],
+            segment_params,
+            _segmentBrain,
+            segment_outputs,
         )
 
+        self.image_writer.flush()
         return self.brain_image, self.anatomic_brain_image, self.brain_mask
@@ -0,0 +1,199 @@
+"""
+Skull strip a batch of subjects.
+
+Runs strip_skull over a manifest of subjects in a single interpreter.
+The images of the next subjects are read in a background thread while
+the current ones are processed, and subjects are spread over a pool of
+workers that each create one strip_skull instance, and so load the
+atlas cohort only once.  The timing and outcome of every subject are
+written to a JSON results file as they complete.
+"""
+
+import json
+import os
+import time
+import traceback
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+import itk
+
+from strip_skull import strip_skull
+
+# The strip_skull instance of this worker, created by _init_worker
+_worker_stripper = None
+
+
+def _init_worker(strip_skull_args, num_threads):
+    """Create this worker's strip_skull instance and load its cohort."""
+    global _worker_stripper
+    if num_threads is not None:
+        itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(num_threads)
+    _worker_stripper = strip_skull(**strip_skull_args)
+    _worker_stripper.load_cohort()
+
+
+def _read_images(filenames):
+    """Read the images of a subject and return them and the time taken."""
+    start = time.perf_counter()
+    images = [itk.imread(filename, itk.F) for filename in filenames]
+    return images, time.perf_counter() - start
+
+
+def _strip_skull_subject(subject_id, images, output_dir, run_args):
+    """
+    Skull strip one subject in a worker and write its outputs.
+
+    Returns:
+        A dict of the output filenames and the run and write times.
+    """
+    start = time.perf_counter()
+    _worker_stripper.set_input_images(images)
+    outputs = _worker_stripper.run(**run_args)
+    run_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    filenames = []
+    for suffix, img in zip(("Brain", "AnatomicBrain", "BrainMask"), outputs):
+        filename = os.path.join(output_dir, f"{subject_id}-{suffix}.mha")
+        itk.imwrite(img, filename, compression=True)
+        filenames.append(filename)
+    return {
+        "outputs": filenames,
+        "run_time": run_time,
+        "write_time": time.perf_counter() - start,
+    }
+
+
+def get_subject_id(filenames):
+    """Return the name of a subject's first image, without extension."""
+    return os.path.splitext(os.path.basename(filenames[0]))[0]
+
+
+def strip_skull_batch(
+    manifest,
+    output_dir,
+    results_file=None,
+    num_workers=1,
+    run_args=None,
+    **strip_skull_args,
+):
+    """
+    Skull strip every subject of a manifest.
+
+    Args:
+        manifest: list of subjects, each a tuple of image filenames
+            passed to strip_skull.set_input_images.
+        output_dir: directory for the "<subject>-Brain.mha",
+            "<subject>-AnatomicBrain.mha", and "<subject>-BrainMask.mha"
+            outputs, where <subject> is from get_subject_id.
+        results_file: JSON file listing the status, timing, and any
+            error of each subject.  Rewritten as each subject completes.
+            Defaults to "results.json" in output_dir.
+        num_workers: number of subjects processed at once, each in its
+            own process.  ITK's threads are split evenly across them.
+        run_args: dict of arguments for strip_skull.run.
+        strip_skull_args: arguments for creating each strip_skull, e.g.,
+            data_dir.
+
+    Returns:
+        The list of per-subject results, in manifest order.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if results_file is None:
+        results_file = os.path.join(output_dir, "results.json")
+    if run_args is None:
+        run_args = {}
+
+    if num_workers > 1:
+        num_threads = max(
+            1,
+            itk.MultiThreaderBase.GetGlobalDefaultNumberOfThreads()
+            // num_workers,
+        )
+        pool = ProcessPoolExecutor(
+            num_workers,
+            initializer=_init_worker,
+            initargs=(strip_skull_args, num_threads),
+        )
+    else:
+        pool = ThreadPoolExecutor(
+            1, initializer=_init_worker, initargs=(strip_skull_args, None)
+        )
+    reader = ThreadPoolExecutor(1)
+
+    results = [
+        {
+            "subject": get_subject_id(filenames),
+            "images": list(filenames),
+            "status": "pending",
+        }
+        for filenames in manifest
+    ]
+
+    def _writeResults():
+        with open(results_file, "w") as file:
+            json.dump(results, file, indent=2)
+
+    def _fail(result, stage):
+        result["status"] = "failed"
+        result["error"] = f"{stage}: {traceback.format_exc()}"
+        print(f"ERROR: {result['subject']} failed during {stage}.")
+        _writeResults()
+
+    # Keep enough subjects read ahead that a worker never waits on I/O,
+    #   but no more, to bound memory.
+    unread = deque(range(len(manifest)))
+    reading = deque()
+    running = {}
+
+    def _readAhead():
+        while unread and len(reading) + len(running) <= num_workers:
+            subject_num = unread.popleft()
+            images_future = reader.submit(_read_images, manifest[subject_num])
+            reading.append((subject_num, images_future))
+
+    _readAhead()
+    while reading or running:
+        while reading and len(running) < num_workers:
+            subject_num, images_future = reading.popleft()
+            result = results[subject_num]
+            try:
+                images, result["read_time"] = images_future.result()
+            except Exception:
+                _fail(result, "read")
+                _readAhead()
+                continue
+            result["status"] = "running"
+            future = pool.submit(
+                _strip_skull_subject,
+                result["subject"],
+                images,
+                output_dir,
+                run_args,
+            )
+            running[future] = subject_num
+            _readAhead()
+
+        if not running:
+            continue
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = results[running.pop(future)]
+            try:
+                result.update(future.result())
+                result["status"] = "done"
+                _writeResults()
+            except Exception:
+                _fail(result, "run")
+        _readAhead()
+
+    reader.shutdown()
+    pool.shutdown()
+    _writeResults()
+    return results
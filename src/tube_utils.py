@@ -6,11 +6,53 @@ This module contains utility functions for working with tubes.
 Functions:
     get_children_as_list: Finds all children of a given type in a
         GroupSpatialObject and returns them as a list.
-    read_group: Reads a group from a file.
+    get_tube_point_arrays: Gathers the points of a list of tubes into
+        contiguous per-attribute NumPy arrays.
+    read_group: Reads a group, or only its tubes that match
+        predicates, from a file.
     write_group: Writes a group to a file.
+    write_group_arrays: Writes the tubes of a group as a directory of
+        contiguous per-attribute arrays.
+    read_group_arrays: Memory-maps the arrays written by
+        write_group_arrays.
+    get_group_arrays: Gathers the tubes of a group into the arrays of
+        write_group_arrays.
+    convert_group_arrays_to_group: Builds a group of tubes from the
+        arrays of read_group_arrays.
+    find_tubes_in_point_arrays: Finds the tubes that match an id set,
+        a bounding box, a minimum length, or a minimum radius.
+    merge_tube_groups: Merges groups of tubes extracted from overlapping
+        regions, dropping and stitching the parts found more than once.
+
+Classes:
+    tube_id_map: A persistent map from tube ids to tubes and their
+        positions in a list of tubes.
+    tube_point_index: A spatial index over the centerline points of tubes
+        for closest-point, radius, and bounding-box queries.
 """
 
+import json
+import os
+
 import itk
+import numpy as np
+
+TUBE_POINT_SCALAR_ATTRIBUTES = (
+    "Ridgeness",
+    "Medialness",
+    "Branchness",
+    "Curvature",
+    "Intensity",
+    "Roundness",
+    "Levelness",
+    "Alpha1",
+    "Alpha2",
+    "Alpha3",
+)
+
+TUBE_ARRAYS_EXTENSION = ".tubes"
+TUBE_ARRAYS_FORMAT = "pytubetk-tube-arrays"
+TUBE_ARRAYS_VERSION = 1
 
 
 def get_children_as_list(
@@ -53,28 +95,291 @@ def get_tube_index_in_list(
     return index
 
 
-def read_group(filename: str, dims: int = 3) -> itk.GroupSpatialObject:
-    """Reads a group from a file.
+def _get_point_values(points: list, getter) -> np.ndarray:
+    """Calls a scalar getter on every point and returns an array.
+
+    Mapping the unbound method over the list avoids a Python attribute
+    lookup per point.
+    """
+    return np.fromiter(
+        map(getter, points), dtype=np.float64, count=len(points)
+    )
+
+
+def _get_point_positions(points: list, getter) -> np.ndarray:
+    """Calls a position getter on every point and returns an N x 3 array.
+
+    Unpacking itk.Point values one element at a time is slow, so the
+    points are copied in C++ into a VectorContainer that is converted to
+    an array in bulk.
+    """
+    if len(points) == 0:
+        return np.zeros((0, 3))
+    PositionsType = itk.VectorContainer[itk.UL, itk.Point[itk.D, 3]]
+    positions = PositionsType.New()
+    stl_positions = positions.CastToSTLContainer()
+    stl_positions.swap(type(stl_positions)(list(map(getter, points))))
+    return itk.array_from_vector_container(positions).reshape(-1, 3)
+
+
+def _get_point_vectors(points: list, getter) -> np.ndarray:
+    """Calls a vector getter on every point and returns an N x 3 array.
+
+    Used for tangents and normals.  The STL container of a Vector
+    VectorContainer is not wrapped, so the vectors are set one at a time
+    into the container, which is still faster than unpacking them in
+    Python.
+    """
+    if len(points) == 0:
+        return np.zeros((0, 3))
+    vectors = itk.VectorContainer[itk.UL, itk.Vector[itk.D, 3]].New()
+    vectors.Reserve(len(points))
+    for _ in map(vectors.SetElement, range(len(points)), map(getter, points)):
+        pass
+    return itk.array_from_vector_container(vectors).reshape(-1, 3)
+
+
+def _set_point_values(points: list, setter, values: np.ndarray):
+    """Calls a setter on every point with the matching row of values.
+
+    The inverse of _get_point_values.  The rows are converted to Python
+    values at once, which is faster than indexing a (possibly
+    memory-mapped) array per point.
+    """
+    for _ in map(setter, points, values.tolist()):
+        pass
+
+
+def _get_transform_arrays(transform) -> tuple:
+    """Returns the matrix and offset of a transform as arrays."""
+    return (
+        itk.array_from_matrix(transform.GetMatrix()),
+        np.array(transform.GetOffset()),
+    )
+
+
+def _set_transform_arrays(transform, matrix, offset):
+    """Sets the matrix and offset of a transform from arrays."""
+    transform.SetMatrix(
+        itk.matrix_from_array(np.array(matrix, dtype=np.float64))
+    )
+    transform.SetOffset([float(x) for x in offset])
+
+
+def _get_object_to_world(tube: itk.TubeSpatialObject) -> tuple:
+    """Returns the matrix and offset of a tube's object-to-world transform."""
+    return _get_transform_arrays(tube.GetObjectToWorldTransform())
+
+
+def _gather_tube_points(tube_list: list) -> tuple:
+    """Returns the points of all tubes in one list.
+
+    Returns:
+        tuple: The points, their type, the tube ids, and the offsets of
+            the first point of each tube in the list of points.
+    """
+    num_tubes = len(tube_list)
+    tube_offsets = np.zeros(num_tubes + 1, dtype=np.int64)
+    tube_ids = np.zeros(num_tubes, dtype=np.int64)
+    points = []
+    for i, tube in enumerate(tube_list):
+        # Indexing creates the point proxies faster than iterating
+        tube_points = tube.GetPoints()
+        points.extend(map(tube_points.__getitem__, range(len(tube_points))))
+        tube_offsets[i + 1] = len(points)
+        tube_ids[i] = tube.GetId()
+
+    PointType = itk.TubeSpatialObjectPoint[3]
+    if len(points) > 0:
+        PointType = type(points[0])
+    return points, PointType, tube_ids, tube_offsets
+
+
+def get_tube_point_arrays(
+    tube_list: list, include_object_space: bool = False
+) -> dict:
+    """Gathers the points of a list of tubes into per-attribute arrays.
+
+    Each attribute of all points is read in one pass into a contiguous
+    column.  Points of tube i are the rows TubeOffsets[i] to
+    TubeOffsets[i+1] of every point array.
+
+    Args:
+        tube_list (list): The tubes to gather, e.g., from
+            get_children_as_list.  Tubes should be up to date.
+        include_object_space (bool, optional): Also gather the point
+            ids and the object-space values needed to rebuild the tubes.
+            Defaults to False.
+
+    Returns:
+        dict: "Position" (N x 3, world space), "Radius" (N, world space),
+            "Color" (N x 4), one (N,) array per name in
+            TUBE_POINT_SCALAR_ATTRIBUTES, "TubeId" (number of tubes) and
+            "TubeOffsets" (number of tubes + 1).  If include_object_space
+            is True, also "PointId", "PositionInObjectSpace",
+            "RadiusInObjectSpace", "TangentInObjectSpace",
+            "Normal1InObjectSpace", and "Normal2InObjectSpace".
+    """
+    points, PointType, tube_ids, tube_offsets = _gather_tube_points(
+        tube_list
+    )
+
+    # The world-space getters transform every point separately, so read
+    #   object-space values and apply each tube's transform to its rows.
+    object_position = _get_point_positions(
+        points, PointType.GetPositionInObjectSpace
+    )
+    object_radius = _get_point_values(points, PointType.GetRadiusInObjectSpace)
+    position = object_position.copy()
+    radius = object_radius.copy()
+    for i, tube in enumerate(tube_list):
+        matrix, offset = _get_object_to_world(tube)
+        rows = slice(tube_offsets[i], tube_offsets[i + 1])
+        position[rows] = position[rows] @ matrix.T + offset
+        # As TubeSpatialObjectPoint, the mean of the radius transformed
+        #   as a covariant vector
+        radius[rows] *= np.mean(np.linalg.inv(matrix).T.sum(axis=1))
+
+    point_arrays = {
+        "Position": position,
+        "Radius": radius,
+        "Color": np.column_stack(
+            [
+                _get_point_values(points, PointType.GetRed),
+                _get_point_values(points, PointType.GetGreen),
+                _get_point_values(points, PointType.GetBlue),
+                _get_point_values(points, PointType.GetAlpha),
+            ]
+        ).reshape(-1, 4),
+    }
+    for name in TUBE_POINT_SCALAR_ATTRIBUTES:
+        point_arrays[name] = _get_point_values(
+            points, getattr(PointType, "Get" + name)
+        )
+    point_arrays["TubeId"] = tube_ids
+    point_arrays["TubeOffsets"] = tube_offsets
+
+    if include_object_space:
+        point_arrays["PointId"] = np.fromiter(
+            map(PointType.GetId, points), dtype=np.int64, count=len(points)
+        )
+        point_arrays["PositionInObjectSpace"] = object_position
+        point_arrays["RadiusInObjectSpace"] = object_radius
+        for name in (
+            "TangentInObjectSpace",
+            "Normal1InObjectSpace",
+            "Normal2InObjectSpace",
+        ):
+            point_arrays[name] = _get_point_vectors(
+                points, getattr(PointType, "Get" + name)
+            )
+    return point_arrays
+
+
+def read_group(
+    filename: str,
+    dims: int = 3,
+    tube_ids=None,
+    bounds=None,
+    min_length: float = None,
+    min_radius: float = None,
+) -> itk.GroupSpatialObject:
+    """Reads a group, or the tubes of a group that match predicates.
+
+    Files ending in ".tubes" are read with read_group_arrays, and only
+    the tubes that match are built, so the time and memory used scale
+    with the result.  Any other file is read whole by ITK's
+    SpatialObjectReader, and the tubes that do not match are then
+    removed from the group read.
 
     Args:
         filename (str): The name of the file to read.
         dims (int, optional): The dimensionality of the group. Defaults to 3.
+        tube_ids, bounds, min_length, min_radius (optional): Keep only
+            the tubes that match, as in find_tubes_in_point_arrays.
+            Defaults to None, which keeps all tubes.
 
     Returns:
         itk.GroupSpatialObject: The group read from the file.
     """
+    predicates = {
+        "tube_ids": tube_ids,
+        "bounds": bounds,
+        "min_length": min_length,
+        "min_radius": min_radius,
+    }
+    is_filtered = any(value is not None for value in predicates.values())
+
+    if filename.endswith(TUBE_ARRAYS_EXTENSION):
+        if dims != 3:
+            print("ERROR: Tube arrays files only hold 3D groups.")
+            return None
+        header, arrays = read_group_arrays(filename)
+        if header is None:
+            return None
+        tube_indices = None
+        if is_filtered:
+            tube_indices = find_tubes_in_point_arrays(arrays, **predicates)
+        return convert_group_arrays_to_group(header, arrays, tube_indices)
+
     GroupFileReaderType = itk.SpatialObjectReader[dims]
 
     groupFileReader = GroupFileReaderType.New()
     groupFileReader.SetFileName(filename)
     groupFileReader.Update()
 
-    return groupFileReader.GetGroup()
+    group = groupFileReader.GetGroup()
+    if is_filtered:
+        if dims != 3:
+            print("ERROR: Tubes can only be filtered in 3D groups.")
+            return None
+        tube_list = get_children_as_list(group)
+        keep = np.zeros(len(tube_list), dtype=bool)
+        keep[
+            find_tubes_in_point_arrays(
+                get_tube_point_arrays(tube_list), **predicates
+            )
+        ] = True
+        _remove_tubes(tube_list, keep)
+        group.Update()
+    return group
+
+
+def _remove_tubes(tube_list: list, keep: np.ndarray):
+    """Removes the tubes not kept from their parents, in place.
+
+    The children of a removed tube are attached to its parent, with the
+    removed tube's object-to-parent transform folded into their own, so
+    their world-space geometry is unchanged.
+    """
+    for tube, is_kept in zip(tube_list, keep):
+        if is_kept:
+            continue
+        parent = tube.GetParent()
+        matrix, offset = _get_transform_arrays(
+            tube.GetObjectToParentTransform()
+        )
+        children = tube.GetChildren()
+        for child in [children[i] for i in range(len(children))]:
+            child_matrix, child_offset = _get_transform_arrays(
+                child.GetObjectToParentTransform()
+            )
+            _set_transform_arrays(
+                child.GetModifiableObjectToParentTransform(),
+                matrix @ child_matrix,
+                matrix @ child_offset + offset,
+            )
+            tube.RemoveChild(child)
+            parent.AddChild(child)
+        parent.RemoveChild(tube)
 
 
 def write_group(group: itk.GroupSpatialObject, filename: str):
     """Writes a group to a file.
 
+    Files ending in ".tubes" are written with write_group_arrays; any
+    other file is written by ITK's SpatialObjectWriter.
+
     Args:
         group (itk.GroupSpatialObject): The group to write.
         filename (str): The name of the file to write to.
@@ -82,6 +387,10 @@ def write_group(group: itk.GroupSpatialObject, filename: str):
     Returns:
         itk.GroupSpatialObject: The group read from the file.
     """
+    if filename.endswith(TUBE_ARRAYS_EXTENSION):
+        write_group_arrays(group, filename)
+        return
+
     dims = group.GetObjectDimension()
     GroupFileWriterType = itk.SpatialObjectWriter[dims]
 
@@ -89,3 +398,929 @@ def write_group(group: itk.GroupSpatialObject, filename: str):
     groupFileWriter.SetFileName(filename)
     groupFileWriter.SetInput(group)
     groupFileWriter.Update()
+
+
+def write_group_arrays(group: itk.GroupSpatialObject, dirname: str):
+    """Writes the tubes of a group as a directory of columnar arrays.
+
+    Every attribute of every point, and of every tube, is stored as one
+    contiguous .npy file, and a "header.json" file lists the columns and
+    holds the group's id, name, and transform.  The point columns are
+    those of get_tube_point_arrays with include_object_space set, so
+    the world-space columns can be visualized without rebuilding the
+    group.  Points of the i-th tube are the rows TubeOffsets[i] to
+    TubeOffsets[i+1].  Each tube's world-space bounds, length, and mean
+    radius are also stored, so find_tubes_in_point_arrays can select
+    tubes without reading their points.
+
+    Only tubes are stored.  A tube whose parent is not a tube is
+    attached to the group when read back.  Tag dictionaries are not
+    stored.
+
+    Args:
+        group (itk.GroupSpatialObject): The group to write.  Must be 3D.
+        dirname (str): The directory to write, conventionally ending in
+            ".tubes".  It is created if needed.
+    """
+    if group.GetObjectDimension() != 3:
+        print("ERROR: Tube arrays files only hold 3D groups.")
+        return
+
+    header, arrays = get_group_arrays(group)
+
+    os.makedirs(dirname, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(
+            os.path.join(dirname, name + ".npy"), np.ascontiguousarray(values)
+        )
+    with open(os.path.join(dirname, "header.json"), "w") as header_file:
+        json.dump(header, header_file, indent=2)
+
+
+def get_group_arrays(group: itk.GroupSpatialObject) -> tuple:
+    """Gathers the tubes of a group into the arrays of write_group_arrays.
+
+    Args:
+        group (itk.GroupSpatialObject): A 3D group.
+
+    Returns:
+        tuple: The header dict and a dict of arrays, one per column, as
+            returned by read_group_arrays.
+    """
+    group.Update()
+    tube_list = get_children_as_list(group)
+    arrays = get_tube_point_arrays(tube_list, include_object_space=True)
+
+    num_tubes = len(tube_list)
+    tube_index = {tube.GetId(): i for i, tube in enumerate(tube_list)}
+    arrays["TubeParent"] = np.full(num_tubes, -1, dtype=np.int64)
+    arrays["TubeParentPoint"] = np.zeros(num_tubes, dtype=np.int64)
+    arrays["TubeRoot"] = np.zeros(num_tubes, dtype=np.uint8)
+    arrays["TubeColor"] = np.zeros((num_tubes, 4))
+    arrays["TubeObjectToParentMatrix"] = np.zeros((num_tubes, 3, 3))
+    arrays["TubeObjectToParentOffset"] = np.zeros((num_tubes, 3))
+    arrays.update(_get_tube_summary_arrays(arrays))
+    tube_names = []
+    for i, tube in enumerate(tube_list):
+        parent = tube.GetParent()
+        if parent is not None and parent.GetTypeName() == "TubeSpatialObject":
+            arrays["TubeParent"][i] = tube_index.get(parent.GetId(), -1)
+        arrays["TubeParentPoint"][i] = tube.GetParentPoint()
+        arrays["TubeRoot"][i] = tube.GetRoot()
+        tube_property = tube.GetProperty()
+        arrays["TubeColor"][i] = tuple(tube_property.GetColor())
+        tube_names.append(tube_property.GetName())
+        (
+            arrays["TubeObjectToParentMatrix"][i],
+            arrays["TubeObjectToParentOffset"][i],
+        ) = _get_transform_arrays(tube.GetObjectToParentTransform())
+
+    group_matrix, group_offset = _get_transform_arrays(
+        group.GetObjectToParentTransform()
+    )
+    header = {
+        "Format": TUBE_ARRAYS_FORMAT,
+        "Version": TUBE_ARRAYS_VERSION,
+        "Dimension": 3,
+        "GroupId": group.GetId(),
+        "GroupName": group.GetProperty().GetName(),
+        "GroupObjectToParentMatrix": group_matrix.tolist(),
+        "GroupObjectToParentOffset": group_offset.tolist(),
+        "NumberOfTubes": num_tubes,
+        "NumberOfPoints": int(arrays["TubeOffsets"][-1]),
+        "TubeNames": tube_names,
+        "Columns": sorted(arrays),
+    }
+    return header, arrays
+
+
+def read_group_arrays(dirname: str, mmap_mode: str = "r") -> tuple:
+    """Reads the columnar arrays written by write_group_arrays.
+
+    The columns are memory-mapped, so only the pages that are used are
+    read from disk.  The arrays can be passed directly to
+    tube_visualization_utils.convert_point_arrays_to_polylines, without
+    creating ITK objects.
+
+    Args:
+        dirname (str): The directory to read.
+        mmap_mode (str, optional): The numpy.load memory-map mode. "r"
+            maps read-only, "c" maps copy-on-write, and None reads the
+            arrays into memory. Defaults to "r".
+
+    Returns:
+        tuple: The header dict and a dict of arrays, one per column.
+    """
+    with open(os.path.join(dirname, "header.json")) as header_file:
+        header = json.load(header_file)
+    if header.get("Format") != TUBE_ARRAYS_FORMAT:
+        print("ERROR: " + dirname + " is not a tube arrays file.")
+        return None, None
+    if header["Version"] > TUBE_ARRAYS_VERSION:
+        print("ERROR: Unsupported tube arrays version in " + dirname)
+        return None, None
+
+    arrays = {
+        name: np.load(
+            os.path.join(dirname, name + ".npy"), mmap_mode=mmap_mode
+        )
+        for name in header["Columns"]
+    }
+    return header, arrays
+
+
+def convert_group_arrays_to_group(
+    header: dict, arrays: dict, tube_indices=None
+) -> itk.GroupSpatialObject:
+    """Builds a group of tubes from the arrays of read_group_arrays.
+
+    Only the rows of the selected tubes are read, so memory-mapped
+    arrays are paged in only for them.  A selected tube whose parent
+    tube is not selected is attached to the group, with the transforms
+    of its unselected ancestors folded into its own.
+
+    Args:
+        header (dict): The header returned by read_group_arrays.
+        arrays (dict): The arrays returned by read_group_arrays.
+        tube_indices (np.ndarray, optional): The indices of the tubes to
+            build, e.g., from find_tubes_in_point_arrays. Defaults to
+            None, which builds all tubes.
+
+    Returns:
+        itk.GroupSpatialObject: The group holding the tubes.
+    """
+    group = itk.GroupSpatialObject[3].New()
+    group.SetId(header["GroupId"])
+    group.GetProperty().SetName(header["GroupName"])
+    _set_transform_arrays(
+        group.GetModifiableObjectToParentTransform(),
+        header["GroupObjectToParentMatrix"],
+        header["GroupObjectToParentOffset"],
+    )
+    group.Update()
+
+    if tube_indices is None:
+        tube_indices = range(len(arrays["TubeId"]))
+
+    PointType = itk.TubeSpatialObjectPoint[3]
+    tube_offsets = arrays["TubeOffsets"]
+    tubes = {}
+    for i in tube_indices:
+        i = int(i)
+        rows = slice(tube_offsets[i], tube_offsets[i + 1])
+        points = [PointType() for _ in range(rows.stop - rows.start)]
+        _set_point_values(points, PointType.SetId, arrays["PointId"][rows])
+        for name in (
+            "PositionInObjectSpace",
+            "RadiusInObjectSpace",
+            "TangentInObjectSpace",
+            "Normal1InObjectSpace",
+            "Normal2InObjectSpace",
+        ):
+            _set_point_values(
+                points, getattr(PointType, "Set" + name), arrays[name][rows]
+            )
+        for channel, setter in enumerate(
+            (
+                PointType.SetRed,
+                PointType.SetGreen,
+                PointType.SetBlue,
+                PointType.SetAlpha,
+            )
+        ):
+            _set_point_values(points, setter, arrays["Color"][rows, channel])
+        for name in TUBE_POINT_SCALAR_ATTRIBUTES:
+            _set_point_values(
+                points, getattr(PointType, "Set" + name), arrays[name][rows]
+            )
+
+        tube = itk.TubeSpatialObject[3].New()
+        tube.SetId(int(arrays["TubeId"][i]))
+        tube.GetProperty().SetName(header["TubeNames"][i])
+        red, green, blue, alpha = arrays["TubeColor"][i].tolist()
+        tube.GetProperty().SetColor(red, green, blue)
+        tube.GetProperty().SetAlpha(alpha)
+        tube.SetParentPoint(int(arrays["TubeParentPoint"][i]))
+        tube.SetRoot(bool(arrays["TubeRoot"][i]))
+        tube.SetPoints(points)
+        tubes[i] = tube
+
+    for i, tube in tubes.items():
+        matrix = np.array(arrays["TubeObjectToParentMatrix"][i])
+        offset = np.array(arrays["TubeObjectToParentOffset"][i])
+        parent = int(arrays["TubeParent"][i])
+        while parent >= 0 and parent not in tubes:
+            parent_matrix = arrays["TubeObjectToParentMatrix"][parent]
+            offset = parent_matrix @ offset + arrays[
+                "TubeObjectToParentOffset"
+            ][parent]
+            matrix = parent_matrix @ matrix
+            parent = int(arrays["TubeParent"][parent])
+        if parent >= 0:
+            tubes[parent].AddChild(tube)
+        else:
+            group.AddChild(tube)
+        # Adding a child resets its object-to-parent transform, so the
+        #   transform is set afterwards.
+        _set_transform_arrays(
+            tube.GetModifiableObjectToParentTransform(), matrix, offset
+        )
+    group.Update()
+    return group
+
+
+def _get_tube_summary_arrays(point_arrays: dict) -> dict:
+    """Computes the world-space bounds, length, and mean radius of tubes.
+
+    Returns:
+        dict: "TubeBoundsLower" and "TubeBoundsUpper" (number of tubes x
+            3), "TubeLength", and "TubeMeanRadius".  Tubes without
+            points have empty bounds, zero length, and zero radius.
+    """
+    position = np.asarray(point_arrays["Position"])
+    radius = np.asarray(point_arrays["Radius"])
+    tube_offsets = point_arrays["TubeOffsets"]
+    num_tubes = len(tube_offsets) - 1
+    counts = np.diff(tube_offsets)
+    has_points = counts > 0
+    starts = tube_offsets[:-1][has_points]
+
+    summary = {
+        "TubeBoundsLower": np.full((num_tubes, 3), np.inf),
+        "TubeBoundsUpper": np.full((num_tubes, 3), -np.inf),
+        "TubeLength": np.zeros(num_tubes),
+        "TubeMeanRadius": np.zeros(num_tubes),
+    }
+    if len(starts) == 0:
+        return summary
+
+    # Tubes without points add no rows, so each reduced segment only
+    #   holds the rows of one tube.
+    summary["TubeBoundsLower"][has_points] = np.minimum.reduceat(
+        position, starts
+    )
+    summary["TubeBoundsUpper"][has_points] = np.maximum.reduceat(
+        position, starts
+    )
+    summary["TubeMeanRadius"][has_points] = (
+        np.add.reduceat(radius, starts) / counts[has_points]
+    )
+    # Segment j joins points j and j+1, so the segments of a tube are
+    #   its rows but the last.
+    segment_lengths = np.zeros(len(position))
+    segment_lengths[1:] = np.cumsum(
+        np.linalg.norm(np.diff(position, axis=0), axis=1)
+    )
+    summary["TubeLength"] = (
+        segment_lengths[np.maximum(tube_offsets[1:] - 1, 0)]
+        - segment_lengths[np.minimum(tube_offsets[:-1], len(position) - 1)]
+    )
+    summary["TubeLength"][~has_points] = 0
+    return summary
+
+
+def find_tubes_in_point_arrays(
+    point_arrays: dict,
+    tube_ids=None,
+    bounds=None,
+    min_length: float = None,
+    min_radius: float = None,
+) -> np.ndarray:
+    """Finds the tubes that match all of the given predicates.
+
+    The per-tube columns written by write_group_arrays are used when
+    present, so that only the positions of tubes whose bounds overlap
+    the query box are read.
+
+    Args:
+        point_arrays (dict): Tube point arrays as returned by
+            get_tube_point_arrays or read_group_arrays.
+        tube_ids (iterable, optional): Keep only tubes with these ids.
+        bounds (tuple, optional): The world-space (lower, upper)
+            corners of a box.  Keep only tubes with at least one
+            centerline point in the box.
+        min_length (float, optional): Keep only tubes whose world-space
+            centerline is at least this long.
+        min_radius (float, optional): Keep only tubes whose mean
+            world-space radius is at least this large.
+
+    Returns:
+        np.ndarray: The indices of the matching tubes, in file order.
+    """
+    if "TubeLength" in point_arrays:
+        summary = point_arrays
+    else:
+        summary = _get_tube_summary_arrays(point_arrays)
+
+    keep = np.ones(len(point_arrays["TubeId"]), dtype=bool)
+    if tube_ids is not None:
+        keep &= np.isin(point_arrays["TubeId"], np.fromiter(tube_ids, int))
+    if min_length is not None:
+        keep &= summary["TubeLength"] >= min_length
+    if min_radius is not None:
+        keep &= summary["TubeMeanRadius"] >= min_radius
+    if bounds is not None:
+        lower = np.asarray(bounds[0], dtype=np.float64)
+        upper = np.asarray(bounds[1], dtype=np.float64)
+        keep &= np.all(summary["TubeBoundsLower"] <= upper, axis=1)
+        keep &= np.all(summary["TubeBoundsUpper"] >= lower, axis=1)
+        tube_offsets = point_arrays["TubeOffsets"]
+        for i in np.flatnonzero(keep):
+            position = point_arrays["Position"][
+                tube_offsets[i] : tube_offsets[i + 1]
+            ]
+            keep[i] = np.any(
+                np.all((position >= lower) & (position <= upper), axis=1)
+            )
+    return np.flatnonzero(keep)
+
+
+def _get_runs(keep: np.ndarray) -> list:
+    """Returns the (start, stop) of each run of True values."""
+    edges = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def merge_tube_groups(
+    groups: list,
+    min_points: int = 3,
+    stitch_scale: float = 2.0,
+    min_tube_points: int = 0,
+) -> itk.GroupSpatialObject:
+    """Merges groups of tubes, dropping the parts found more than once.
+
+    The groups are merged in order.  A point of a tube is a duplicate if
+    a point of an earlier group's tube is within its radius.  Each tube
+    is split at its duplicate points, and the runs of at least
+    min_points points are kept.  A run that starts or ends within
+    stitch_scale times its radius of an end point of an earlier group's
+    tube continues that tube, and is joined to it.  Tubes of the same
+    group are not compared, as one extractor does not trace a vessel
+    twice.
+
+    Args:
+        groups (list): The groups to merge, e.g., extracted from
+            overlapping tiles of an image.  Their tubes are expected in
+            world space, and their hierarchy is not kept.
+        min_points (int, optional): The fewest points of a kept run.
+            Defaults to 3.
+        stitch_scale (float, optional): The stitching distance, in
+            radii. Defaults to 2.0.
+        min_tube_points (int, optional): The fewest points traced for a
+            merged tube, once all groups are merged and stitched.  The
+            points of every source tube it was built from count,
+            including those dropped as duplicates, so a branch is
+            judged by its traced length, as in a single extraction.
+            Defaults to 0, which keeps all merged tubes.
+
+    Returns:
+        itk.GroupSpatialObject: A group holding the merged tubes,
+            numbered in merge order.
+    """
+    merged = itk.GroupSpatialObject[3].New()
+    merged_tubes = {}
+    # The points of the source tubes that each merged tube was built
+    #   from, counting those dropped as duplicates
+    traced_points = {}
+    index = tube_point_index()
+    for group in groups:
+        group.Update()
+        tube_list = get_children_as_list(group)
+        point_arrays = get_tube_point_arrays(tube_list)
+        points, PointType, _, tube_offsets = _gather_tube_points(tube_list)
+        position = point_arrays["Position"]
+        radius = np.maximum(point_arrays["Radius"], 1e-6)
+
+        duplicate = index.count_points_within_radius(position, radius) > 0
+
+        # Joins are applied once the whole group is merged, so that the
+        #   index, and the point numbers it returns, stay unchanged.
+        prepends = {}
+        appends = {}
+
+        def _stitch(point_num, run_points, at_start, num_traced):
+            if index.get_number_of_points() == 0:
+                return False
+            max_distance = stitch_scale * radius[point_num]
+            tube_id, _, distance = index.find_closest_point(
+                position[point_num]
+            )
+            if distance > max_distance:
+                return False
+            # The closest point may be a few points short of the end, so
+            #   the run is joined to an end within the stitching distance
+            tube = merged_tubes[tube_id]
+            first, last = (
+                np.linalg.norm(
+                    np.subtract(
+                        tube.GetPoint(i).GetPositionInWorldSpace(),
+                        position[point_num],
+                    )
+                )
+                for i in (0, tube.GetNumberOfPoints() - 1)
+            )
+            # Orient the run so that it ends next to the tube
+            if at_start:
+                run_points = run_points[::-1]
+            if last <= min(first, max_distance) and tube_id not in appends:
+                appends[tube_id] = run_points[::-1]
+            elif first <= max_distance and tube_id not in prepends:
+                prepends[tube_id] = run_points
+            else:
+                return False
+            traced_points[tube_id] += num_traced
+            return True
+
+        new_tubes = []
+        for i, tube in enumerate(tube_list):
+            start = tube_offsets[i]
+            rows = slice(start, tube_offsets[i + 1])
+            num_traced = rows.stop - rows.start
+            for run_start, run_stop in _get_runs(~duplicate[rows]):
+                if run_stop - run_start < min_points:
+                    continue
+                first = start + run_start
+                last = start + run_stop - 1
+                run_points = points[first : last + 1]
+                if _stitch(first, run_points, True, num_traced):
+                    continue
+                if _stitch(last, run_points, False, num_traced):
+                    continue
+                new_tubes.append((tube, run_points, num_traced))
+
+        for tube_id in set(prepends) | set(appends):
+            tube = merged_tubes[tube_id]
+            tube_points = tube.GetPoints()
+            tube_points = list(
+                map(tube_points.__getitem__, range(len(tube_points)))
+            )
+            tube_points = (
+                prepends.get(tube_id, [])
+                + tube_points
+                + appends.get(tube_id, [])
+            )
+            _set_point_values(
+                tube_points, PointType.SetId, np.arange(len(tube_points))
+            )
+            tube.SetPoints(tube_points)
+            tube.Update()
+            index.add_tube(tube)
+        for source_tube, run_points, num_traced in new_tubes:
+            tube = itk.TubeSpatialObject[3].New()
+            tube.SetId(len(merged_tubes))
+            source_property = source_tube.GetProperty()
+            tube.GetProperty().SetName(source_property.GetName())
+            tube.GetProperty().SetColor(*list(source_property.GetColor())[:3])
+            tube.GetProperty().SetAlpha(source_property.GetAlpha())
+            _set_point_values(
+                run_points, PointType.SetId, np.arange(len(run_points))
+            )
+            tube.SetPoints(run_points)
+            merged.AddChild(tube)
+            tube.Update()
+            merged_tubes[tube.GetId()] = tube
+            traced_points[tube.GetId()] = num_traced
+            index.add_tube(tube)
+
+    # Short pieces may still have been stitched into long tubes, so
+    #   short tubes are only dropped now.  The rest are renumbered.
+    tube_id = 0
+    for old_id, tube in merged_tubes.items():
+        if traced_points[old_id] < min_tube_points:
+            merged.RemoveChild(tube)
+        else:
+            tube.SetId(tube_id)
+            tube_id += 1
+    merged.Update()
+    return merged
+
+
+class tube_id_map:
+    """
+    A persistent map from tube ids to tubes and their positions in a list.
+
+    The map is built once from a group, or from a list of tubes returned
+    by get_children_as_list, and replaces the linear scans of
+    get_tube_index_in_list with dictionary lookups.  When built from a
+    group, the map is rebuilt on the next lookup after the group's
+    modification time changes, e.g., after AddChild or RemoveChild.
+    Changes to deeper descendants require a call to update().
+    """
+
+    def __init__(
+        self, grp: itk.GroupSpatialObject = None, tube_list: list = None
+    ):
+        """
+        The constructor for the tube_id_map class.
+
+        Args:
+            grp (itk.GroupSpatialObject, optional): The group whose tubes
+                are mapped. Defaults to None.
+            tube_list (list, optional): The tubes to map, if already listed
+                from grp, or if there is no group. Defaults to None.
+        """
+        self.grp = grp
+        self.tube_list = []
+        self._index = {}
+        self._group_mtime = None
+        if tube_list is not None:
+            self._build(tube_list)
+        else:
+            self.update()
+
+    def _build(self, tube_list):
+        """
+        Private function to map the ids of a list of tubes.
+        """
+        self.tube_list = tube_list
+        self._index = {tube.GetId(): i for i, tube in enumerate(tube_list)}
+        if self.grp is not None:
+            self._group_mtime = self.grp.GetMTime()
+
+    def update(self):
+        """Rebuilds the map from the group's current children."""
+        if self.grp is not None:
+            self._build(get_children_as_list(self.grp))
+
+    def _checkGroup(self):
+        """
+        Private function to rebuild the map if the group was modified.
+        """
+        if self.grp is not None and self.grp.GetMTime() != self._group_mtime:
+            self.update()
+
+    def add_tube(self, tube: itk.TubeSpatialObject):
+        """Adds a tube to the group, if any, and to the end of the map.
+
+        Args:
+            tube (itk.TubeSpatialObject): The tube to add.
+        """
+        if self.grp is not None:
+            self._checkGroup()
+            self.grp.AddChild(tube)
+            self._group_mtime = self.grp.GetMTime()
+        self._index[tube.GetId()] = len(self.tube_list)
+        self.tube_list.append(tube)
+
+    def remove_tube(self, tube_id: int):
+        """Removes a tube from the group, if any, and from the map.
+
+        Args:
+            tube_id (int): The id of the tube to remove.
+        """
+        self._checkGroup()
+        index = self._index.pop(tube_id)
+        tube = self.tube_list.pop(index)
+        for i in range(index, len(self.tube_list)):
+            self._index[self.tube_list[i].GetId()] = i
+        if self.grp is not None:
+            tube.GetParent().RemoveChild(tube)
+            self._group_mtime = self.grp.GetMTime()
+
+    def get_index(self, tube_id: int) -> int:
+        """Returns the position of a tube in tube_list.
+
+        Args:
+            tube_id (int): The id of the tube to find.
+
+        Returns:
+            int: The index of the tube in tube_list.
+        """
+        self._checkGroup()
+        return self._index[tube_id]
+
+    def get_tube(self, tube_id: int) -> itk.TubeSpatialObject:
+        """Returns the tube having an id.
+
+        Args:
+            tube_id (int): The id of the tube to find.
+
+        Returns:
+            itk.TubeSpatialObject: The tube.
+        """
+        self._checkGroup()
+        return self.tube_list[self._index[tube_id]]
+
+    def __contains__(self, tube_id: int) -> bool:
+        self._checkGroup()
+        return tube_id in self._index
+
+    def __len__(self) -> int:
+        self._checkGroup()
+        return len(self.tube_list)
+
+
+class tube_point_index:
+    """
+    A voxel-hash index over the world-space centerline points of tubes.
+
+    Points are binned into cubic cells, and the integer coordinates of
+    each point's cell are packed into one key.  Points are kept sorted by
+    key, so the points in a row of cells are found by binary search.
+    Every point maps back to the id of its tube and its index in that
+    tube's list of points.
+
+    Tubes can be added or removed at any time.  Only the points of added
+    tubes are read from ITK; the sorted arrays are rebuilt from the
+    stored per-tube points on the next query.
+    """
+
+    def __init__(self, grp: itk.GroupSpatialObject = None, cell_size=None):
+        """
+        The constructor for the tube_point_index class.
+
+        Args:
+            grp (itk.GroupSpatialObject, optional): A group whose tubes
+                are added to the index. Defaults to None.
+            cell_size (float, optional): The edge length of the hash
+                cells. Defaults to None, which uses four times the median
+                distance between consecutive tube points.
+        """
+        self.cell_size = cell_size
+
+        self._tube_points = {}
+        self._modified = True
+
+        self._cell_size = 1.0
+        self._origin = np.zeros(3)
+        self._dims = np.ones(3, dtype=np.int64)
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._positions = np.zeros((0, 3))
+        self._tube_ids = np.zeros(0, dtype=np.int64)
+        self._point_indices = np.zeros(0, dtype=np.int64)
+
+        if grp is not None:
+            self.add_tubes(get_children_as_list(grp))
+
+    def add_tube(self, tube: itk.TubeSpatialObject):
+        """Adds, or replaces, the points of a tube.
+
+        Args:
+            tube (itk.TubeSpatialObject): The tube to add. It should be up
+                to date, so its world-space positions are current.
+        """
+        tube_points = tube.GetPoints()
+        points = list(map(tube_points.__getitem__, range(len(tube_points))))
+        matrix, offset = _get_object_to_world(tube)
+        if len(points) > 0:
+            positions = _get_point_positions(
+                points, type(points[0]).GetPositionInObjectSpace
+            )
+            self._tube_points[tube.GetId()] = positions @ matrix.T + offset
+        else:
+            self._tube_points[tube.GetId()] = np.zeros((0, 3))
+        self._modified = True
+
+    def add_tubes(self, tube_list: list):
+        """Adds, or replaces, the points of a list of tubes.
+
+        Args:
+            tube_list (list): The tubes to add.
+        """
+        for tube in tube_list:
+            self.add_tube(tube)
+
+    def remove_tube(self, tube_id: int):
+        """Removes the points of a tube from the index.
+
+        Args:
+            tube_id (int): The id of the tube to remove.
+        """
+        if self._tube_points.pop(tube_id, None) is not None:
+            self._modified = True
+
+    def get_number_of_points(self, tube_id: int = None) -> int:
+        """Returns the number of indexed points.
+
+        Args:
+            tube_id (int, optional): Only count the points of this tube.
+                Defaults to None.
+
+        Returns:
+            int: The number of points, or 0 if the tube is not indexed.
+        """
+        if tube_id is not None:
+            return len(self._tube_points.get(tube_id, ()))
+        return sum(len(points) for points in self._tube_points.values())
+
+    def update(self):
+        """Rebuilds the sorted point arrays if tubes were added or removed."""
+        if not self._modified:
+            return
+        self._modified = False
+
+        tube_ids = list(self._tube_points.keys())
+        counts = np.array(
+            [len(self._tube_points[i]) for i in tube_ids], dtype=np.int64
+        )
+        if counts.sum() == 0:
+            self._keys = np.zeros(0, dtype=np.int64)
+            self._positions = np.zeros((0, 3))
+            self._tube_ids = np.zeros(0, dtype=np.int64)
+            self._point_indices = np.zeros(0, dtype=np.int64)
+            return
+        positions = np.concatenate([self._tube_points[i] for i in tube_ids])
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        point_indices = np.arange(offsets[-1]) - np.repeat(
+            offsets[:-1], counts
+        )
+
+        self._cell_size = self.cell_size
+        if self._cell_size is None:
+            steps = np.linalg.norm(np.diff(positions, axis=0), axis=1)
+            steps = steps[point_indices[1:] > 0]
+            steps = steps[steps > 0]
+            self._cell_size = 4 * np.median(steps) if len(steps) > 0 else 1.0
+
+        self._origin = positions.min(axis=0)
+        cells = np.floor((positions - self._origin) / self._cell_size).astype(
+            np.int64
+        )
+        self._dims = cells.max(axis=0) + 1
+        keys = self._cellKeys(cells[:, 0], cells[:, 1], cells[:, 2])
+        order = np.argsort(keys, kind="stable")
+
+        self._keys = keys[order]
+        self._positions = positions[order]
+        self._tube_ids = np.repeat(tube_ids, counts)[order]
+        self._point_indices = point_indices[order]
+
+    def _cellKeys(self, ix, iy, iz):
+        """
+        Private function to pack cell coordinates into one key.
+        """
+        return (ix * self._dims[1] + iy) * self._dims[2] + iz
+
+    def _pointsInBox(self, lower, upper):
+        """
+        Private function to get the sorted indices of points in the cells
+        overlapping the world-space box [lower, upper].
+        """
+        lo = np.floor((np.asarray(lower) - self._origin) / self._cell_size)
+        hi = np.floor((np.asarray(upper) - self._origin) / self._cell_size)
+        lo = np.maximum(lo, 0).astype(np.int64)
+        hi = np.minimum(hi, self._dims - 1).astype(np.int64)
+        if len(self._keys) == 0 or np.any(lo > hi):
+            return np.zeros(0, dtype=np.int64)
+
+        ix, iy = np.meshgrid(
+            np.arange(lo[0], hi[0] + 1),
+            np.arange(lo[1], hi[1] + 1),
+            indexing="ij",
+        )
+        row_keys = self._cellKeys(ix.ravel(), iy.ravel(), 0)
+        starts = np.searchsorted(self._keys, row_keys + lo[2], side="left")
+        ends = np.searchsorted(self._keys, row_keys + hi[2], side="right")
+        counts = ends - starts
+        row_offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        return np.repeat(starts - row_offsets, counts) + np.arange(
+            counts.sum()
+        )
+
+    def find_points_in_bounds(self, lower, upper):
+        """Finds the points inside a world-space bounding box.
+
+        Args:
+            lower (list): The minimum corner of the box.
+            upper (list): The maximum corner of the box.
+
+        Returns:
+            tuple: The tube ids and the point indices of the points found.
+        """
+        self.update()
+        candidates = self._pointsInBox(lower, upper)
+        positions = self._positions[candidates]
+        inside = np.all((positions >= lower) & (positions <= upper), axis=1)
+        candidates = candidates[inside]
+        return self._tube_ids[candidates], self._point_indices[candidates]
+
+    def find_points_within_radius(self, position, radius: float):
+        """Finds the points within a distance of a world-space position.
+
+        Args:
+            position (list): The center of the query.
+            radius (float): The query distance.
+
+        Returns:
+            tuple: The tube ids and the point indices of the points found.
+        """
+        self.update()
+        position = np.asarray(position, dtype=np.float64)
+        candidates = self._pointsInBox(position - radius, position + radius)
+        distances = np.linalg.norm(
+            self._positions[candidates] - position, axis=1
+        )
+        candidates = candidates[distances <= radius]
+        return self._tube_ids[candidates], self._point_indices[candidates]
+
+    def count_points_within_radius(self, positions, radius):
+        """Counts the points within a distance of each of many positions.
+
+        All queries are answered at once: the rows of cells overlapped by
+        every query's box are binary searched together, and the distances
+        to all of their points are computed in one pass.
+
+        Args:
+            positions (np.ndarray): The N x 3 world-space query centers.
+            radius (float or np.ndarray): The query distance, or one per
+                position.
+
+        Returns:
+            np.ndarray: The number of points found for each position.
+        """
+        self.update()
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        radius = np.broadcast_to(
+            np.asarray(radius, dtype=np.float64), len(positions)
+        )
+        if len(self._keys) == 0 or len(positions) == 0:
+            return np.zeros(len(positions), dtype=np.int64)
+
+        lo = (positions - radius[:, None] - self._origin) / self._cell_size
+        hi = (positions + radius[:, None] - self._origin) / self._cell_size
+        lo = np.maximum(np.floor(lo), 0).astype(np.int64)
+        hi = np.minimum(np.floor(hi), self._dims - 1).astype(np.int64)
+        extent = np.maximum(hi - lo + 1, 0)
+        num_rows = extent[:, 0] * extent[:, 1] * (extent[:, 2] > 0)
+
+        # One row of cells along z per query and (x, y) cell of its box
+        query = np.repeat(np.arange(len(positions)), num_rows)
+        row = np.arange(num_rows.sum()) - np.repeat(
+            np.cumsum(num_rows) - num_rows, num_rows
+        )
+        row_keys = self._cellKeys(
+            lo[query, 0] + row // extent[query, 1],
+            lo[query, 1] + row % extent[query, 1],
+            0,
+        )
+        starts = np.searchsorted(self._keys, row_keys + lo[query, 2], "left")
+        ends = np.searchsorted(self._keys, row_keys + hi[query, 2], "right")
+        counts = ends - starts
+        candidates = np.repeat(
+            starts - (np.cumsum(counts) - counts), counts
+        ) + np.arange(counts.sum())
+        query = np.repeat(query, counts)
+
+        distances = np.linalg.norm(
+            self._positions[candidates] - positions[query], axis=1
+        )
+        return np.bincount(
+            query[distances <= radius[query]], minlength=len(positions)
+        )
+
+    def find_tubes_within_radius(self, position, radius: float):
+        """Finds the tubes having a point within a distance of a position.
+
+        Args:
+            position (list): The center of the query.
+            radius (float): The query distance.
+
+        Returns:
+            np.ndarray: The sorted ids of the tubes found.
+        """
+        tube_ids, _ = self.find_points_within_radius(position, radius)
+        return np.unique(tube_ids)
+
+    def find_closest_point(self, position, tube_id: int = None):
+        """Finds the point closest to a world-space position.
+
+        The search radius starts at one cell and doubles until a point is
+        found within it, which is then the closest point.
+
+        Args:
+            position (list): The query position.
+            tube_id (int, optional): Only consider the points of this tube.
+                Defaults to None.
+
+        Returns:
+            tuple: The tube id, point index, and distance of the closest
+                point, or None if no point qualifies.
+        """
+        self.update()
+        position = np.asarray(position, dtype=np.float64)
+        radius = self._cell_size
+        while True:
+            lower = position - radius
+            upper = position + radius
+            candidates = self._pointsInBox(lower, upper)
+            if tube_id is not None:
+                candidates = candidates[self._tube_ids[candidates] == tube_id]
+            distances = np.linalg.norm(
+                self._positions[candidates] - position, axis=1
+            )
+            covers_all = np.all(lower <= self._origin) and np.all(
+                upper >= self._origin + self._dims * self._cell_size
+            )
+            if len(candidates) > 0 and (
+                distances.min() <= radius or covers_all
+            ):
+                closest = np.argmin(distances)
+                point = candidates[closest]
+                return (
+                    int(self._tube_ids[point]),
+                    int(self._point_indices[point]),
+                    float(distances[closest]),
+                )
+            if covers_all:
+                return None
+            radius *= 2
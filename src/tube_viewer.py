@@ -21,30 +21,55 @@ from vtkmodules.vtkRenderingCore import (
 
 from tube_utils import (
     get_children_as_list,
-    get_tube_index_in_list,
+    tube_id_map,
+    tube_point_index,
     write_group
 )
 from tube_visualization_utils import (
+    convert_tubes_to_lod_surfaces,
     convert_tubes_to_polylines,
-    convert_tubes_to_surfaces
+    convert_tubes_to_surfaces,
+    extract_tubes_from_polydata
 )
 
 
 class tube_viewer:
-    def __init__(self, tubes):
+    def __init__(self, tubes, merged=False, offscreen=False):
         """
         The constructor for the tube_viewer class.
+
+        Args:
+            tubes (itk.GroupSpatialObject): The tubes to be visualized.
+            merged (bool, optional): Render all tubes using a single
+                polydata, mapper, and actor, which scales to scenes with
+                many thousands of tubes. Defaults to False.
+            offscreen (bool, optional): Render each scene once, off
+                screen, and return without starting the interaction,
+                e.g., to time or test rendering. Defaults to False.
         """
         self.tubes = tubes
+        self.merged = merged
+        self.offscreen = offscreen
 
         self.tube_list = get_children_as_list(tubes)
         self.num_tubes = len(self.tube_list)
+        self.tube_ids = tube_id_map(tubes, self.tube_list)
 
-        self.tube_polylines = convert_tubes_to_polylines(tubes)
-        self.tube_surfaces = convert_tubes_to_surfaces(tubes)
+        self.tube_polylines = convert_tubes_to_polylines(tubes, merged)
+        self.tube_surfaces = convert_tubes_to_surfaces(tubes, merged=merged)
 
         self.data_image = None
 
+        self.renderer = None
+        self.tube_actor = None
+        self.tube_actors = {}
+
+        self.lod_pdata = []
+        self.lod_distances = [1.5, 4.0]
+
+        # Built on the first pick
+        self.tube_point_index = None
+
         self.selected_tubes_ids = []
         self.selected_tubes_points = []
         self.selected_tubes_actors = []
@@ -80,70 +105,104 @@ class tube_viewer:
         """
         Private function to get the selected tubes as a list.
         """
-        selected_tubes_list = []
-        for i in range(len(self.tube_list)):
-            id = self.tube_list[i].GetId()
-            if id in self.selected_tubes_ids:
-                selected_tubes_list.append(self.tube_list[i])
-        return selected_tubes_list
-
-    def _updateCurrentTubeActor(self, pickedPos, actor, renwin):
+        selected_tubes_indices = sorted(
+            self.tube_ids.get_index(tube_id)
+            for tube_id in self.selected_tubes_ids
+        )
+        return [self.tube_list[i] for i in selected_tubes_indices]
+
+    def _highlightTube(self, tube_id):
+        """
+        Private function to draw a tube as selected.
+
+        Returns the actor to pass to _unhighlightTube.
+        """
+        if self.merged:
+            tube_pdata = extract_tubes_from_polydata(
+                self.tube_actor.GetMapper().GetInput(), [tube_id]
+            )
+            mapper = vtkPolyDataMapper()
+            mapper.SetInputData(tube_pdata)
+            mapper.ScalarVisibilityOff()
+            # Draw in front of the coincident cells of the merged actor
+            mapper.SetRelativeCoincidentTopologyLineOffsetParameters(-1, -1)
+            mapper.SetRelativeCoincidentTopologyPolygonOffsetParameters(
+                -1, -1
+            )
+            actor = vtkActor()
+            actor.SetMapper(mapper)
+            actor.GetProperty().SetColor(1, 1, 1)
+            self.renderer.AddActor(actor)
+            return actor
+
+        actor = self.tube_actors[tube_id]
+        actor.GetMapper().ScalarVisibilityOff()
+        actor.GetProperty().SetColor(1, 1, 1)
+        actor.GetMapper().Update()
+        actor.Modified()
+        return actor
+
+    def _unhighlightTube(self, actor):
+        """
+        Private function to restore the drawing of a selected tube.
+        """
+        if self.merged:
+            self.renderer.RemoveActor(actor)
+            return
+
+        actor.GetMapper().ScalarVisibilityOn()
+        actor.GetMapper().Update()
+        actor.Modified()
+
+    def _updateCurrentTubeActor(self, pickedPos, tube_id, renwin):
         """
         Private function to updated the viz of currently selected tube.
         """
-        if len(self.selected_tubes_actors) > 0:
+        if tube_id is not None:
+            pos = [pickedPos[0], pickedPos[1], pickedPos[2]]
+            if self.tube_point_index is None:
+                self.tube_point_index = tube_point_index()
+                self.tube_point_index.add_tubes(self.tube_list)
+            closest_point = self.tube_point_index.find_closest_point(
+                pos, tube_id
+            )
+            if closest_point is None:
+                # The picked tube has no points to select, e.g., it is
+                #   not indexed, so the selection is left as it is.
+                return
+        if len(self.selected_tubes_ids) > 0:
             if (
                 self.multiple_selections_enabled is False and
-                not ([actor] == self.selected_tubes_actors)
+                not ([tube_id] == self.selected_tubes_ids)
             ):
                 for tube_actor in self.selected_tubes_actors:
-                    tube_actor.GetMapper().ScalarVisibilityOn()
-                    tube_actor.GetMapper().Update()
-                    tube_actor.Modified()
+                    self._unhighlightTube(tube_actor)
                 self.selected_tubes_ids = []
                 self.selected_tubes_points = []
                 self.selected_tubes_actors = []
             elif (
                 self.multiple_selections_enabled is True and
-                actor in self.selected_tubes_actors
+                tube_id in self.selected_tubes_ids
             ):
-                actor.GetMapper().ScalarVisibilityOn()
-                actor.GetMapper().Update()
-                actor.Modified()
-                idx = self.selected_tubes_actors.index(actor)
-                self.selected_tubes_actors = \
-                    self.selected_tubes_actors[0:idx] + \
-                    self.selected_tubes_actors[idx:-1]
-                self.selected_tubes_ids = \
-                    self.selected_tubes_ids[0:idx] + \
-                    self.selected_tubes_ids[idx:-1]
-                self.selected_tubes_points = \
-                    self.selected_tubes_points[0:idx] + \
-                    self.selected_tubes_points[idx:-1]
-                actor = None
-        if actor is not None:
-            pos = [pickedPos[0], pickedPos[1], pickedPos[2]]
-            tube_poly_data = actor.GetMapper().GetInput()
-            tube_id = tube_poly_data.GetPointData().GetScalars(
-                "Id"
-            ).GetTuple(0)[0]
-            tube = self.tube_list[
-                get_tube_index_in_list(tube_id, self.tube_list)
-                ]
+                idx = self.selected_tubes_ids.index(tube_id)
+                self._unhighlightTube(self.selected_tubes_actors[idx])
+                del self.selected_tubes_actors[idx]
+                del self.selected_tubes_ids[idx]
+                del self.selected_tubes_points[idx]
+                tube_id = None
+        if tube_id is not None:
+            tube = self.tube_ids.get_tube(tube_id)
             tube_length = tube.GetNumberOfPoints()
-            point = tube.ClosestPointInWorldSpace(pos)
+            point = tube.GetPoint(closest_point[1])
             point_id = point.GetId()
             point_pos = point.GetPositionInWorldSpace()
             point_radius = point.GetRadiusInWorldSpace()
-            if actor not in self.selected_tubes_actors:
+            if tube_id not in self.selected_tubes_ids:
                 self.selected_tubes_ids.append(tube_id)
                 self.selected_tubes_points.append(point_id)
-                self.selected_tubes_actors.append(actor)
-                actor.GetMapper().ScalarVisibilityOff()
-                actor.GetProperty().SetColor(1, 1, 1)
-                actor.GetMapper().Update()
-                actor.Modified()
-                self.selected_tubes_actors.append(actor)
+                self.selected_tubes_actors.append(
+                    self._highlightTube(tube_id)
+                )
             print("Selected position: ", pos)
             print("  Tube id: ", tube_id)
             print("  Tube Length: ", tube_length)
@@ -174,8 +233,14 @@ class tube_viewer:
 
         self.multiple_selections_enabled = bool(obj.GetShiftKey())
         if pickedActor is not None:
+            # Every tube polydata, merged or not, labels its cells by tube
+            tube_id = int(
+                pickedActor.GetMapper().GetInput().GetCellData().GetArray(
+                    "TubeId"
+                ).GetTuple1(picker.GetCellId())
+            )
             self._updateCurrentTubeActor(
-                pickedPos, pickedActor, obj.GetRenderWindow()
+                pickedPos, tube_id, obj.GetRenderWindow()
             )
 
         return 0
@@ -216,14 +281,45 @@ class tube_viewer:
                 write_group(tubes_group, filename)
         return 0
 
-    def _render(self, pdata, param="Radius", vessel_list=[]):
+    def _startRenderEvent(self, obj, event):
+        """
+        Private function to pick the level of detail from camera distance.
+        """
+        bounds = self.lod_pdata[0].GetBounds()
+        center = [(bounds[2 * i] + bounds[2 * i + 1]) / 2 for i in range(3)]
+        size = max(
+            sum((bounds[2 * i + 1] - bounds[2 * i]) ** 2 for i in range(3))
+            ** 0.5,
+            1e-6,
+        )
+        camera_pos = obj.GetActiveCamera().GetPosition()
+        distance = (
+            sum((camera_pos[i] - center[i]) ** 2 for i in range(3)) ** 0.5
+        )
+        level = 0
+        while (
+            level < len(self.lod_distances)
+            and level + 1 < len(self.lod_pdata)
+            and distance > self.lod_distances[level] * size
+        ):
+            level += 1
+        mapper = self.tube_actor.GetMapper()
+        if mapper.GetInput() is not self.lod_pdata[level]:
+            mapper.SetInputData(self.lod_pdata[level])
+
+    def _render(self, pdata, param="Radius", vessel_list=[], lod_pdata=[]):
         """
         Private function to render the tubes.
+
+        In merged mode, lod_pdata optionally lists the merged polydata of
+        the levels of detail from finest to coarsest.  The level drawn
+        is then chosen from the camera distance before every render.
         """
         renderer = vtkRenderer()
 
         renderWindow = vtkRenderWindow()
         renderWindow.SetWindowName(param)
+        renderWindow.SetOffScreenRendering(self.offscreen)
         renderWindow.AddRenderer(renderer)
 
         self.renderWindowInteractor = vtkRenderWindowInteractor()
@@ -240,22 +336,55 @@ class tube_viewer:
             "KeyPressEvent", self._keyPressEvent
         )
 
-        mapper = []
-        actor = []
-        for i in range(self.num_tubes):
-            if vessel_list == [] or i in vessel_list:
-                pdata[i].GetPointData().SetActiveScalars(param)
+        self.renderer = renderer
+        self.tube_actors = {}
+        self.selected_tubes_ids = []
+        self.selected_tubes_points = []
+        self.selected_tubes_actors = []
+
+        if self.merged:
+            if vessel_list != []:
+                vessel_ids = [self.tube_list[i].GetId() for i in vessel_list]
+                pdata = extract_tubes_from_polydata(pdata, vessel_ids)
+                lod_pdata = [
+                    extract_tubes_from_polydata(level_pdata, vessel_ids)
+                    for level_pdata in lod_pdata
+                ]
+            pdata.GetPointData().SetActiveScalars(param)
+            for level_pdata in lod_pdata:
+                level_pdata.GetPointData().SetActiveScalars(param)
+            self.lod_pdata = lod_pdata
+
+            mapper = vtkPolyDataMapper()
+            mapper.SetInputData(pdata)
+            mapper.ScalarVisibilityOn()
 
-                mapper.append(vtkPolyDataMapper())
-                mapper[-1].SetInputData(pdata[i])
-                mapper[-1].ScalarVisibilityOn()
+            self.tube_actor = vtkActor()
+            self.tube_actor.SetMapper(mapper)
 
-                actor.append(vtkActor())
-                actor[-1].SetMapper(mapper[-1])
+            renderer.AddActor(self.tube_actor)
 
-                renderer.AddActor(actor[-1])
+            if len(lod_pdata) > 0:
+                renderer.AddObserver("StartEvent", self._startRenderEvent)
+        else:
+            vessel_set = set(vessel_list)
+            for i in range(self.num_tubes):
+                if vessel_list == [] or i in vessel_set:
+                    pdata[i].GetPointData().SetActiveScalars(param)
+
+                    mapper = vtkPolyDataMapper()
+                    mapper.SetInputData(pdata[i])
+                    mapper.ScalarVisibilityOn()
+
+                    actor = vtkActor()
+                    actor.SetMapper(mapper)
+                    self.tube_actors[self.tube_list[i].GetId()] = actor
+
+                    renderer.AddActor(actor)
 
         renderWindow.Render()
+        if self.offscreen:
+            return
         self.renderWindowInteractor.Initialize()
         self.renderWindowInteractor.Start()
 
@@ -273,7 +402,9 @@ class tube_viewer:
             None
         """
         if self.tube_polylines == []:
-            self.tube_polylines = convert_tubes_to_polylines(self.tubes)
+            self.tube_polylines = convert_tubes_to_polylines(
+                self.tubes, self.merged
+            )
         self._render(self.tube_polylines, param, vessel_list)
 
     def render_tubes_as_surfaces(self, param="Radius", vessel_list=[]):
@@ -290,5 +421,37 @@ class tube_viewer:
             None
         """
         if self.tube_surfaces == []:
-            self.tube_surfaces = convert_tubes_to_surfaces(self.tubes)
+            self.tube_surfaces = convert_tubes_to_surfaces(
+                self.tubes, merged=self.merged
+            )
         self._render(self.tube_surfaces, param, vessel_list)
+
+    def render_tubes_as_lod_surfaces(self, param="Radius", vessel_list=[]):
+        """
+        Renders the tubes as surfaces whose level of detail follows zoom.
+
+        Coarse, medium and fine surfaces are generated once by
+        convert_tubes_to_lod_surfaces.  The fine level is drawn while the
+        camera is within lod_distances[0] scene diagonals of the scene
+        center, the medium level within lod_distances[1], and the coarse
+        level beyond. Requires the viewer to be in merged mode.
+
+        Args:
+            param (str, optional): The parameter to be used for coloring tubes.
+                Defaults to "Radius".
+            vessel_list (list, optional): The list of tubes to be rendered.
+                Defaults to []. If empty, all tubes are rendered.
+
+        Returns:
+            None
+        """
+        if not self.merged:
+            print("ERROR: Level of detail rendering requires merged=True")
+            return
+        lod_surfaces = convert_tubes_to_lod_surfaces(self.tubes)
+        lod_pdata = [
+            lod_surfaces["fine"],
+            lod_surfaces["medium"],
+            lod_surfaces["coarse"],
+        ]
+        self._render(lod_pdata[0], param, vessel_list, lod_pdata)
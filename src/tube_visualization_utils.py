@@ -1,20 +1,290 @@
-from functools import cache
-
-from tube_utils import get_children_as_list
-
-from vtkmodules.vtkCommonCore import vtkDoubleArray, vtkPoints
-from vtkmodules.vtkCommonDataModel import (
-    vtkCellArray,
-    vtkPolyData,
-    vtkPolyLine,
+import inspect
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from itertools import repeat
+
+import numpy as np
+from tube_utils import (
+    TUBE_POINT_SCALAR_ATTRIBUTES,
+    get_children_as_list,
+    get_tube_point_arrays,
 )
-from vtkmodules.vtkFiltersCore import vtkTubeFilter
-
-
-@cache
-def convert_tubes_to_polylines(tubes):
-    tube_polylines = []
 
+from vtkmodules.util.numpy_support import (
+    get_numpy_array_type,
+    numpy_to_vtk,
+    numpy_to_vtkIdTypeArray,
+    vtk_to_numpy,
+)
+from vtkmodules.util.vtkConstants import VTK_DOUBLE, VTK_ID_TYPE
+from vtkmodules.vtkCommonCore import vtkIdList, vtkPoints
+from vtkmodules.vtkCommonDataModel import vtkCellArray, vtkPolyData
+from vtkmodules.vtkFiltersCore import (
+    vtkAppendPolyData,
+    vtkExtractCells,
+    vtkTubeFilter,
+)
+from vtkmodules.vtkFiltersGeometry import vtkGeometryFilter
+
+_VTK_ID_DTYPE = get_numpy_array_type(VTK_ID_TYPE)
+
+
+class tube_geometry_cache:
+    """
+    A memory-bounded LRU cache of the geometry converted from tube groups.
+
+    Entries are keyed by the converting function, the group, and the
+    remaining arguments.  Each entry records the group state (the latest
+    ITK modification time of the group and its tubes, and the number of
+    tubes) it was computed from, so a group changed in place, e.g., by
+    TubeMath smoothing, is converted again instead of being served stale
+    geometry.  Groups themselves are not referenced by the cache.
+    """
+
+    def __init__(self, max_bytes=1024**3):
+        """
+        Args:
+            max_bytes (int, optional): Limit on the total VTK memory held by
+                cached geometry. Least recently used entries are evicted
+                beyond it. Defaults to 1 GiB.
+        """
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_group_state(tubes):
+        """
+        Returns a value that changes whenever the group or a tube changes.
+
+        ITK modification times come from a single global counter, so the
+        state also differs between distinct groups.
+        """
+        tube_list = get_children_as_list(tubes)
+        mtime = tubes.GetMTime()
+        for tube in tube_list:
+            mtime = max(mtime, tube.GetMTime())
+        return (mtime, len(tube_list))
+
+    @staticmethod
+    def _getMemorySize(value):
+        """
+        Private function to get the memory, in bytes, of cached geometry.
+        """
+        if isinstance(value, dict):
+            value = list(value.values())
+        if isinstance(value, list):
+            return sum(pdata.GetActualMemorySize() for pdata in value) * 1024
+        return value.GetActualMemorySize() * 1024
+
+    def get(self, key, state):
+        """
+        Returns the cached value for key if computed from state, else None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == state:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, state, value):
+        """
+        Caches value for key, evicting least recently used entries.
+        """
+        nbytes = self._getMemorySize(value)
+        with self._lock:
+            self._remove(key)
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (state, value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def _remove(self, key):
+        """
+        Private function to drop an entry and release its memory budget.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def invalidate(self, tubes=None):
+        """
+        Drops the cached geometry of a group, or of all groups.
+
+        Args:
+            tubes (itk.GroupSpatialObject, optional): The group whose
+                entries are dropped. Defaults to None, which clears the
+                whole cache.
+        """
+        with self._lock:
+            if tubes is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            for key in [k for k in self._entries if k[1] == id(tubes)]:
+                self._remove(key)
+
+    def get_statistics(self):
+        """
+        Returns the hit, miss and eviction counts, and the memory in use.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+geometry_cache = tube_geometry_cache()
+
+
+def _cached_tube_geometry(func):
+    """
+    Private decorator caching a conversion function in geometry_cache.
+
+    The group state is read after converting, since conversion itself
+    updates the tubes, e.g., by computing their tangents and normals.
+    Arguments that do not change the result, such as num_workers, are
+    left out of the key.
+    """
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    def wrapper(tubes, *args, **kwargs):
+        arguments = signature.bind(tubes, *args, **kwargs)
+        arguments.apply_defaults()
+        key = (func.__name__, id(tubes)) + tuple(
+            value
+            for name, value in arguments.arguments.items()
+            if name not in ("tubes", "num_workers")
+        )
+
+        value = geometry_cache.get(key, geometry_cache.get_group_state(tubes))
+        if value is None:
+            value = func(tubes, *args, **kwargs)
+            geometry_cache.put(
+                key, geometry_cache.get_group_state(tubes), value
+            )
+        return value
+
+    return wrapper
+
+
+def _numpy_to_vtk_double_array(name, values):
+    """Wraps a contiguous float64 array as a vtkDoubleArray without copying.
+
+    numpy_to_vtk keeps a reference to the array on the returned object.
+    """
+    vtk_array = numpy_to_vtk(values, deep=False, array_type=VTK_DOUBLE)
+    vtk_array.SetName(name)
+    return vtk_array
+
+
+def _point_arrays_to_polydata(point_arrays, first_tube, last_tube):
+    """Builds one vtkPolyData holding tubes first_tube to last_tube - 1.
+
+    Each tube becomes one polyline cell, labeled by the "TubeId" cell
+    data array.  Point data arrays are views of the columns in
+    point_arrays, handed to VTK without copying.
+    """
+    tube_offsets = point_arrays["TubeOffsets"]
+    first_point = tube_offsets[first_tube]
+    last_point = tube_offsets[last_tube]
+    num_points = last_point - first_point
+
+    def _column(name):
+        return point_arrays[name][first_point:last_point]
+
+    tube_ids = point_arrays["TubeId"][first_tube:last_tube]
+
+    data_point = vtkPoints()
+    data_point.SetData(
+        _numpy_to_vtk_double_array("Points", _column("Position"))
+    )
+
+    cell_offsets = tube_offsets[first_tube : last_tube + 1] - first_point
+    tube_line_array = vtkCellArray()
+    tube_line_array.SetData(
+        numpy_to_vtkIdTypeArray(
+            np.ascontiguousarray(cell_offsets, dtype=_VTK_ID_DTYPE),
+            deep=True,
+        ),
+        numpy_to_vtkIdTypeArray(
+            np.arange(num_points, dtype=_VTK_ID_DTYPE), deep=True
+        ),
+    )
+
+    point_ids = np.repeat(
+        tube_ids.astype(np.float64),
+        np.diff(tube_offsets[first_tube : last_tube + 1]),
+    )
+
+    tube_polyline = vtkPolyData()
+    tube_polyline.SetPoints(data_point)
+    tube_polyline.SetLines(tube_line_array)
+    point_data = tube_polyline.GetPointData()
+    point_data.AddArray(_numpy_to_vtk_double_array("Id", point_ids))
+    point_data.AddArray(
+        _numpy_to_vtk_double_array("Radius", _column("Radius"))
+    )
+    point_data.AddArray(_numpy_to_vtk_double_array("Color", _column("Color")))
+    for name in TUBE_POINT_SCALAR_ATTRIBUTES:
+        point_data.AddArray(_numpy_to_vtk_double_array(name, _column(name)))
+    point_data.SetActiveScalars("Radius")
+
+    cell_tube_ids = numpy_to_vtk(tube_ids, deep=False)
+    cell_tube_ids.SetName("TubeId")
+    tube_polyline.GetCellData().AddArray(cell_tube_ids)
+    return tube_polyline
+
+
+def convert_point_arrays_to_polylines(point_arrays, merged=False):
+    """Converts the per-attribute arrays of a set of tubes to polylines.
+
+    Args:
+        point_arrays (dict): Tube point arrays as returned by
+            tube_utils.get_tube_point_arrays.
+        merged (bool, optional): Return a single vtkPolyData holding one
+            polyline cell per tube. Defaults to False.
+
+    Returns:
+        list or vtkPolyData: One vtkPolyData per tube, or a single merged
+            vtkPolyData if merged is True.  Polylines have the point data
+            arrays "Id", "Radius", "Color", "Ridgeness", "Medialness",
+            "Branchness", "Curvature", "Intensity", "Roundness",
+            "Levelness", "Alpha1", "Alpha2" and "Alpha3", and the cell
+            data array "TubeId".
+    """
+    num_tubes = len(point_arrays["TubeId"])
+    if merged:
+        return _point_arrays_to_polydata(point_arrays, 0, num_tubes)
+    return [
+        _point_arrays_to_polydata(point_arrays, i, i + 1)
+        for i in range(num_tubes)
+    ]
+
+
+@_cached_tube_geometry
+def convert_tubes_to_polylines(tubes, merged=False):
     tubes.Update()
     tube_list = get_children_as_list(tubes)
 
@@ -23,125 +293,348 @@ def convert_tubes_to_polylines(tubes):
         tube.RemoveDuplicatePointsInObjectSpace()
         tube.ComputeTangentsAndNormals()
 
-        tube_num_points = tube.GetNumberOfPoints()
-
-        data_point = vtkPoints()
-        data_point.SetNumberOfPoints(tube_num_points)
-
-        data_radius = vtkDoubleArray()
-        data_radius.SetName("Radius")
-        data_radius.SetNumberOfTuples(tube_num_points)
-
-        data_id = vtkDoubleArray()
-        data_id.SetName("Id")
-        data_id.SetNumberOfTuples(tube_num_points)
-
-        data_color = vtkDoubleArray()
-        data_color.SetName("Color")
-        data_color.SetNumberOfComponents(4)
-        data_color.SetNumberOfTuples(tube_num_points)
-
-        data_a1 = vtkDoubleArray()
-        data_a1.SetName("Alpha1")
-        data_a1.SetNumberOfTuples(tube_num_points)
-
-        data_a2 = vtkDoubleArray()
-        data_a2.SetName("Alpha2")
-        data_a2.SetNumberOfTuples(tube_num_points)
-
-        data_a3 = vtkDoubleArray()
-        data_a3.SetName("Alpha3")
-        data_a3.SetNumberOfTuples(tube_num_points)
-
-        data_ridgeness = vtkDoubleArray()
-        data_ridgeness.SetName("Ridgeness")
-        data_ridgeness.SetNumberOfTuples(tube_num_points)
-
-        data_medialness = vtkDoubleArray()
-        data_medialness.SetName("Medialness")
-        data_medialness.SetNumberOfTuples(tube_num_points)
-
-        data_branchness = vtkDoubleArray()
-        data_branchness.SetName("Branchness")
-        data_branchness.SetNumberOfTuples(tube_num_points)
-
-        data_intensity = vtkDoubleArray()
-        data_intensity.SetName("Intensity")
-        data_intensity.SetNumberOfTuples(tube_num_points)
-
-        data_curvature = vtkDoubleArray()
-        data_curvature.SetName("Curvature")
-        data_curvature.SetNumberOfTuples(tube_num_points)
-
-        data_roundness = vtkDoubleArray()
-        data_roundness.SetName("Roundness")
-        data_roundness.SetNumberOfTuples(tube_num_points)
-
-        data_levelness = vtkDoubleArray()
-        data_levelness.SetName("Levelness")
-        data_levelness.SetNumberOfTuples(tube_num_points)
-
-        tube_line = vtkPolyLine()
-        tube_line.GetPointIds().SetNumberOfIds(tube_num_points)
-        for point_num, point in enumerate(tube.GetPoints()):
-            tube_line.GetPointIds().SetId(point_num, point_num)
-            data_point.SetPoint(point_num, *point.GetPositionInWorldSpace())
-
-            data_id.SetTuple1(point_num, tube.GetId())
-            data_radius.SetTuple1(point_num, point.GetRadiusInWorldSpace())
-            data_color.SetTuple4(point_num, *point.GetColor())
-
-            data_ridgeness.SetTuple1(point_num, point.GetRidgeness())
-            data_medialness.SetTuple1(point_num, point.GetMedialness())
-            data_branchness.SetTuple1(point_num, point.GetBranchness())
-            data_curvature.SetTuple1(point_num, point.GetCurvature())
-            data_intensity.SetTuple1(point_num, point.GetIntensity())
-            data_roundness.SetTuple1(point_num, point.GetRoundness())
-            data_levelness.SetTuple1(point_num, point.GetLevelness())
-            data_a1.SetTuple1(point_num, point.GetAlpha1())
-            data_a2.SetTuple1(point_num, point.GetAlpha2())
-            data_a3.SetTuple1(point_num, point.GetAlpha3())
-
-        tube_line_array = vtkCellArray()
-        tube_line_array.InsertNextCell(tube_line)
-
-        tube_polylines.append(vtkPolyData())
-        tube_polylines[-1].SetPoints(data_point)
-        tube_polylines[-1].SetLines(tube_line_array)
-        tube_polylines[-1].GetPointData().AddArray(data_id)
-        tube_polylines[-1].GetPointData().AddArray(data_radius)
-        tube_polylines[-1].GetPointData().AddArray(data_color)
-        tube_polylines[-1].GetPointData().AddArray(data_ridgeness)
-        tube_polylines[-1].GetPointData().AddArray(data_medialness)
-        tube_polylines[-1].GetPointData().AddArray(data_branchness)
-        tube_polylines[-1].GetPointData().AddArray(data_curvature)
-        tube_polylines[-1].GetPointData().AddArray(data_intensity)
-        tube_polylines[-1].GetPointData().AddArray(data_roundness)
-        tube_polylines[-1].GetPointData().AddArray(data_levelness)
-        tube_polylines[-1].GetPointData().AddArray(data_a1)
-        tube_polylines[-1].GetPointData().AddArray(data_a2)
-        tube_polylines[-1].GetPointData().AddArray(data_a3)
-        tube_polylines[-1].GetPointData().SetActiveScalars("Radius")
-
-    return tube_polylines
-
-
-@cache
-def convert_tubes_to_surfaces(tubes, number_of_sides=5):
-    tubes.Update()
-    tube_list = get_children_as_list(tubes)
-    num_tubes = len(tube_list)
-
-    tube_polylines = convert_tubes_to_polylines(tubes)
+    return convert_point_arrays_to_polylines(
+        get_tube_point_arrays(tube_list), merged
+    )
+
+
+@_cached_tube_geometry
+def convert_tubes_to_surfaces(
+    tubes, number_of_sides=5, merged=False, num_workers=1
+):
+    tube_polylines = convert_tubes_to_polylines(tubes, merged)
+
+    if num_workers <= 1:
+        if merged:
+            return _convert_polyline_to_surface(
+                tube_polylines, number_of_sides
+            )
+        return [
+            _convert_polyline_to_surface(tube_polyline, number_of_sides)
+            for tube_polyline in tube_polylines
+        ]
+
+    # vtkTubeFilter sweeps each polyline independently, so filtering
+    #   blocks of tubes concurrently and concatenating the outputs in tube
+    #   order reproduces the serial result.  VTK releases the GIL while a
+    #   filter executes, so threads run the filters in parallel.
+    if merged:
+        tube_polylines = _split_polylines(tube_polylines, num_workers)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        tube_surfaces = list(
+            executor.map(
+                _convert_polyline_to_surface,
+                tube_polylines,
+                repeat(number_of_sides),
+            )
+        )
+    if merged:
+        appender = vtkAppendPolyData()
+        for tube_surface in tube_surfaces:
+            appender.AddInputData(tube_surface)
+        appender.Update()
+        return appender.GetOutput()
+    return tube_surfaces
 
-    tube_surfaces = []
-    for i in range(num_tubes):
-        tFilter = vtkTubeFilter()
-        tFilter.SetVaryRadiusToVaryRadiusByAbsoluteScalar()
-        tFilter.CappingOn()
-        tFilter.SetNumberOfSides(number_of_sides)
-        tFilter.SetInputData(tube_polylines[i])
-        tFilter.Update()
-        tube_surfaces.append(tFilter.GetOutput())
 
-    return tube_surfaces
+def _polyline_to_point_arrays(tube_polyline):
+    """Views the arrays of a merged polyline as tube point arrays.
+
+    This is the inverse of _point_arrays_to_polydata and does not copy.
+    """
+    point_data = tube_polyline.GetPointData()
+    point_arrays = {
+        "Position": vtk_to_numpy(tube_polyline.GetPoints().GetData()),
+        "TubeId": vtk_to_numpy(
+            tube_polyline.GetCellData().GetArray("TubeId")
+        ),
+        "TubeOffsets": vtk_to_numpy(
+            tube_polyline.GetLines().GetOffsetsArray()
+        ),
+    }
+    for name in ("Radius", "Color") + TUBE_POINT_SCALAR_ATTRIBUTES:
+        point_arrays[name] = vtk_to_numpy(point_data.GetArray(name))
+    return point_arrays
+
+
+def _split_polylines(tube_polyline, num_blocks):
+    """Splits a merged polyline into blocks of consecutive tubes.
+
+    Blocks hold about the same number of points and share the memory of
+    the merged point data.
+    """
+    point_arrays = _polyline_to_point_arrays(tube_polyline)
+
+    tube_offsets = point_arrays["TubeOffsets"]
+    num_tubes = len(tube_offsets) - 1
+    block_starts = np.searchsorted(
+        tube_offsets,
+        np.linspace(0, tube_offsets[-1], num_blocks + 1)[:-1],
+    )
+    block_bounds = np.unique(np.append(block_starts, num_tubes))
+    return [
+        _point_arrays_to_polydata(point_arrays, first_tube, last_tube)
+        for first_tube, last_tube in zip(block_bounds[:-1], block_bounds[1:])
+    ]
+
+
+def _convert_polyline_to_surface(tube_polyline, number_of_sides):
+    """Sweeps the polylines of a vtkPolyData using their "Radius" values.
+
+    vtkTubeFilter passes cell data through, so "TubeId" labels the
+    triangle strips and caps generated from each polyline.
+    """
+    tFilter = vtkTubeFilter()
+    tFilter.SetVaryRadiusToVaryRadiusByAbsoluteScalar()
+    tFilter.CappingOn()
+    tFilter.SetNumberOfSides(number_of_sides)
+    tFilter.SetInputData(tube_polyline)
+    tFilter.Update()
+    return tFilter.GetOutput()
+
+
+# The finest level has at most the 5 sides that convert_tubes_to_surfaces
+#   uses by default, so it is never heavier than the surfaces it replaces.
+TUBE_LOD_LEVELS = {
+    "coarse": {
+        "sides_at_median_radius": 3,
+        "max_sides": 4,
+        "angle_tolerance": 15.0,
+        "radius_tolerance": 0.2,
+        "max_step": 16,
+    },
+    "medium": {
+        "sides_at_median_radius": 4,
+        "max_sides": 5,
+        "angle_tolerance": 5.0,
+        "radius_tolerance": 0.1,
+        "max_step": 8,
+    },
+    "fine": {
+        "sides_at_median_radius": 5,
+        "max_sides": 5,
+        "angle_tolerance": 0.0,
+        "radius_tolerance": 0.0,
+        "max_step": 1,
+    },
+}
+
+
+def select_tubes_in_point_arrays(point_arrays, tube_indices):
+    """Gathers a subset of tubes from tube point arrays.
+
+    Args:
+        point_arrays (dict): Tube point arrays as returned by
+            tube_utils.get_tube_point_arrays or
+            tube_utils.read_group_arrays.
+        tube_indices (np.ndarray): The indices of the tubes to keep,
+            in the order they should appear, e.g., from
+            tube_utils.find_tubes_in_point_arrays.
+
+    Returns:
+        dict: New tube point arrays holding only the selected tubes.
+            Tubes whose parent is not selected have no parent.
+    """
+    tube_offsets = point_arrays["TubeOffsets"]
+    starts = tube_offsets[tube_indices]
+    counts = tube_offsets[np.asarray(tube_indices) + 1] - starts
+    new_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_offsets[1:])
+    rows = np.repeat(starts - new_offsets[:-1], counts) + np.arange(
+        new_offsets[-1]
+    )
+
+    # Columns named "Tube..." hold one row per tube
+    selected = {
+        name: values[tube_indices] if name.startswith("Tube") else values[rows]
+        for name, values in point_arrays.items()
+    }
+    selected["TubeOffsets"] = new_offsets
+    if "TubeParent" in selected:
+        new_index = np.full(len(tube_offsets) - 1, -1, dtype=np.int64)
+        new_index[tube_indices] = np.arange(len(counts))
+        parent = selected["TubeParent"]
+        selected["TubeParent"] = np.where(
+            parent >= 0, new_index[np.maximum(parent, 0)], -1
+        )
+    return selected
+
+
+def decimate_point_arrays(
+    point_arrays, angle_tolerance=5.0, radius_tolerance=0.1, max_step=8
+):
+    """Drops centerline points where a tube is straight and uniform.
+
+    An interior point is kept if the centerline turns by more than
+    angle_tolerance at it, if the radius changes across it by more than
+    radius_tolerance relative to its radius, or if it falls on every
+    max_step-th point of its tube.  End points are always kept.
+
+    Args:
+        point_arrays (dict): Tube point arrays as returned by
+            tube_utils.get_tube_point_arrays or read_group_arrays.
+            Columns named "Tube..." are copied unchanged.
+        angle_tolerance (float, optional): Turning angle, in degrees.
+            Defaults to 5.0.
+        radius_tolerance (float, optional): Relative radius change.
+            Defaults to 0.1.
+        max_step (int, optional): Maximum run of dropped points plus one.
+            Defaults to 8.
+
+    Returns:
+        dict: New tube point arrays holding only the kept points.
+    """
+    tube_offsets = point_arrays["TubeOffsets"]
+    num_points = tube_offsets[-1]
+    num_tubes = len(tube_offsets) - 1
+    if num_points == 0 or max_step <= 1:
+        return point_arrays
+
+    counts = np.diff(tube_offsets)
+    point_tube = np.repeat(np.arange(num_tubes), counts)
+    point_index = np.arange(num_points) - tube_offsets[point_tube]
+
+    keep = np.zeros(num_points, dtype=bool)
+    keep[tube_offsets[:-1][counts > 0]] = True
+    keep[tube_offsets[1:][counts > 0] - 1] = True
+    keep |= point_index % max_step == 0
+
+    interior = np.flatnonzero(~keep)
+    position = point_arrays["Position"]
+    radius = point_arrays["Radius"]
+    segment_in = position[interior] - position[interior - 1]
+    segment_out = position[interior + 1] - position[interior]
+    cos_angle = np.einsum("ij,ij->i", segment_in, segment_out) / np.maximum(
+        np.linalg.norm(segment_in, axis=1)
+        * np.linalg.norm(segment_out, axis=1),
+        np.finfo(np.float64).tiny,
+    )
+    turning = cos_angle < np.cos(np.radians(angle_tolerance))
+    radius_change = np.abs(radius[interior + 1] - radius[interior - 1])
+    varying = radius_change > radius_tolerance * np.abs(radius[interior])
+    keep[interior] = turning | varying
+
+    # Columns named "Tube..." hold one row per tube
+    decimated = {
+        name: values if name.startswith("Tube") else values[keep]
+        for name, values in point_arrays.items()
+    }
+    decimated["TubeOffsets"] = np.zeros(num_tubes + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(point_tube[keep], minlength=num_tubes),
+        out=decimated["TubeOffsets"][1:],
+    )
+    return decimated
+
+
+@_cached_tube_geometry
+def convert_tubes_to_lod_surfaces(
+    tubes, levels=("coarse", "medium", "fine"), num_workers=1
+):
+    """Converts tubes to merged surfaces at several levels of detail.
+
+    For each level in TUBE_LOD_LEVELS, centerlines are decimated by
+    decimate_point_arrays, and each tube is swept with a number of sides
+    proportional to its mean radius, relative to the median point radius
+    of the group, clipped to [3, max_sides].  Thin tubes therefore get
+    triangular cross sections at every level.
+
+    Args:
+        tubes (itk.GroupSpatialObject): The tubes to convert.
+        levels (tuple, optional): The names of the levels to generate.
+            Defaults to ("coarse", "medium", "fine").
+        num_workers (int, optional): Number of threads sweeping tubes.
+            Defaults to 1.
+
+    Returns:
+        dict: The merged vtkPolyData surface for each level.  Tubes are
+            ordered by number of sides, and labeled by "TubeId".
+    """
+    point_arrays = _polyline_to_point_arrays(
+        convert_tubes_to_polylines(tubes, merged=True)
+    )
+    tube_offsets = point_arrays["TubeOffsets"]
+    num_tubes = len(tube_offsets) - 1
+    counts = np.diff(tube_offsets)
+    mean_radius = np.bincount(
+        np.repeat(np.arange(num_tubes), counts),
+        weights=point_arrays["Radius"],
+        minlength=num_tubes,
+    ) / np.maximum(counts, 1)
+    median_radius = (
+        np.median(point_arrays["Radius"]) if tube_offsets[-1] > 0 else 1.0
+    )
+
+    lod_surfaces = {}
+    for level in levels:
+        params = TUBE_LOD_LEVELS[level]
+        level_arrays = decimate_point_arrays(
+            point_arrays,
+            params["angle_tolerance"],
+            params["radius_tolerance"],
+            params["max_step"],
+        )
+        tube_sides = np.clip(
+            np.round(
+                params["sides_at_median_radius"]
+                * mean_radius
+                / max(median_radius, np.finfo(np.float64).tiny)
+            ),
+            3,
+            params["max_sides"],
+        ).astype(int)
+
+        blocks = []
+        blocks_sides = []
+        for number_of_sides in np.unique(tube_sides):
+            tube_indices = np.flatnonzero(tube_sides == number_of_sides)
+            tube_polyline = _point_arrays_to_polydata(
+                select_tubes_in_point_arrays(level_arrays, tube_indices),
+                0,
+                len(tube_indices),
+            )
+            for block in _split_polylines(tube_polyline, num_workers):
+                blocks.append(block)
+                blocks_sides.append(int(number_of_sides))
+
+        with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+            surfaces = list(
+                executor.map(
+                    _convert_polyline_to_surface, blocks, blocks_sides
+                )
+            )
+        appender = vtkAppendPolyData()
+        for surface in surfaces:
+            appender.AddInputData(surface)
+        appender.Update()
+        lod_surfaces[level] = appender.GetOutput()
+
+    return lod_surfaces
+
+
+def extract_tubes_from_polydata(pdata, tube_ids):
+    """Extracts the cells of the given tubes from a merged vtkPolyData.
+
+    Args:
+        pdata (vtkPolyData): A merged output of convert_tubes_to_polylines
+            or convert_tubes_to_surfaces.
+        tube_ids (list): The ids of the tubes to extract.
+
+    Returns:
+        vtkPolyData: The cells whose "TubeId" is in tube_ids.
+    """
+    cell_tube_ids = vtk_to_numpy(pdata.GetCellData().GetArray("TubeId"))
+    cell_ids = np.flatnonzero(np.isin(cell_tube_ids, list(tube_ids)))
+
+    cell_list = vtkIdList()
+    cell_list.SetNumberOfIds(len(cell_ids))
+    for i, cell_id in enumerate(cell_ids):
+        cell_list.SetId(i, cell_id)
+
+    extractor = vtkExtractCells()
+    extractor.SetInputData(pdata)
+    extractor.SetCellList(cell_list)
+    geometry = vtkGeometryFilter()
+    geometry.SetInputConnection(extractor.GetOutputPort())
+    geometry.Update()
+    return geometry.GetOutput()